@@ -0,0 +1,696 @@
+"""Route and command benchmarks against large synthetic databases.
+
+Usage::
+
+    python bench_watchlist.py                          # 1k / 100k / 1M rows, print a report
+    python bench_watchlist.py --sizes 1000 --save      # store the results as the baseline
+    python bench_watchlist.py --sizes 1000 --baseline bench_baseline.json
+
+With ``--baseline`` the run exits with status 1 when a scenario regresses
+beyond ``--threshold`` (p95 latency or peak memory), or runs more SQL
+statements than the baseline did.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from watchlist import app, db
+from watchlist.cache import clear_caches
+from watchlist.database import dispose_read_engines
+from watchlist.models import User, Movie
+from watchlist.security import login_limiter, password_verifier
+from watchlist import api, assets, backup, fakedata, images
+
+# 基准测试
+# 为每种规模（默认 1 千、10 万、100 万行）生成一个 SQLite 数据库文件并缓存在 --data-dir 里，
+# 每次运行复制一份来测，写操作不会污染缓存的数据库。
+# 每个场景通过 test_client / test_cli_runner 执行若干次，记录延迟的 p50 / p95 / p99、
+# 每次执行的 SQL 条数，以及单独执行一次时 tracemalloc 统计到的内存峰值。
+# SCENARIOS 覆盖每个路由和每个 flask 命令，只有 enrich-worker 除外（它需要外部的元数据服务）；
+# 新增路由或命令时在这里加一个场景。
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+DATA_VERSION = 5    # 修改了生成数据的方式后加一，让缓存的数据库重新生成
+PASSWORD = 'benchmark'
+
+
+# ---
+# SQL 计数
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+query_counter = QueryCounter()
+
+
+# ---
+# 测试数据
+
+def seed_database(path, size):
+    """Create a database at ``path`` holding one user and ``size`` movies."""
+    use_database(path)
+    db.create_all()
+    user = User(name='Bench', username='bench')
+    user.set_password(PASSWORD)
+    db.session.add(user)
+    db.session.commit()
+    fakedata.insert_movies(fakedata.generate_movies(size, seed=0, batch_size=50000), defer_indexes=True)
+    db.session.remove()
+
+
+def use_database(path):
+    db.session.remove()
+    db.get_engine().dispose()
+    dispose_read_engines()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    clear_caches()
+
+
+def prepare_database(size, data_dir, work_dir):
+    """Return the path of a fresh copy of the cached ``size``-row database."""
+    os.makedirs(data_dir, exist_ok=True)
+    cached = os.path.join(data_dir, 'watchlist-%d-v%d.db' % (size, DATA_VERSION))
+    if not os.path.exists(cached):
+        start = time.perf_counter()
+        tmp = cached + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with app.app_context():
+            seed_database(tmp, size)
+            use_database(':memory:')
+        os.replace(tmp, cached)
+        print('Seeded %d movies in %.1fs' % (size, time.perf_counter() - start), file=sys.stderr)
+    path = os.path.join(work_dir, 'bench-%d.db' % size)
+    shutil.copyfile(cached, path)
+    return path
+
+
+# ---
+# 场景
+
+class Context(object):
+    """State shared by the scenarios of one database size."""
+
+    def __init__(self, size, work_dir):
+        self.size = size
+        self.work_dir = work_dir
+        self.client = app.test_client()    # 匿名访客
+        self.runner = app.test_cli_runner()
+        self.user_client = app.test_client()
+        login_limiter.reset()
+        self.user_client.post('/login', data=dict(username='bench', password=PASSWORD))
+        with app.app_context():
+            user = User.query.first()
+            self.user_id = user.id
+            self.token = api.generate_token(user)
+            self.max_id = db.session.query(db.func.max(Movie.id)).scalar()
+        self.rng = random.Random(1)
+        self.deleted = 0
+        self.asset_path = None
+
+    def random_id(self):
+        return self.rng.randint(1, self.max_id)
+
+
+def check(response, status=200):
+    if response.status_code != status:
+        raise AssertionError('Expected %d, got %d' % (status, response.status_code))
+    response.get_data()    # 流式响应也要读完
+    response.close()
+
+
+def check_command(result):
+    if result.exit_code != 0:
+        raise AssertionError(result.output)
+
+
+def index(ctx):
+    check(ctx.client.get('/'))
+
+
+def index_last_page(ctx):
+    check(ctx.client.get('/?after=%d' % (ctx.max_id - 20)))
+
+
+def index_year_range(ctx):
+    check(ctx.client.get('/?sort=title&year_from=1990&year_to=1999'))
+
+
+def index_year_range_added(ctx):
+    check(ctx.client.get('/?year_from=1990&year_to=1999'))    # 筛选表单默认的排序
+
+
+def index_narrow_year_range(ctx):
+    check(ctx.client.get('/?sort=title&year_from=1900&year_to=1901'))
+
+
+def search(ctx):
+    check(ctx.client.get('/search?q=night'))
+
+
+def stats(ctx):
+    check(ctx.client.get('/stats'))
+
+
+def api_stats(ctx):
+    check(ctx.client.get('/api/stats'))
+
+
+def api_movies(ctx):
+    check(ctx.client.get('/api/movies?after=%d' % ctx.random_id()))
+
+
+def metrics(ctx):
+    check(ctx.client.get('/metrics'))
+
+
+def edit_get(ctx):
+    check(ctx.user_client.get('/movie/edit/%d' % ctx.random_id()))
+
+
+def edit_post(ctx):
+    movie_id = ctx.random_id()
+    check(ctx.user_client.post('/movie/edit/%d' % movie_id, data=dict(title='Edited %d' % movie_id, year='2001')),
+          302)
+
+
+def create(ctx):
+    check(ctx.user_client.post('/', data=dict(title='Created', year='2020')), 302)
+
+
+def delete(ctx):
+    # 从最大的 id 往前删，不会删到同一条；之后的场景不再随机访问已有的条目
+    check(ctx.user_client.post('/movie/delete/%d' % (ctx.max_id - ctx.deleted)), 302)
+    ctx.deleted += 1
+
+
+def api_batch(ctx):
+    operations = [{'op': 'create', 'title': 'Batch %d' % i, 'year': 2000 + i % 20} for i in range(100)]
+    check(ctx.client.post('/api/movies/batch', json={'operations': operations},
+                          headers={'Authorization': 'Bearer ' + ctx.token}))
+
+
+def login_get(ctx):
+    check(ctx.client.get('/login'))
+
+
+def settings_get(ctx):
+    check(ctx.user_client.get('/settings'))
+
+
+def logout(ctx):
+    # 直接写入会话登录（不计入密码校验），只测登出本身
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(ctx.user_id)
+        session['_fresh'] = True
+    check(client.get('/logout'), 302)
+
+
+def export_jsonl(ctx):
+    check(ctx.client.get('/export.jsonl'))
+
+
+def asset(ctx):
+    if ctx.asset_path is None:    # 第一次（预热）时生成带散列的文件
+        manifest = assets.build_assets(app.static_folder, app.config['ASSETS_BUILD_DIR'])
+        ctx.asset_path = manifest['style.css']['path']
+    check(ctx.client.get('/assets/' + ctx.asset_path, headers={'Accept-Encoding': 'gzip'}))
+
+
+def image(ctx):
+    # 第一次（预热）时生成缩略图，之后读缓存目录里的文件
+    source = images.get_source('images/avatar.png')
+    width = source.widths(images.IMAGE_SIZES['images/avatar.png'])[0]
+    check(ctx.client.get('/images/' + images.derivative_name(source, width, source.formats()[-1])))
+
+
+def login(ctx):
+    login_limiter.reset()    # 只测校验密码本身，不测限流
+    check(app.test_client().post('/login', data=dict(username='bench', password=PASSWORD)), 302)
+
+
+def settings(ctx):
+    check(ctx.user_client.post('/settings', data=dict(name='Bench')), 302)
+
+
+def export_csv(ctx):
+    check(ctx.client.get('/export.csv'))
+
+
+def cmd_export(ctx):
+    check_command(ctx.runner.invoke(args=['export', os.path.join(ctx.work_dir, 'export.csv')]))
+
+
+def cmd_import(ctx):
+    path = os.path.join(ctx.work_dir, 'import.csv')
+    if not os.path.exists(path):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['title', 'year'])
+            for batch in fakedata.generate_movies(1000, seed=2):
+                writer.writerows(batch)
+    check_command(ctx.runner.invoke(args=['import', path]))
+
+
+def cmd_token(ctx):
+    check_command(ctx.runner.invoke(args=['token']))
+
+
+def cmd_rebuild_search(ctx):
+    check_command(ctx.runner.invoke(args=['rebuild-search']))
+
+
+def cmd_rebuild_stats(ctx):
+    check_command(ctx.runner.invoke(args=['rebuild-stats']))
+
+
+def cmd_check_stats(ctx):
+    check_command(ctx.runner.invoke(args=['check-stats']))
+
+
+def cmd_initdb(ctx):
+    check_command(ctx.runner.invoke(args=['initdb']))    # 不带 --drop，只创建缺少的表
+
+
+def cmd_migrate(ctx):
+    check_command(ctx.runner.invoke(args=['migrate']))
+
+
+def cmd_warmup(ctx):
+    check_command(ctx.runner.invoke(args=['warmup']))
+
+
+def cmd_build_assets(ctx):
+    check_command(ctx.runner.invoke(args=['build-assets']))
+
+
+def cmd_build_images(ctx):
+    check_command(ctx.runner.invoke(args=['build-images']))
+
+
+def cmd_forge(ctx):
+    check_command(ctx.runner.invoke(args=['forge', '--count', '1000', '--seed', '3']))
+
+
+def cmd_admin(ctx):
+    # 密码散列改变后旧的 API 令牌失效，所以排在 api_batch 之后
+    check_command(ctx.runner.invoke(args=['admin', '--username', 'bench', '--password', PASSWORD]))
+
+
+def cmd_enrich_missing(ctx):
+    check_command(ctx.runner.invoke(args=['enrich-missing']))
+
+
+def cmd_backup(ctx):
+    check_command(ctx.runner.invoke(args=['backup']))
+
+
+def cmd_restore(ctx):
+    snapshot = backup.list_snapshots(app.config['BACKUP_DIR'])[-1]    # cmd_backup 写的快照
+    check_command(ctx.runner.invoke(args=['restore', snapshot, '--yes']))
+
+
+# 需要 Pillow 的场景，没有安装时跳过
+PILLOW_SCENARIOS = {'image', 'cmd_build_images'}
+
+
+# (名称, 函数, 最多执行次数, 额外配置)；读操作在前，写操作在后
+SCENARIOS = [
+    ('index', index, None, {}),
+    ('index_cached', index, None, {'PAGE_CACHE_ENABLED': True}),
+    ('index_last_page', index_last_page, None, {}),
+    ('index_year_range', index_year_range, None, {}),
+    ('index_year_range_added', index_year_range_added, None, {}),
+    ('index_narrow_year_range', index_narrow_year_range, None, {}),
+    ('search', search, None, {}),
+    ('stats', stats, None, {}),
+    ('api_stats', api_stats, None, {}),
+    ('api_movies', api_movies, None, {}),
+    ('metrics', metrics, None, {}),
+    ('edit_get', edit_get, None, {}),
+    ('login_get', login_get, None, {}),
+    ('settings_get', settings_get, None, {}),
+    ('asset', asset, None, {}),
+    ('image', image, None, {}),
+    ('export_csv', export_csv, 3, {}),
+    ('export_jsonl', export_jsonl, 3, {}),
+    ('cmd_export', cmd_export, 3, {}),
+    ('cmd_token', cmd_token, None, {}),
+    ('cmd_check_stats', cmd_check_stats, 3, {}),
+    ('cmd_initdb', cmd_initdb, 10, {}),
+    ('cmd_migrate', cmd_migrate, 10, {}),
+    ('cmd_warmup', cmd_warmup, 3, {}),
+    ('cmd_build_assets', cmd_build_assets, 3, {}),
+    ('cmd_build_images', cmd_build_images, 3, {}),
+    ('login', login, 10, {}),
+    ('logout', logout, None, {}),
+    ('edit_post', edit_post, None, {}),
+    ('create', create, None, {}),
+    ('delete', delete, None, {}),
+    ('settings', settings, None, {}),
+    ('api_batch', api_batch, 10, {}),
+    ('cmd_import', cmd_import, 3, {}),
+    ('cmd_rebuild_search', cmd_rebuild_search, 1, {}),
+    ('cmd_rebuild_stats', cmd_rebuild_stats, 1, {}),
+    ('cmd_forge', cmd_forge, 3, {}),
+    ('cmd_admin', cmd_admin, 3, {}),
+    ('cmd_enrich_missing', cmd_enrich_missing, 1, {}),
+    ('cmd_backup', cmd_backup, 1, {}),
+    ('cmd_restore', cmd_restore, 1, {}),    # 放在最后：用 cmd_backup 的快照覆盖数据库
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)    # nearest-rank
+    return values[min(index, len(values) - 1)]
+
+
+def run_scenario(ctx, func, iterations, config):
+    saved = {key: app.config[key] for key in config}
+    app.config.update(config)
+    try:
+        func(ctx)    # 预热一次：编译模板、打开连接、填充缓存
+        latencies = []
+        queries = []
+        for i in range(iterations):
+            before = query_counter.count
+            start = time.perf_counter()
+            func(ctx)
+            latencies.append(time.perf_counter() - start)
+            queries.append(query_counter.count - before)
+
+        # 内存峰值单独测一次，tracemalloc 会拖慢执行，不计入延迟
+        tracemalloc.start()
+        try:
+            func(ctx)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        app.config.update(saved)
+    return {
+        'iterations': iterations,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'queries': max(queries),
+        'peak_memory': peak,
+    }
+
+
+def run_benchmarks(sizes, iterations=50, names=None, data_dir=None, mode='production'):
+    """Run the scenarios for each database size; return ``{size: {scenario: stats}}``."""
+    data_dir = data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'bench')
+    work_dir = tempfile.mkdtemp(prefix='watchlist-bench-')
+    saved = {key: app.config[key] for key in ('SQLALCHEMY_DATABASE_URI', 'DATABASE_MODE', 'PAGE_CACHE_ENABLED',
+                                              'TESTING', 'ASSETS_BUILD_DIR', 'IMAGES_CACHE_DIR', 'BACKUP_DIR')}
+    # 命令和静态文件写到临时目录，不碰项目里的 build/、backups/
+    app.config.update(DATABASE_MODE=mode, PAGE_CACHE_ENABLED=False, TESTING=True,
+                      ASSETS_BUILD_DIR=os.path.join(work_dir, 'assets'),
+                      IMAGES_CACHE_DIR=os.path.join(work_dir, 'images'),
+                      BACKUP_DIR=os.path.join(work_dir, 'backups'))
+    event.listen(Engine, 'before_cursor_execute', query_counter)
+    results = {}
+    try:
+        for size in sizes:
+            path = prepare_database(size, data_dir, work_dir)
+            with app.app_context():
+                use_database(path)
+            ctx = Context(size, work_dir)
+            results[str(size)] = {}
+            for name, func, limit, config in SCENARIOS:
+                if names and name not in names:
+                    continue
+                if name in PILLOW_SCENARIOS and images.Image is None:
+                    continue
+                count = min(iterations, limit) if limit else iterations
+                results[str(size)][name] = run_scenario(ctx, func, count, config)
+            with app.app_context():
+                use_database(':memory:')
+    finally:
+        event.remove(Engine, 'before_cursor_execute', query_counter)
+        password_verifier.shutdown()
+        app.config.update(saved)
+        assets.reload_manifest()    # 回到原来的 ASSETS_BUILD_DIR
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=0.2, min_latency=0.002, min_memory=256 * 1024):
+    """Return a message for every scenario that regressed against ``baseline``.
+
+    Latency and memory are only compared when the difference is larger than
+    ``min_latency`` seconds / ``min_memory`` bytes, so that noise on very fast
+    scenarios does not fail the run.
+    """
+    regressions = []
+    for size, scenarios in sorted(results.items()):
+        for name, stats in sorted(scenarios.items()):
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            label = '%s rows / %s' % (size, name)
+            if stats['p95'] > base['p95'] * (1 + threshold) and stats['p95'] - base['p95'] > min_latency:
+                regressions.append('%s: p95 %.1fms -> %.1fms' % (label, base['p95'] * 1000, stats['p95'] * 1000))
+            if stats['queries'] > base['queries']:
+                regressions.append('%s: queries %d -> %d' % (label, base['queries'], stats['queries']))
+            if stats['peak_memory'] > base['peak_memory'] * (1 + threshold) \
+                    and stats['peak_memory'] - base['peak_memory'] > min_memory:
+                regressions.append('%s: peak memory %dKB -> %dKB'
+                                   % (label, base['peak_memory'] // 1024, stats['peak_memory'] // 1024))
+    return regressions
+
+
+def format_report(results):
+    lines = ['%-10s %-20s %9s %9s %9s %8s %10s' % ('rows', 'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'queries',
+                                                 'peak KB')]
+    for size, scenarios in results.items():
+        for name, stats in scenarios.items():
+            line = '%-10s %-20s %9.2f %9.2f %9.2f %8d %10d' % (
+                size, name, stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000,
+                stats['queries'], stats['peak_memory'] // 1024)
+            if 'writes_per_second' in stats:
+                line += ' %8.0f writes/s' % stats['writes_per_second']
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+# ---
+# 冷启动：在新的 Python 进程里导入应用并处理第一批请求，模拟刚 fork / 重启的 worker
+
+COLD_START_SCRIPT = """
+import json, resource, time
+start = time.perf_counter()
+from watchlist import app, db
+imported = time.perf_counter()
+app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+with app.app_context():
+    db.create_all()
+client = app.test_client()
+ready = time.perf_counter()
+for url in ('/', '/login', '/nothing'):
+    client.get(url).get_data()
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_requests': done - ready, 'total': done - start - (ready - imported),
+                  'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+"""
+
+# 名称 -> 环境变量；bytecode_cache / warmup 两种情况先运行一次，把字节码写进缓存目录
+COLD_START_VARIANTS = [
+    ('cold_compile', {'JINJA_BYTECODE_CACHE_DIR': '', 'TEMPLATE_WARMUP': '0'}),
+    ('cold_bytecode_cache', {'TEMPLATE_WARMUP': '0'}),
+    ('cold_warmup', {'TEMPLATE_WARMUP': '1'}),
+]
+
+
+def run_cold_start(iterations=10, names=None):
+    """Time import + first requests in fresh processes; return ``{variant: stats}``."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = tempfile.mkdtemp(prefix='watchlist-jinja-')
+    results = {}
+    try:
+        for name, variables in COLD_START_VARIANTS:
+            if names and name not in names:
+                continue
+            env = dict(os.environ, JINJA_BYTECODE_CACHE_DIR=cache_dir, METRICS_ENABLED='0')
+            env.update(variables)
+            runs = []
+            for i in range(iterations + 1):
+                output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], cwd=root, env=env, check=True,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+                runs.append(json.loads(output))
+            runs = runs[1:]    # 第一次运行用来填充字节码缓存
+            totals = [run['total'] for run in runs]
+            results[name] = {
+                'iterations': iterations,
+                'p50': percentile(totals, 50),
+                'p95': percentile(totals, 95),
+                'p99': percentile(totals, 99),
+                'queries': 0,
+                'peak_memory': max(run['maxrss'] for run in runs),
+                'import': percentile([run['import'] for run in runs], 50),
+                'first_requests': percentile([run['first_requests'] for run in runs], 50),
+            }
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+# ---
+# 并发写入：多个线程同时提交表单（新建和编辑交替），比较逐个提交和合并提交（见 watchlist/groupcommit.py）
+
+WRITE_VARIANTS = [
+    ('writes', {'GROUP_COMMIT': False}),
+    ('writes_group_commit', {'GROUP_COMMIT': True}),
+]
+
+
+def run_concurrent_writes(threads=8, requests=50, names=None, data_dir=None, size=1000):
+    """Submit forms from ``threads`` clients at once; return ``{variant: stats}``."""
+    from watchlist.groupcommit import group_writer
+    data_dir = data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'bench')
+    work_dir = tempfile.mkdtemp(prefix='watchlist-bench-')
+    saved = {key: app.config[key] for key in ('SQLALCHEMY_DATABASE_URI', 'DATABASE_MODE', 'GROUP_COMMIT', 'TESTING')}
+    app.config.update(DATABASE_MODE='production', TESTING=True)
+    results = {}
+    try:
+        for name, config in WRITE_VARIANTS:
+            if names and name not in names:
+                continue
+            path = prepare_database(size, data_dir, work_dir)    # 每种情况都从同样的数据开始
+            with app.app_context():
+                use_database(path)
+            app.config.update(config)
+            clients = []
+            for i in range(threads):
+                client = app.test_client()
+                login_limiter.reset()
+                check(client.post('/login', data=dict(username='bench', password=PASSWORD)), 302)
+                clients.append(client)
+            latencies = []
+            barrier = threading.Barrier(threads + 1)
+
+            def submit(index, client):
+                rng = random.Random(index)
+                barrier.wait()
+                for i in range(requests):
+                    start = time.perf_counter()
+                    if i % 2:
+                        movie_id = rng.randint(1, size)
+                        check(client.post('/movie/edit/%d' % movie_id, data=dict(title='Edited %d' % movie_id,
+                                                                                year='2001')), 302)
+                    else:
+                        check(client.post('/', data=dict(title='Created %d' % index, year='2020')), 302)
+                    latencies.append(time.perf_counter() - start)    # list.append 是线程安全的
+
+            workers = [threading.Thread(target=submit, args=(index, client)) for index, client in enumerate(clients)]
+            for worker in workers:
+                worker.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            group_writer.shutdown()
+            if len(latencies) != threads * requests:
+                raise AssertionError('Some writes failed.')
+            results[name] = {
+                'iterations': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'queries': 0,
+                'peak_memory': 0,
+                'writes_per_second': len(latencies) / elapsed,
+            }
+            with app.app_context():
+                use_database(':memory:')
+    finally:
+        group_writer.shutdown()
+        password_verifier.shutdown()
+        app.config.update(saved)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Watchlist routes and commands.')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma-separated database sizes (rows).')
+    parser.add_argument('--iterations', type=int, default=50, help='Timed runs per scenario.')
+    parser.add_argument('--only', help='Comma-separated scenario names to run.')
+    parser.add_argument('--mode', default='production', choices=['default', 'production'],
+                        help='DATABASE_MODE to benchmark.')
+    parser.add_argument('--data-dir', help='Where seeded databases are cached.')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='Baseline JSON file.')
+    parser.add_argument('--save', action='store_true', help='Write the results to the baseline file.')
+    parser.add_argument('--output', help='Also write the results to this JSON file.')
+    parser.add_argument('--no-cold-start', action='store_true', help='Skip the cold start measurements.')
+    parser.add_argument('--no-concurrent-writes', action='store_true', help='Skip the concurrent write measurements.')
+    parser.add_argument('--write-threads', type=int, default=8, help='Clients submitting forms at once.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed regression (0.2 = 20%%).')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = set(args.only.split(',')) if args.only else None
+    results = run_benchmarks(sizes, args.iterations, names, args.data_dir, args.mode)
+    if not args.no_cold_start:
+        results['startup'] = run_cold_start(min(args.iterations, 10), names)
+    if not args.no_concurrent_writes:
+        results['concurrent'] = run_concurrent_writes(args.write_threads, args.iterations, names,
+                                                             args.data_dir)
+    print(format_report(results))
+
+    document = {'python': platform.python_version(), 'mode': args.mode, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if args.save:
+        # 合并到已有的基线里，只覆盖这次运行过的规模和场景
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f).get('results', {})
+        for size, scenarios in results.items():
+            baseline.setdefault(size, {}).update(scenarios)
+        document['results'] = baseline
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        if regressions:
+            print('\nRegressions against %s:' % args.baseline)
+            for message in regressions:
+                print('  ' + message)
+            return 1
+        print('\nNo regressions against %s.' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+# gunicorn 配置：gunicorn -c gunicorn.conf.py wsgi:app
+# 主进程先导入应用并预热（preload_app），worker 通过 fork 共享这部分内存，启动也不必再导入一遍。
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # 把主进程里已有的对象移出垃圾回收的跟踪范围，
+    # 否则 worker 里的垃圾回收会改写这些对象的引用计数头，写时复制的内存页就被复制掉了
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from watchlist import post_fork
+    post_fork()    # 丢掉从主进程继承来的数据库连接和进程池
@@ -1,11 +1,39 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest    
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from sqlalchemy import create_engine, event, text
 
 #from app import app, db, User, Movie
 #from app import forge, initdb    # 导入命令函数（都是自定义的命令）
 #因为代码经过组织后，文件路径改变了，需要更新导入语句
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import app, db, assets, images, transfer, warmup, post_fork
+from watchlist.models import User, Movie, EnrichmentJob
 from watchlist.commands import forge, initdb
+from watchlist.views import movie_list_query
+from watchlist.search import build_match_query, search_movies
+from watchlist.stats import check_stats, get_stats
+from watchlist.pagination import encode_cursor
+from watchlist.database import configure_engine, pool_options, get_read_engine, dispose_read_engines
+from watchlist.security import login_limiter
+from watchlist.metrics import request_latency, request_queries, template_render_time, reset_metrics
+from watchlist.cache import clear_caches, bump_version, current_version, page_cache
+from watchlist.groupcommit import group_writer
+from watchlist.backup import BackupError, backup_scheduler, copy_database, list_snapshots
+import bench_watchlist
 
 class WatchlistTestCase(unittest.TestCase):    #测试用例
     
@@ -18,6 +46,8 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         )
         # 创建数据库和表
         db.create_all()
+        clear_caches()    # 每个测试都使用新的数据库，清空进程内缓存
+        login_limiter.reset()
 
         # 创建测试用例，一个用户，一个电影条目
         user = User(name='Test', username='test')
@@ -72,6 +102,426 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试主页分页
+    def test_index_pagination(self):
+        app.config['WATCHLIST_PER_PAGE'] = 2
+        try:
+            db.session.add_all([Movie(title='Movie %d' % i, year='2000') for i in range(2, 6)])
+            db.session.commit()
+
+            response = self.client.get('/')
+            data = response.get_data(as_text=True)
+            self.assertIn('5 Titles', data)
+            self.assertIn('Test Movie Title', data)
+            self.assertIn('Movie 2', data)
+            self.assertNotIn('Movie 3', data)
+            self.assertIn('after=2', data)    # 下一页链接
+            self.assertNotIn('Previous', data)
+
+            response = self.client.get('/?after=2')
+            data = response.get_data(as_text=True)
+            self.assertIn('Movie 3', data)
+            self.assertIn('Movie 4', data)
+            self.assertNotIn('Test Movie Title', data)
+            self.assertIn('before=3', data)
+            self.assertIn('after=4', data)
+
+            response = self.client.get('/?after=4')
+            data = response.get_data(as_text=True)
+            self.assertIn('Movie 5', data)
+            self.assertNotIn('Next', data)
+
+            response = self.client.get('/?before=3')
+            data = response.get_data(as_text=True)
+            self.assertIn('Test Movie Title', data)
+            self.assertIn('Movie 2', data)
+            self.assertNotIn('Previous', data)
+
+            # 超出 64 位整数范围的游标当作没有游标
+            for cursor in ('after=%d' % 2 ** 63, 'before=-%d' % 2 ** 64):
+                response = self.client.get('/?' + cursor)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Test Movie Title', response.get_data(as_text=True))
+
+            # ?per_page= 覆盖默认的每页条数
+            response = self.client.get('/?per_page=10')
+            data = response.get_data(as_text=True)
+            self.assertIn('Movie 5', data)
+            self.assertNotIn('Next', data)
+        finally:
+            app.config['WATCHLIST_PER_PAGE'] = 20
+
+    # 测试按年份筛选、排序
+    def test_index_year_filter_and_sort(self):
+        app.config['WATCHLIST_PER_PAGE'] = 2
+        try:
+            db.session.add_all([Movie(title='Movie %d' % i, year=1990 + i) for i in range(1, 5)])
+            db.session.commit()
+
+            data = self.client.get('/?year_from=1992&year_to=1994&sort=title').get_data(as_text=True)
+            self.assertIn('3 Titles', data)
+            self.assertIn('Movie 2', data)
+            self.assertIn('Movie 3', data)
+            self.assertNotIn('Movie 1', data)
+            self.assertNotIn('Movie 4', data)
+
+            self.assertIn('year_from=1992', data)    # 筛选条件保留在翻页链接里
+
+            # 复合游标翻到下一页
+            movie = Movie.query.filter_by(title='Movie 3').one()
+            cursor = encode_cursor((movie.title, movie.year, movie.id))
+            data = self.client.get('/?year_from=1992&year_to=1994&sort=title&after=' + cursor).get_data(as_text=True)
+            self.assertIn('Movie 4', data)
+            self.assertNotIn('Movie 3', data)
+            self.assertIn('Previous', data)
+
+            # 类型不对的游标当作没有游标，返回第一页
+            for values in (['a', {'x': 1}, 3], [movie.title, '1993', movie.id], [movie.title, movie.year, True],
+                           [movie.title, movie.year, 2 ** 63]):
+                cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+                response = self.client.get('/?year_from=1992&year_to=1994&sort=title&after=' + cursor)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Movie 2', response.get_data(as_text=True))
+
+            data = self.client.get('/?sort=year&per_page=10').get_data(as_text=True)
+            self.assertLess(data.index('Movie 1'), data.index('Movie 4'))
+            self.assertLess(data.index('Movie 4'), data.index('Test Movie Title'))
+        finally:
+            app.config['WATCHLIST_PER_PAGE'] = 20
+
+    # 测试排序和年份范围查询都由索引完成，不需要扫描全表或临时排序
+    def test_movie_list_query_plans(self):
+        def plan(args):
+            with app.test_request_context('/?' + args):
+                query, columns, filters = movie_list_query()
+                statement = query.order_by(*columns).limit(21).statement.compile(
+                    db.engine, compile_kwargs={'literal_binds': True})
+            return ' | '.join(row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN %s' % statement)))
+
+        # 有年份筛选时按索引做范围查找（SEARCH），并且直接按索引顺序读出，不再排序
+        for args in ('year_from=1990&year_to=2000', 'year_from=1990', 'sort=year&year_from=1990&year_to=2000',
+                     'sort=title&year_from=1990&year_to=1990', 'sort=id&year_to=2000'):
+            result = plan(args)
+            self.assertIn('SEARCH', result, args)
+            self.assertNotIn('TEMP B-TREE', result, args)
+        # 没有筛选时沿索引顺序读取
+        for args in ('sort=year', 'sort=title'):
+            result = plan(args)
+            self.assertIn('SCAN movie USING INDEX', result, args)
+            self.assertNotIn('TEMP B-TREE', result, args)
+
+        # 按标题排序、年份范围很窄：范围查找，只排序范围里的行
+        self.assertIn('SEARCH movie USING INDEX ix_movie_year', plan('sort=title&year_from=1990&year_to=2000'))
+        # 范围覆盖了大部分电影：沿标题索引读取，很快取满一页
+        db.session.add_all([Movie(title='Movie %d' % i, year=1995) for i in range(30)])
+        db.session.commit()
+        result = plan('sort=title&year_from=1990&year_to=2000')
+        self.assertIn('SCAN movie USING INDEX ix_movie_title_year', result)
+        self.assertNotIn('TEMP B-TREE', result)
+
+    # 测试登录用户的主页流式渲染
+    def test_index_streamed(self):
+        self.client.post('/login', data=dict(username='test', password='123'))
+        response = self.client.get('/', buffered=False)
+        self.assertNotIn('Content-Length', response.headers)    # 边渲染边发送，事先不知道长度
+        data = response.get_data(as_text=True)
+        response.close()
+        self.assertIn('Login success.', data)    # 提示消息在开始发送前就取出了
+        self.assertIn('1 Titles', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('</html>', data)
+        self.assertNotIn('Login success.', self.client.get('/').get_data(as_text=True))    # 只显示一次
+
+        app.config['STREAM_TEMPLATES'] = False
+        try:
+            self.assertIn('Content-Length', self.client.get('/').headers)
+        finally:
+            app.config['STREAM_TEMPLATES'] = True
+
+    # 测试响应压缩
+    def test_compression(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode('utf-8'))
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)    # 304 和 200 带相同的 ETag
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # 不接受压缩、太小、类型不在列表里或已经压缩过的响应原样返回
+        self.assertNotIn('Content-Encoding', self.client.get('/').headers)
+        response = self.client.get('/api/movies', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)    # 小于 COMPRESS_MIN_SIZE
+        response = self.client.get('/export.csv?gzip=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode('utf-8'))
+
+        # 流式响应逐块压缩
+        self.client.post('/login', data=dict(username='test', password='123'))
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertIn('Test Movie Title', gzip.decompress(response.get_data()).decode('utf-8'))
+        response.close()
+
+    # 测试站点主人缓存
+    def test_owner_cache(self):
+        response = self.client.get('/')
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+
+        # 绕过缓存直接修改数据库，缓存的名字保持不变
+        User.query.first().name = 'Changed'
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+
+        # 另一个 worker 提交修改时会增加版本号，本进程随即重新加载
+        bump_version('user')
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertIn('Changed\'s Watchlist', response.get_data(as_text=True))
+
+        # 错误页面同样使用缓存的名字
+        response = self.client.get('/nothing')
+        self.assertIn('Changed\'s Watchlist', response.get_data(as_text=True))
+
+    # 记录执行的 SQL 语句，用于检查缓存是否生效
+    def capture_sql(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    # 测试登录用户缓存
+    def test_user_loader_cache(self):
+        self.login()
+        self.client.get('/settings')    # 第一次请求加载并缓存用户
+
+        statements = self.capture_sql()
+        response = self.client.get('/settings')
+        self.assertIn('Your Name', response.get_data(as_text=True))
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+
+        # 修改密码会让缓存失效
+        User.query.first().set_password('456')
+        db.session.commit()
+        del statements[:]
+        self.client.get('/settings')
+        self.assertTrue([s for s in statements if 'FROM user' in s])
+
+        # 关闭缓存后每个请求都查询数据库
+        app.config['USER_CACHE_ENABLED'] = False
+        try:
+            del statements[:]
+            self.client.get('/settings')
+            self.assertTrue([s for s in statements if 'FROM user' in s])
+        finally:
+            app.config['USER_CACHE_ENABLED'] = True
+
+    # 测试匿名访客的整页缓存
+    def test_page_cache(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(page_cache.misses, 1)
+
+        statements = self.capture_sql()
+        response = self.client.get('/')
+        self.assertEqual(page_cache.hits, 1)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn('Test Movie Title', response.get_data(as_text=True))
+        self.assertFalse([s for s in statements if 'FROM movie' in s])    # 命中缓存时不查询电影
+
+        # 条件请求
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        # 创建条目后缓存失效
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2019'))
+        self.client.get('/logout', follow_redirects=True)    # 带 flash 消息的页面不会被缓存
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+
+    # 测试导出
+    def test_export(self):
+        response = self.client.get('/export.csv')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertEqual(data.splitlines()[0], 'id,title,year,updated_at')
+        self.assertIn('1,Test Movie Title,2019,', data)
+
+        response = self.client.get('/export.jsonl?gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(response.get_data()).splitlines()]
+        self.assertEqual(rows[0]['title'], 'Test Movie Title')
+
+        # 只导出指定时间之后修改的条目
+        response = self.client.get('/export.jsonl?since=2999-01-01T00:00:00')
+        self.assertEqual(response.get_data(), b'')
+        response = self.client.get('/export.jsonl?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    # 测试标题搜索
+    def test_search(self):
+        db.session.add_all([Movie(title='My Neighbor Totoro', year='1988'),
+                            Movie(title='Totoro Returns', year='2020'),
+                            Movie(title='Leon', year='1994')])
+        db.session.commit()
+
+        response = self.client.get('/search?q=totor')    # 前缀匹配
+        data = response.get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertIn('Totoro Returns', data)
+        self.assertNotIn('Leon', data)
+
+        response = self.client.get('/search?q=neighbor+tot')    # 所有单词都要匹配
+        data = response.get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Totoro Returns', data)
+
+        # 触发器同步修改和删除
+        self.login()
+        self.client.post('/movie/edit/4', data=dict(title='Leon The Professional', year='1994'))
+        self.client.post('/movie/delete/3')
+        data = self.client.get('/search?q=professional').get_data(as_text=True)
+        self.assertIn('Leon The Professional', data)
+        data = self.client.get('/search?q=totoro').get_data(as_text=True)
+        self.assertNotIn('Totoro Returns', data)
+
+        # 分页
+        data = self.client.get('/search?q=totoro&per_page=1').get_data(as_text=True)
+        self.assertNotIn('page=2', data)
+        data = self.client.get('/search?q=t&per_page=1').get_data(as_text=True)
+        self.assertIn('page=2', data)
+
+    # 测试搜索语法转义
+    def test_search_query_escaping(self):
+        self.assertEqual(build_match_query('Leon'), '"Leon"*')
+        self.assertEqual(build_match_query('"WALL-E" OR ('), '"WALL"* "E"* "OR"*')
+        self.assertEqual(build_match_query(''), '')
+        response = self.client.get('/search?q=%22%28')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/search?q=leon&page=%d' % 2 ** 63)
+        self.assertEqual(response.status_code, 400)
+
+    # 测试请求指标
+    def test_metrics(self):
+        reset_metrics()
+        self.client.get('/')
+        self.client.get('/')
+        self.assertEqual(request_latency.count('index'), 2)
+        self.assertEqual(request_queries.count('index'), 2)
+        self.assertEqual(template_render_time.count('index.html'), 1)    # 第二次命中页面缓存，没有渲染
+
+        response = self.client.get('/metrics')
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('watchlist_request_duration_seconds_count{endpoint="index"} 2', data)
+        self.assertIn('watchlist_request_sql_queries_bucket{endpoint="index",le="+Inf"} 2', data)
+        self.assertIn('watchlist_template_render_duration_seconds_count{template="index.html"} 1', data)
+        self.assertIn('watchlist_page_cache_hits_total 1', data)
+
+    # 测试慢请求日志
+    def test_slow_request_log(self):
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0.000001
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.client.get('/')
+        finally:
+            app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        self.assertIn('Slow request: GET /?', logs.output[0])
+        self.assertIn('FROM movie', logs.output[0])
+
+    # 测试 API 列表
+    def test_api_movies(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year='2000') for i in range(2, 4)])
+        db.session.commit()
+        data = self.client.get('/api/movies?per_page=2').get_json()
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Test Movie Title', 'Movie 2'])
+        self.assertEqual(data['next'], 2)
+        self.assertIsNone(data['prev'])
+        data = self.client.get('/api/movies?per_page=2&after=2').get_json()
+        self.assertEqual([movie['id'] for movie in data['movies']], [3])
+        self.assertIsNone(data['next'])
+
+    # 辅助方法，生成带令牌的请求头
+    def api_headers(self):
+        from watchlist.api import generate_token
+        return {'Authorization': 'Bearer ' + generate_token(User.query.first())}
+
+    # 测试批量修改
+    def test_api_batch(self):
+        operations = [
+            {'op': 'create', 'title': 'New Movie', 'year': 2019},
+            {'op': 'update', 'id': 1, 'title': 'Test Movie Edited'},
+            {'op': 'create', 'title': '', 'year': '2019'},
+            {'op': 'delete', 'id': 99},
+            {'op': 'rename'},
+        ]
+        response = self.client.post('/api/movies/batch', json={'operations': operations}, headers=self.api_headers())
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual(results[0], {'status': 'created', 'id': 2})
+        self.assertEqual(results[1], {'status': 'updated', 'id': 1})
+        self.assertEqual(results[2], {'status': 'error', 'error': 'Invalid input.'})
+        self.assertEqual(results[3], {'status': 'error', 'error': 'Not found.'})
+        self.assertEqual(results[4], {'status': 'error', 'error': 'Unknown op.'})
+        self.assertEqual(Movie.query.get(1).title, 'Test Movie Edited')
+        self.assertEqual(Movie.query.get(2).year, 2019)
+
+        response = self.client.post('/api/movies/batch', json={'operations': [{'op': 'delete', 'id': 2}]},
+                                    headers=self.api_headers())
+        self.assertEqual(response.get_json()['results'], [{'status': 'deleted', 'id': 2}])
+        self.assertIsNone(Movie.query.get(2))
+
+    # 测试原子批量：有一条失败就全部回滚
+    def test_api_batch_atomic(self):
+        operations = [{'op': 'create', 'title': 'New Movie', 'year': '2019'}, {'op': 'delete', 'id': 99}]
+        response = self.client.post('/api/movies/batch', json={'operations': operations, 'atomic': True},
+                                    headers=self.api_headers())
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['results'][0], {'status': 'skipped'})
+        self.assertEqual(Movie.query.count(), 1)
+
+    # 测试 API 认证
+    def test_api_auth(self):
+        response = self.client.post('/api/movies/batch', json={'operations': []})
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/movies/batch', json={'operations': []},
+                                    headers={'Authorization': 'Bearer forged'})
+        self.assertEqual(response.status_code, 401)
+
+        # 令牌里不带密码散列的片段
+        from watchlist.api import _serializer
+        user = User.query.first()
+        data = _serializer().loads(self.api_headers()['Authorization'].split()[1])
+        self.assertEqual(len(data['pw']), 16)
+        self.assertNotIn(data['pw'], user.password_hash)
+
+        # 修改密码后旧令牌失效
+        headers = self.api_headers()
+        User.query.first().set_password('456')
+        db.session.commit()
+        response = self.client.post('/api/movies/batch', json={'operations': []}, headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+        # 登录后可以不带令牌
+        self.client.post('/login', data=dict(username='test', password='456'))
+        response = self.client.post('/api/movies/batch', json={'operations': []})
+        self.assertEqual(response.status_code, 200)
+
     # 测试辅助方法-----------------------------------------------------
     
     # 这些操作对应的请求都需要登录账户后才能发送，我们先编写一个用于登录账户的辅助方法
@@ -116,6 +566,15 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         self.assertNotIn('Item created.', data)
         self.assertIn('Invalid input.', data)
 
+        # 测试创建条目操作，但电影年份末尾带换行
+        response = self.client.post('/', data=dict(
+            title='New Movie',
+            year='2019\n'
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Item created.', data)
+        self.assertIn('Invalid input.', data)
+
     # 测试更新条目
     def test_update_item(self):
         self.login()
@@ -164,6 +623,47 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         self.assertIn('Item deleted.', data)
         self.assertNotIn('Test Movie Title', data)
 
+    # 测试表单、API 在同一个事务里更新统计
+    def test_stats_maintained(self):
+        self.login()
+        self.client.post('/', data=dict(title='Leon', year='1994'))
+        self.client.post('/', data=dict(title='Mahjong', year='1996'))
+        self.client.post('/movie/edit/2', data=dict(title='Leon', year='1999'))    # 同一个年代里改年份
+        self.client.post('/movie/edit/3', data=dict(title='Mahjong', year='2008'))    # 换了年代
+        self.client.post('/movie/delete/1')
+        self.client.post('/api/movies/batch', json={'operations': [
+            {'op': 'create', 'title': 'WALL-E', 'year': 2008},
+            {'op': 'update', 'id': 2, 'year': 1988},
+            {'op': 'delete', 'id': 3},
+        ]})
+        self.assertEqual(check_stats(), [])
+        self.assertEqual(get_stats(), {
+            'total': 2,
+            'decades': [{'decade': 1980, 'count': 1}, {'decade': 2000, 'count': 1}],
+            'years': [{'year': 1988, 'count': 1}, {'year': 2008, 'count': 1}],
+        })
+        data = self.client.get('/?year_from=2000&year_to=2009').get_data(as_text=True)
+        self.assertIn('1 Titles', data)
+
+    # 测试统计页只读统计表
+    def test_stats_page(self):
+        db.session.add_all([Movie(title='Leon', year='1994'), Movie(title='Mahjong', year='1996')])
+        db.session.commit()
+        statements = self.capture_sql()
+        data = self.client.get('/stats').get_data(as_text=True)
+        self.assertIn('3 Titles', data)
+        self.assertIn('1990s', data)
+        self.assertIn('2019', data)
+        self.assertFalse([s for s in statements if re.search(r'\bmovie\b', s)])    # 不查询 movie 表
+        self.assertEqual(len([s for s in statements if 'movie_stat' in s]), 1)
+
+        response = self.client.get('/api/stats')
+        self.assertEqual(response.get_json(), {
+            'total': 3,
+            'decades': [{'decade': 1990, 'count': 2}, {'decade': 2010, 'count': 1}],
+            'years': [{'year': 1994, 'count': 1}, {'year': 1996, 'count': 1}, {'year': 2019, 'count': 1}],
+        })
+
     # 在这几个测试方法中，大部分的断言都是在判断响应主体是否包含正确的提示消息和电影条目信息。
 
     # 测试认证相关功能 ---------------------------------------------------
@@ -230,6 +730,68 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         self.assertIn('Invalid input.', data)
 
 
+    # 测试登录限流
+    def test_login_rate_limit(self):
+        app.config['LOGIN_BURST'] = 3
+        try:
+            for i in range(3):
+                response = self.client.post('/login', data=dict(username='test', password='456'))
+                self.assertEqual(response.status_code, 302)
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Too Many Requests - 429', response.get_data(as_text=True))
+
+            # 其他页面不受影响
+            self.assertEqual(self.client.get('/').status_code, 200)
+        finally:
+            app.config['LOGIN_BURST'] = 10
+
+    # 测试密码校验排队已满时立即返回 429
+    def test_login_queue_full(self):
+        from watchlist.security import password_verifier
+        password_verifier.shutdown()
+        app.config.update(LOGIN_EXECUTOR='thread', LOGIN_QUEUE_LIMIT=1)
+        try:
+            executor, slots = password_verifier._get_executor()
+            slots.acquire()    # 模拟已有一个校验在进行
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)
+            slots.release()
+            response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+            self.assertIn('Login success.', response.get_data(as_text=True))
+        finally:
+            password_verifier.shutdown()
+            app.config.update(LOGIN_EXECUTOR='process', LOGIN_QUEUE_LIMIT=8)
+
+    # 测试校验超时：返回 429，超时的校验在结束之前仍然占着名额
+    def test_login_timeout(self):
+        from watchlist.security import password_verifier
+        password_verifier.shutdown()
+        app.config.update(LOGIN_EXECUTOR='thread', LOGIN_WORKERS=1, LOGIN_QUEUE_LIMIT=2, LOGIN_TIMEOUT=0.05)
+        release = threading.Event()
+        try:
+            executor, slots = password_verifier._get_executor()
+            slots.acquire()
+            busy = executor.submit(release.wait)    # 唯一的工作线程被占住
+            busy.add_done_callback(lambda f: slots.release())
+
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)    # 超时，不是 500
+            # 超时的校验已经取消，名额随之归还；被占住的那个名额要等它结束
+            self.assertTrue(slots.acquire(blocking=False))
+            self.assertFalse(slots.acquire(blocking=False))
+            slots.release()
+
+            release.set()
+            busy.result()
+            app.config['LOGIN_TIMEOUT'] = 10
+            response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+            self.assertIn('Login success.', response.get_data(as_text=True))
+        finally:
+            release.set()
+            password_verifier.shutdown()
+            app.config.update(LOGIN_EXECUTOR='process', LOGIN_WORKERS=2, LOGIN_QUEUE_LIMIT=8, LOGIN_TIMEOUT=10)
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -280,11 +842,32 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
 
     # 测试虚拟数据
     def test_forge_command(self):
+        version = current_version('movie')
         result = self.runner.invoke(forge)    # 执行自定义 forge命令——给数据库填满初始化虚拟数据。
         self.assertIn('Done.', result.output)
         self.assertNotEqual(Movie.query.count(), 0)
+        self.assertNotEqual(current_version('movie'), version)    # 缓存的主页、统计页失效
 
     # 测试初始化数据库
+    # 测试生成大量随机数据
+    def test_forge_command_count(self):
+        result = self.runner.invoke(args=['forge', '--count', '250', '--seed', '7', '--batch-size', '100'])
+        self.assertIn('Forged 250 movies', result.output)
+        self.assertEqual(Movie.query.count(), 251)    # 加上 setUp 里的一条
+        self.assertEqual(User.query.count(), 1)    # 已有用户时不再添加
+        titles = [movie.title for movie in Movie.query.order_by(Movie.id).offset(1)]
+        self.assertTrue(all(0 < len(title) <= 60 for title in titles))
+        self.assertTrue(all(1900 <= movie.year <= 2024 for movie in Movie.query.offset(1)))
+        indexes = {row[1] for row in db.session.execute(text('PRAGMA index_list(movie)'))}
+        self.assertIn('ix_movie_title_year', indexes)    # 导入时删掉的索引已经重建
+        self.assertEqual(check_stats(), [])
+        self.assertEqual(get_stats()['total'], 251)
+
+        # 同一个种子生成相同的数据
+        self.runner.invoke(args=['forge', '--count', '250', '--seed', '7'])
+        again = [movie.title for movie in Movie.query.order_by(Movie.id).offset(251)]
+        self.assertEqual(again, titles)
+
     def test_initdb_command(self):
         result = self.runner.invoke(initdb)    # 执行自定义 initdb命令
         self.assertIn('Initialized database.', result.output)
@@ -310,7 +893,717 @@ class WatchlistTestCase(unittest.TestCase):    #测试用例
         self.assertEqual(User.query.first().username, 'peter')
         self.assertTrue(User.query.first().validate_password('456'))
 
+    # 写一个临时文件，测试结束后删除
+    def make_file(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    # 测试批量导入 CSV
+    def test_import_command_csv(self):
+        path = self.make_file('.csv', 'title,year\nLeon,1994\n,1999\nWALL-E,2008\nToo Long Year,20081\n')
+        result = self.runner.invoke(args=['import', path, '--batch-size', '1'])
+        self.assertIn('Imported 2 movies', result.output)
+        self.assertIn('2 invalid', result.output)
+        self.assertIn('Done.', result.output)
+        self.assertEqual(Movie.query.count(), 3)
+        self.assertEqual(Movie.query.filter_by(title='WALL-E').first().year, 2008)
+        self.assertIn('WALL-E', self.client.get('/search?q=wall').get_data(as_text=True))    # 导入的条目加入了搜索索引
+        self.assertEqual(check_stats(), [])    # 导入的条目计入了统计
+
+        result = self.runner.invoke(args=['import', path, '--batch-size', '0'])
+        self.assertEqual(result.exit_code, 2)    # 参数错误，不会导入
+        self.assertEqual(Movie.query.count(), 3)
+
+    # 测试批量导入 JSON-lines 并去重
+    def test_import_command_jsonl_dedupe(self):
+        path = self.make_file('.jsonl', '{"title": "Test Movie Title", "year": "2019"}\n'
+                                        '{"title": "Leon", "year": 1994}\n'
+                                        '{"title": "Leon", "year": "1994"}\n'
+                                        'not json\n')
+        result = self.runner.invoke(args=['import', path, '--dedupe'])
+        self.assertIn('Imported 1 movies', result.output)
+        self.assertIn('1 invalid, 2 duplicates skipped', result.output)
+        self.assertEqual(Movie.query.count(), 2)
+        self.assertEqual(check_stats(), [])    # 跳过的重复条目不计数
+
+    # 测试导出命令
+    def test_export_command(self):
+        db.session.add(Movie(title='Leon', year='1994'))
+        db.session.commit()
+        result = self.runner.invoke(args=['export', '--format', 'jsonl'])
+        rows = [json.loads(line) for line in result.output.splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['Test Movie Title', 'Leon'])
+
+        fd, path = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.runner.invoke(args=['export', path, '--since', '2000-01-01'])
+        with gzip.open(path, 'rt') as f:
+            self.assertIn('Leon', f.read())
+
+    # 测试重建搜索索引
+    def test_rebuild_search_command(self):
+        result = self.runner.invoke(args=['rebuild-search'])
+        self.assertIn('Done.', result.output)
+        data = self.client.get('/search?q=test').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+
+    # 测试检查、重建统计
+    def test_stats_commands(self):
+        result = self.runner.invoke(args=['check-stats'])
+        self.assertIn('Stats are consistent.', result.output)
+
+        db.session.execute(text("UPDATE movie_stat SET count = 5 WHERE scope = 'year'"))
+        db.session.execute(text("DELETE FROM movie_stat WHERE scope = 'total'"))
+        db.session.commit()
+        result = self.runner.invoke(args=['check-stats'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('year 2019: expected 1, found 5', result.output)
+        self.assertIn('total 0: expected 1, found None', result.output)
+
+        result = self.runner.invoke(args=['rebuild-stats'])
+        self.assertIn('Done.', result.output)
+        self.assertEqual(check_stats(), [])
+        self.assertIn('1 Titles', self.client.get('/').get_data(as_text=True))
+
+    # 测试生成 API 令牌
+    def test_token_command(self):
+        result = self.runner.invoke(args=['token'])
+        token = result.output.strip()
+        response = self.client.post('/api/movies/batch', json={'operations': []},
+                                    headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 200)
+
+    # 测试把旧版本（year 为字符串）的 movie 表升级为当前结构
+    def test_migrate_command(self):
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))'))
+            connection.execute(text("INSERT INTO movie (title, year) VALUES ('Leon', '1994'), ('Mahjong', '1996')"))
+        result = self.runner.invoke(args=['migrate'])
+        self.assertIn('Rebuilt the movie table.', result.output)
+        movie = Movie.query.filter_by(title='Leon').one()
+        self.assertEqual(movie.year, 1994)
+        self.assertIsNotNone(movie.updated_at)
+        indexes = {row[1] for row in db.session.execute(text('PRAGMA index_list(movie)'))}
+        self.assertIn('ix_movie_year_title', indexes)
+        self.assertIn('Mahjong', self.client.get('/search?q=mahj').get_data(as_text=True))
+        self.assertEqual(check_stats(), [])
+
+        result = self.runner.invoke(args=['migrate'])
+        self.assertIn('Schema is up to date.', result.output)
+
+    # 测试只缺少可以为空的列时原地添加，不重建表
+    def test_migrate_command_adds_columns(self):
+        db.session.execute(text('DROP TABLE movie_fts'))
+        db.session.execute(text('CREATE TABLE movie_new (id INTEGER PRIMARY KEY, title VARCHAR(60), '
+                                'year INTEGER, updated_at DATETIME)'))
+        db.session.execute(text('INSERT INTO movie_new SELECT id, title, year, updated_at FROM movie'))
+        db.session.execute(text('DROP TABLE movie'))
+        db.session.execute(text('ALTER TABLE movie_new RENAME TO movie'))
+        db.session.commit()
+        result = self.runner.invoke(args=['migrate'])
+        self.assertIn('Schema is up to date.', result.output)
+        columns = {row[1] for row in db.session.execute(text('PRAGMA table_info(movie)'))}
+        self.assertTrue({'imdb_id', 'poster', 'runtime'} <= columns)
+        self.assertEqual(Movie.query.get(1).title, 'Test Movie Title')
+
+    # 测试年份不是数字时拒绝升级
+    def test_migrate_command_invalid_year(self):
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))'))
+            connection.execute(text("INSERT INTO movie (title, year) VALUES ('Leon', '1994'), ('Bad', '19x4')"))
+        result = self.runner.invoke(args=['migrate'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('invalid year', result.output)
+        self.assertEqual(db.session.execute(text('SELECT year FROM movie WHERE id = 1')).scalar(), '1994')
+
+    # 测试静态文件指纹和预压缩
+    def test_build_assets_command(self):
+        build_dir = tempfile.mkdtemp()
+        app.config['ASSETS_BUILD_DIR'] = build_dir
+        try:
+            result = self.runner.invoke(args=['build-assets'])
+            self.assertIn('Done.', result.output)
+            with open(os.path.join(build_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+            css = manifest['style.css']['path']
+            self.assertRegex(css, r'^style\.[0-9a-f]{12}\.css$')
+            self.assertIn('gzip', manifest['style.css']['encodings'])
+            self.assertEqual(manifest['images/avatar.png']['encodings'], [])    # PNG 本身已经压缩过
+
+            data = self.client.get('/').get_data(as_text=True)
+            self.assertIn('/assets/' + css, data)
+            self.assertNotIn('/static/style.css', data)
+
+            response = self.client.get('/assets/' + css, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(response.mimetype, 'text/css')
+            with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+                self.assertEqual(gzip.decompress(response.get_data()), f.read())
+            response.close()
+
+            response = self.client.get('/assets/' + css, headers={'Accept-Encoding': 'identity'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            response.close()
+
+            self.assertEqual(self.client.get('/assets/../manifest.json').status_code, 404)
+        finally:
+            app.config['ASSETS_BUILD_DIR'] = os.path.join(os.path.dirname(app.root_path), 'build', 'assets')
+            assets.reload_manifest()
+
+    # 测试图片缩略图
+    def test_build_images_command(self):
+        cache_dir = tempfile.mkdtemp()
+        app.config['IMAGES_CACHE_DIR'] = cache_dir
+        try:
+            data = self.client.get('/').get_data(as_text=True)
+            self.assertIn('<picture>', data)
+            self.assertIn('type="image/webp"', data)
+            self.assertIn('loading="lazy"', data)    # 页面下方的龙猫延迟加载
+            self.assertNotIn('images/avatar.png"', data)    # 不再直接引用原图
+
+            # 第一次请求时生成并写入磁盘
+            source = images.get_source('images/avatar.png')
+            with app.test_request_context():
+                url = images.derivative_url(source, 80, 'webp')
+                bad_width_url = images.derivative_url(source, 123, 'webp')
+            self.assertIn(url, data)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/webp')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertLess(len(response.get_data()), os.path.getsize(source.path))
+            response.close()
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, images.derivative_name(source, 80, 'webp'))))
+
+            # 模板用不到的尺寸和过期的散列都返回 404
+            self.assertEqual(self.client.get(bad_width_url).status_code, 404)
+            self.assertEqual(self.client.get(url.replace(source.digest, '0' * 12)).status_code, 404)
+
+            result = self.runner.invoke(args=['build-images'])
+            self.assertIn('Done.', result.output)
+            self.assertIn('totoro.gif.webp', result.output)
+        finally:
+            app.config['IMAGES_CACHE_DIR'] = os.path.join(os.path.dirname(app.root_path), 'build', 'images')
+
+    # 测试模板预热和字节码缓存
+    def test_warmup_command(self):
+        cache_dir = tempfile.mkdtemp()
+        saved = app.config['JINJA_BYTECODE_CACHE_DIR'], app.jinja_env.bytecode_cache
+        app.config['JINJA_BYTECODE_CACHE_DIR'] = cache_dir
+        warmup.configure_bytecode_cache()
+        app.jinja_env.cache.clear()    # 清空已编译的模板，让 warmup 重新编译
+        try:
+            result = self.runner.invoke(args=['warmup'])
+            self.assertIn('Done.', result.output)
+            count = len(app.jinja_env.list_templates())
+            self.assertIn('Compiled %d templates' % count, result.output)
+            self.assertEqual(len(os.listdir(cache_dir)), count)    # 每个模板一个字节码文件
+        finally:
+            app.config['JINJA_BYTECODE_CACHE_DIR'], app.jinja_env.bytecode_cache = saved
+
+    # 测试字节码缓存目录无法创建时只是不用缓存，导入应用不会失败
+    def test_bytecode_cache_dir_not_writable(self):
+        saved = app.config['JINJA_BYTECODE_CACHE_DIR'], app.jinja_env.bytecode_cache
+        with tempfile.NamedTemporaryFile() as f:
+            app.config['JINJA_BYTECODE_CACHE_DIR'] = os.path.join(f.name, 'jinja')    # 父路径是文件
+            try:
+                with self.assertLogs(app.logger, 'WARNING'):
+                    warmup.configure_bytecode_cache()
+                self.assertIsNone(app.jinja_env.bytecode_cache)
+            finally:
+                app.config['JINJA_BYTECODE_CACHE_DIR'], app.jinja_env.bytecode_cache = saved
+
 # 在这几个测试中，大部分的断言是在检查执行命令后的数据库数据是否发生了正确的变化，或是判断命令行输出（result.output）是否包含预期的字符。
 
+
+# ---
+# 测试电影元数据后台任务（使用本地启动的假元数据服务）
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'    # 保持连接，客户端会复用
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlsplit(self.path).query))
+        self.server.requests.append(query)
+        if self.server.failures:    # 先返回几次 503，测试重试
+            self.server.failures -= 1
+            status, data = 503, {'error': 'busy'}
+        else:
+            status, data = self.server.movies.get((query['title'], query['year']), (404, {'error': 'not found'}))
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EnrichmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MetadataHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.movies = {
+            ('Leon', '1994'): (200, {'imdb_id': 'tt0110413', 'poster': 'https://example.com/leon.jpg', 'runtime': 110}),
+            ('Broken', '2000'): (200, {'runtime': 'long'}),
+        }
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.saved = {key: app.config[key] for key in ('ENRICH_URL', 'ENRICH_BACKOFF', 'ENRICH_RETRIES',
+                                                       'ENRICH_MAX_ATTEMPTS')}
+        app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                          ENRICH_URL='http://127.0.0.1:%d/lookup?v=1' % self.server.server_port, ENRICH_BACKOFF=0)
+        db.create_all()
+        clear_caches()
+        db.session.add(User(name='Test', username='test'))
+        db.session.commit()
+        self.runner = app.test_cli_runner()
+
+    def tearDown(self):
+        app.config.update(self.saved)
+        db.session.remove()
+        db.drop_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_enrich_worker(self):
+        db.session.add_all([Movie(title='Leon', year=1994), Movie(title='Nobody Knows', year=2004)])
+        db.session.commit()
+        self.assertEqual(EnrichmentJob.query.count(), 2)    # 保存电影时只创建任务，不访问元数据服务
+        self.assertEqual(self.server.requests, [])
+
+        self.server.failures = 1
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertIn('Enriched 1 movies (1 not found, 0 failed, 0 from cache).', result.output)
+        self.assertEqual(len(self.server.requests), 3)    # 失败的那次重试了一次
+        self.assertEqual(self.server.requests[0]['v'], '1')    # 保留 ENRICH_URL 里原有的参数
+        movie = Movie.query.filter_by(title='Leon').one()
+        self.assertEqual((movie.imdb_id, movie.poster, movie.runtime),
+                         ('tt0110413', 'https://example.com/leon.jpg', 110))
+        self.assertEqual(EnrichmentJob.query.count(), 0)
+
+        data = app.test_client().get('/').get_data(as_text=True)
+        self.assertIn('https://www.imdb.com/title/tt0110413/', data)
+        self.assertIn('110 min', data)
+        self.assertIn('https://www.imdb.com/find?q=Nobody%20Knows', data)
+
+        # 同样的标题和年份直接使用缓存的响应
+        db.session.add(Movie(title='Leon', year=1994))
+        db.session.commit()
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertIn('Enriched 1 movies (0 not found, 0 failed, 1 from cache).', result.output)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # 没有元数据的电影可以重新排队，找不到的电影也用缓存
+        result = self.runner.invoke(args=['enrich-missing'])
+        self.assertIn('Queued 1 movies.', result.output)
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertIn('(1 not found, 0 failed, 1 from cache)', result.output)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_enrich_worker_failure(self):
+        app.config.update(ENRICH_RETRIES=1, ENRICH_MAX_ATTEMPTS=2)
+        self.server.failures = 100
+        db.session.add(Movie(title='Leon', year=1994))
+        db.session.commit()
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertIn('0 not found, 1 failed', result.output)
+        self.assertEqual(len(self.server.requests), 2)
+        job = EnrichmentJob.query.one()
+        self.assertEqual((job.status, job.attempts, job.last_error), ('pending', 1, 'HTTP 503'))
+
+        # 稍后重试，次数用完后标记为 failed
+        job.run_after = job.run_after.replace(year=2000)
+        db.session.commit()
+        self.runner.invoke(args=['enrich-worker', '--once'])
+        db.session.expire_all()
+        self.assertEqual(EnrichmentJob.query.one().status, 'failed')
+
+        # 修改电影后重新排队
+        movie = Movie.query.one()
+        movie.year = 1995
+        db.session.commit()
+        db.session.expire_all()
+        job = EnrichmentJob.query.one()
+        self.assertEqual((job.status, job.attempts), ('pending', 0))
+
+    def test_enrich_worker_invalid_response(self):
+        db.session.add(Movie(title='Broken', year=2000))
+        db.session.commit()
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertIn('1 failed', result.output)
+        self.assertEqual(EnrichmentJob.query.one().last_error, 'Invalid runtime.')
+        self.assertIsNone(Movie.query.one().runtime)
+
+    def test_enrichment_disabled(self):
+        app.config['ENRICH_URL'] = ''
+        db.session.add(Movie(title='Leon', year=1994))
+        db.session.commit()
+        self.assertEqual(EnrichmentJob.query.count(), 0)
+        result = self.runner.invoke(args=['enrich-worker', '--once'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('ENRICH_URL', result.output)
+
+
+# ---
+# 测试基准测试脚本本身（用很小的数据库跑几个场景）
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_run_benchmarks(self):
+        results = bench_watchlist.run_benchmarks([50], iterations=2, names={'index', 'api_movies', 'create'},
+                                                 data_dir=self.data_dir)
+        self.assertEqual(set(results['50']), {'index', 'api_movies', 'create'})
+        stats = results['50']['index']
+        self.assertLessEqual(stats['p50'], stats['p99'])
+        self.assertGreater(stats['queries'], 0)
+        self.assertGreater(stats['peak_memory'], 0)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], 'sqlite:///:memory:')    # 恢复了原来的配置
+        self.assertEqual(bench_watchlist.compare(results, results), [])
+
+    # 每个场景都能运行（覆盖所有路由和命令）
+    def test_run_all_scenarios(self):
+        results = bench_watchlist.run_benchmarks([50], iterations=1, data_dir=self.data_dir)
+        names = {name for name, func, limit, config in bench_watchlist.SCENARIOS}
+        if images.Image is None:
+            names -= bench_watchlist.PILLOW_SCENARIOS
+        self.assertEqual(set(results['50']), names)
+
+    def test_run_concurrent_writes(self):
+        results = bench_watchlist.run_concurrent_writes(threads=2, requests=4, data_dir=self.data_dir, size=50)
+        self.assertEqual(set(results), {'writes', 'writes_group_commit'})
+        self.assertEqual(results['writes_group_commit']['iterations'], 8)
+        self.assertGreater(results['writes']['writes_per_second'], 0)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], 'sqlite:///:memory:')
+
+    def test_compare(self):
+        base = {'1000': {'index': {'p95': 0.010, 'queries': 3, 'peak_memory': 1024 * 1024}}}
+        slower = {'1000': {'index': {'p95': 0.020, 'queries': 4, 'peak_memory': 1024 * 1024}}}
+        noise = {'1000': {'index': {'p95': 0.0105, 'queries': 3, 'peak_memory': 1100 * 1024}}}
+        regressions = bench_watchlist.compare(slower, base)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('p95 10.0ms -> 20.0ms', regressions[0])
+        self.assertEqual(bench_watchlist.compare(noise, base), [])
+
+
+# ---
+# 测试 SQLite 生产模式
+
+class ProductionDatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.uri = 'sqlite:///' + self.path
+        app.config.update(
+            TESTING=True,
+            DATABASE_MODE='production',
+            SQLALCHEMY_DATABASE_URI=self.uri,
+        )
+        db.create_all()
+        clear_caches()
+        user = User(name='Test', username='test')
+        user.set_password('123')
+        db.session.add_all([user, Movie(title='Test Movie Title', year='2019')])
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine().dispose()
+        dispose_read_engines()
+        app.config.update(DATABASE_MODE='default', SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    # 每个连接都设置了 WAL 等参数
+    def test_pragmas(self):
+        with db.get_engine().connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            self.assertEqual(connection.execute(text('PRAGMA busy_timeout')).scalar(), 5000)
+            self.assertEqual(connection.execute(text('PRAGMA synchronous')).scalar(), 1)    # NORMAL
+        with get_read_engine(app).connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA query_only')).scalar(), 1)
+
+    # 只读视图的查询走只读连接池
+    def test_read_only_views_use_read_pool(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = get_read_engine(app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get('/')
+            self.assertIn('Test Movie Title', response.get_data(as_text=True))
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertTrue([s for s in statements if 'FROM movie' in s])
+
+    # 写事务进行中，读请求不会被阻塞
+    def test_readers_proceed_while_writer_holds_transaction(self):
+        engine = configure_engine(create_engine(self.uri, **pool_options(app.config, 2)), app.config)
+        self.addCleanup(engine.dispose)
+        writer = engine.raw_connection()
+        try:
+            writer.isolation_level = None    # 手动控制事务
+            writer.execute('BEGIN EXCLUSIVE')    # 取得写锁；回滚日志模式下这会挡住所有读
+            writer.execute("INSERT INTO movie (title, year) VALUES ('Uncommitted', '2020')")
+
+            results = {}
+
+            def read():
+                response = app.test_client().get('/?per_page=50')
+                results['data'] = response.get_data(as_text=True)
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(timeout=2)    # 远小于 busy_timeout，读请求没有在等写锁
+            self.assertFalse(reader.is_alive())
+            self.assertIn('Test Movie Title', results['data'])
+            self.assertNotIn('Uncommitted', results['data'])    # 读到的是提交前的快照
+            writer.execute('COMMIT')
+        finally:
+            writer.close()
+
+        clear_caches()
+        self.assertIn('Uncommitted', self.client.get('/').get_data(as_text=True))
+
+    # 生产模式下表单写入正常
+    def test_write_in_production_mode(self):
+        self.client.post('/login', data=dict(username='test', password='123'))
+        response = self.client.post('/', data=dict(title='New Movie', year='2019'), follow_redirects=True)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+
+    # 测试批量导入时别的请求同时新建电影：新电影只加入一次搜索索引、只计数一次
+    # （FTS5 不报告重复的 rowid，只能检查新建电影是否等到了批量导入提交之后）
+    def test_bulk_insert_with_concurrent_write(self):
+        started = []
+
+        def create_movie():
+            with app.app_context():
+                db.session.add(Movie(title='Concurrent', year=2001))
+                db.session.commit()
+                db.session.remove()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if executemany and statement.startswith('INSERT INTO movie ') and not started:
+                # 在批量插入之前，让另一个线程新建一部电影；批量导入持有写锁时它要等到提交之后
+                thread = threading.Thread(target=create_movie)
+                thread.start()
+                thread.join(0.5)
+                started.append((thread, thread.is_alive()))
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+        rows = [(1, {'title': 'Imported', 'year': '2001'}), (2, {'title': 'Imported Too', 'year': '2002'})]
+        transfer.import_movies(iter(rows))
+        thread, blocked = started[0]
+        thread.join()
+        # 批量导入从读最大 id 开始就持有写锁，新建电影要等它提交，不会被 index_movies_after() 再索引一次
+        self.assertTrue(blocked)
+        self.assertEqual(Movie.query.count(), 4)
+        self.assertEqual(len(search_movies('concurrent')[0]), 1)
+        self.assertEqual(check_stats(), [])
+
+    # 测试合并提交：并发的表单写入由写线程合并提交，每个请求得到自己的结果
+    def test_group_commit(self):
+        app.config['GROUP_COMMIT'] = True
+        self.addCleanup(app.config.update, GROUP_COMMIT=False)
+        self.addCleanup(group_writer.shutdown)
+        self.client.post('/login', data=dict(username='test', password='123'))
+        statuses = []
+
+        def submit(index):
+            client = app.test_client()
+            client.post('/login', data=dict(username='test', password='123'))
+            for i in range(5):
+                statuses.append(client.post('/', data=dict(title='Movie %d-%d' % (index, i), year='2019')).status_code)
+
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses, [302] * 20)
+        self.assertEqual(Movie.query.count(), 21)
+        self.assertEqual(len(search_movies('movie', per_page=50)[0]), 21)    # 搜索索引在同一个事务里更新
+        self.assertEqual(check_stats(), [])    # 统计也是
+
+        response = self.client.post('/movie/edit/1', data=dict(title='Edited', year='2020'), follow_redirects=True)
+        self.assertIn('Item updated.', response.get_data(as_text=True))
+        self.assertEqual(self.client.post('/movie/delete/999').status_code, 404)    # 写线程里的 abort 交给请求
+        self.client.post('/movie/delete/2')
+        self.client.post('/settings', data=dict(name='Grouped'))
+        db.session.expire_all()
+        self.assertEqual(Movie.query.get(1).title, 'Edited')
+        self.assertIsNone(Movie.query.get(2))
+        self.assertIn('Grouped', self.client.get('/').get_data(as_text=True))
+
+    # 测试在线备份、轮换和恢复
+    def test_backup_and_restore(self):
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['backup', '--dir', backup_dir, '--keep', '2'])
+        self.assertIn('Done.', result.output)
+        first = list_snapshots(backup_dir)[0]
+        with open(first + '.sha256') as f:
+            checksum, name = f.read().split()
+        self.assertEqual(name, os.path.basename(first))
+        with open(first, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), checksum)
+
+        result = runner.invoke(args=['backup', '--dir', backup_dir, '--keep', '2'])
+        self.assertIn('Database unchanged', result.output)    # 相同的数据库得到相同的快照
+        for i in range(2):
+            db.session.add(Movie(title='Backup %d' % i, year=2000))
+            db.session.commit()
+            runner.invoke(args=['backup', '--dir', backup_dir, '--keep', '2'])
+        snapshots = list_snapshots(backup_dir)
+        self.assertEqual(len(snapshots), 2)    # 只保留最新的两个
+        self.assertNotIn(first, snapshots)
+
+        # 快照损坏时拒绝恢复，数据库不变
+        with open(snapshots[0], 'rb') as f:
+            data = f.read()
+        damaged = os.path.join(backup_dir, 'damaged.db.gz')
+        with open(damaged, 'wb') as f:
+            f.write(data[:-10])
+        shutil.copyfile(snapshots[0] + '.sha256', damaged + '.sha256')
+        result = runner.invoke(args=['restore', damaged, '--yes'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Checksum mismatch', result.output)
+
+        # 校验和正确但内容不是数据库
+        garbage = os.path.join(backup_dir, 'garbage.db.gz')
+        with open(garbage, 'wb') as f:
+            f.write(gzip.compress(b'not a database' * 1000))
+        with open(garbage, 'rb') as f, open(garbage + '.sha256', 'w') as out:
+            out.write(hashlib.sha256(f.read()).hexdigest() + '  garbage.db.gz\n')
+        result = runner.invoke(args=['restore', garbage, '--yes'])
+        self.assertIn('Integrity check failed', result.output)
+        self.assertEqual(Movie.query.count(), 3)
+
+        self.client.get('/')    # 让页面进入缓存
+        Movie.query.delete()
+        db.session.commit()
+        result = runner.invoke(args=['restore', snapshots[0], '--yes'])
+        self.assertIn('Restored', result.output)
+        self.assertEqual([movie.title for movie in Movie.query.order_by(Movie.id)], ['Test Movie Title', 'Backup 0'])
+        self.assertIn('Backup 0', self.client.get('/').get_data(as_text=True))
+        with db.get_engine().connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+
+    # 测试回滚日志模式下写入太频繁时放弃备份，而不是一步复制完、阻塞写入
+    def test_backup_gives_up_under_steady_writes(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        source_path = os.path.join(work_dir, 'source.db')
+        connection = sqlite3.connect(source_path)
+        connection.execute('CREATE TABLE t (x TEXT)')
+        connection.executemany('INSERT INTO t VALUES (?)', [('x' * 1000,)] * 200)
+        connection.commit()
+        connection.close()
+
+        stop = threading.Event()
+        writes = []
+
+        def write():
+            writer = sqlite3.connect(source_path, timeout=5)
+            while not stop.is_set():
+                writer.execute("INSERT INTO t VALUES ('y')")
+                writer.commit()
+                writes.append(time.perf_counter())
+                time.sleep(0.002)
+            writer.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            with self.assertRaises(BackupError):
+                copy_database(source_path, os.path.join(work_dir, 'copy.db'), pages=1, sleep=0.01)
+        finally:
+            stop.set()
+            thread.join()
+        gaps = [b - a for a, b in zip(writes, writes[1:])]
+        self.assertLess(max(gaps), 0.5)    # 写入从来没有等待整个复制过程
+
+        self.assertEqual(copy_database(source_path, os.path.join(work_dir, 'copy.db'), pages=1, sleep=0), 0)
+
+    # 测试 web 进程里的定时备份
+    def test_backup_scheduler(self):
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+        app.config.update(BACKUP_DIR=backup_dir, BACKUP_INTERVAL=3600)
+        self.addCleanup(app.config.update, BACKUP_DIR=app.config['BACKUP_DIR'], BACKUP_INTERVAL=0)
+        self.assertIsNotNone(backup_scheduler.run_pending(3600))
+        self.assertIsNone(backup_scheduler.run_pending(3600))    # 最新的快照还没过期
+        self.client.get('/')
+        self.assertTrue(backup_scheduler._thread.is_alive())    # 第一个请求时启动
+        backup_scheduler.stop()
+        self.assertEqual(len(list_snapshots(backup_dir)), 1)
+
+    # 测试 fork 出的 worker 调用 post_fork() 后使用自己的连接
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_post_fork(self):
+        self.assertEqual(self.client.get('/').status_code, 200)    # 父进程的连接池里已经有连接
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                post_fork()
+                response = app.test_client().get('/?per_page=5')
+                status = 0 if response.status_code == 200 and b'Test Movie Title' in response.data else 1
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.client.get('/').status_code, 200)    # 父进程的连接不受影响
+
+
+# 测试 web 进程不导入命令行模块
+class StartupTestCase(unittest.TestCase):
+
+    def run_python(self, code):
+        return subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().split()
+
+    def test_commands_are_loaded_lazily(self):
+        output = self.run_python('import sys, watchlist; print("watchlist.commands" in sys.modules); '
+                                 'print("forge" in watchlist.app.cli.list_commands(None)); '
+                                 'print("watchlist.commands" in sys.modules)')
+        self.assertEqual(output, ['False', 'True', 'True'])
+
+    def test_create_app(self):
+        output = self.run_python('from wsgi import app; import watchlist; print(app is watchlist.app); '
+                                 'print(sorted(watchlist.startup_times))')
+        self.assertEqual(output, ['True', "['import',", "'warmup']"])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,11 +1,16 @@
 import os
 import sys
+import time
+
+_import_started = time.perf_counter()    # 用来统计导入耗时（见 create_app）
 
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
+from watchlist.cli import LazyAppGroup
+from watchlist.database import WatchlistSQLAlchemy
+
 # ...
 
 WIN = sys.platform.startswith('win')
@@ -15,6 +20,7 @@ else:  # 否则使用四个斜线
     prefix = 'sqlite:////'
 
 app = Flask(__name__)
+app.cli = LazyAppGroup(['watchlist.commands'], name=app.name)    # 运行 flask 命令时才导入 commands（见 watchlist/cli.py）
 
 #app.config['SECRET_KEY'] = 'dev'  # 等同于 app.secret_key = 'dev'
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')   #读取系统环境变量 SECRET_KEY 的值，如果没有获取到，则使用 dev。
@@ -27,13 +33,101 @@ app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(ap
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False      # 关闭对模型修改的监控
 
+# 数据库模式：default 使用 SQLite 默认设置；production 开启 WAL 等设置，并使用读写分离的连接池（见 watchlist/database.py）
+app.config['DATABASE_MODE'] = os.getenv('DATABASE_MODE', 'default')
+app.config['DATABASE_POOL_SIZE'] = int(os.getenv('DATABASE_POOL_SIZE', 5))    # 写连接池大小
+app.config['DATABASE_READ_POOL_SIZE'] = int(os.getenv('DATABASE_READ_POOL_SIZE', 10))    # 只读连接池大小
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.getenv('DATABASE_MAX_OVERFLOW', 10))    # 连接池满时允许额外打开的连接数
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')    # WAL 模式下 NORMAL 不会损坏数据库，只可能丢失最近的事务
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))    # 毫秒
+app.config['SQLITE_CACHE_SIZE'] = int(os.getenv('SQLITE_CACHE_SIZE', -64000))    # 负数表示 KiB，即每个连接 64 MB 页缓存
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))    # 内存映射读取的字节数
+
+app.config['WATCHLIST_PER_PAGE'] = int(os.getenv('WATCHLIST_PER_PAGE', 20))    # 主页每页显示的电影条目数
+app.config['WATCHLIST_MAX_PER_PAGE'] = int(os.getenv('WATCHLIST_MAX_PER_PAGE', 100))    # ?per_page= 允许的最大值
+
+# 登录用户缓存：避免已登录用户的每个请求都查询一次 user 表
+app.config['USER_CACHE_ENABLED'] = os.getenv('USER_CACHE_ENABLED', '1') != '0'
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 128))    # 最多缓存的用户数
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 300))    # 缓存有效期（秒）
+
+# 匿名访客的整页缓存
+app.config['PAGE_CACHE_ENABLED'] = os.getenv('PAGE_CACHE_ENABLED', '1') != '0'
+app.config['PAGE_CACHE_SIZE'] = int(os.getenv('PAGE_CACHE_SIZE', 256))    # 最多缓存的页面数（不同的 URL 分别缓存）
+
+# 登录保护（见 watchlist/security.py）
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')    # 散列算法和迭代次数，迭代次数越多越慢
+app.config['LOGIN_EXECUTOR'] = os.getenv('LOGIN_EXECUTOR', 'process')    # 在哪里校验密码：process、thread 或 inline（请求线程）
+app.config['LOGIN_WORKERS'] = int(os.getenv('LOGIN_WORKERS', 2))    # 校验密码的进程数
+app.config['LOGIN_QUEUE_LIMIT'] = int(os.getenv('LOGIN_QUEUE_LIMIT', 8))    # 同时进行和排队的校验数上限，超过返回 429
+app.config['LOGIN_TIMEOUT'] = float(os.getenv('LOGIN_TIMEOUT', 10))    # 等待校验结果的秒数
+app.config['LOGIN_RATE'] = float(os.getenv('LOGIN_RATE', 0.2))    # 每个 IP / 用户名每秒恢复的尝试次数
+app.config['LOGIN_BURST'] = int(os.getenv('LOGIN_BURST', 10))    # 每个 IP / 用户名可以连续尝试的次数
+
+# 请求指标（见 watchlist/metrics.py）
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') != '0'
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.getenv('SLOW_REQUEST_THRESHOLD', 0))    # 超过这个秒数的请求连同 SQL 写入日志，0 表示关闭
+
+# JSON API（见 watchlist/api.py）
+app.config['API_TOKEN_MAX_AGE'] = int(os.getenv('API_TOKEN_MAX_AGE', 30 * 24 * 3600))    # API 令牌有效期（秒）
+app.config['API_MAX_BATCH'] = int(os.getenv('API_MAX_BATCH', 1000))    # 一次批量请求最多包含的操作数
+
+# 静态资源指纹和预压缩（见 watchlist/assets.py），用 flask build-assets 生成
+app.config['ASSETS_ENABLED'] = os.getenv('ASSETS_ENABLED', '1') != '0'
+app.config['ASSETS_BUILD_DIR'] = os.getenv('ASSETS_BUILD_DIR', os.path.join(os.path.dirname(app.root_path), 'build', 'assets'))
+app.config['ASSETS_MAX_AGE'] = int(os.getenv('ASSETS_MAX_AGE', 365 * 24 * 3600))    # 带散列的文件可以缓存一年
+
+# 图片缩略图（见 watchlist/images.py），第一次请求时生成，也可以用 flask build-images 提前生成
+app.config['IMAGES_CACHE_DIR'] = os.getenv('IMAGES_CACHE_DIR', os.path.join(os.path.dirname(app.root_path), 'build', 'images'))
+
+# 流式渲染和响应压缩（见 watchlist/streaming.py、watchlist/compression.py）
+app.config['STREAM_TEMPLATES'] = os.getenv('STREAM_TEMPLATES', '1') != '0'    # 列表页边渲染边发送
+app.config['STREAM_BUFFER_SIZE'] = int(os.getenv('STREAM_BUFFER_SIZE', 16))    # 攒够多少段模板输出发送一次
+app.config['COMPRESS_ENABLED'] = os.getenv('COMPRESS_ENABLED', '1') != '0'
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 500))    # 小于这个字节数的响应不压缩
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', 6))    # gzip 压缩级别
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))    # 动态内容用较低的级别，压缩快
+app.config['COMPRESS_MIMETYPES'] = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'application/json',
+    'application/x-ndjson', 'application/javascript', 'image/svg+xml',
+}
+
+# 模板字节码缓存和启动预热（见 watchlist/warmup.py），JINJA_BYTECODE_CACHE_DIR 为空时不使用字节码缓存
+app.config['JINJA_BYTECODE_CACHE_DIR'] = os.getenv('JINJA_BYTECODE_CACHE_DIR', os.path.join(os.path.dirname(app.root_path), 'build', 'jinja'))
+app.config['TEMPLATE_WARMUP'] = os.getenv('TEMPLATE_WARMUP', '0') != '0'    # 启动时编译所有模板
+
+# 电影元数据后台任务（见 watchlist/enrichment.py），ENRICH_URL 为空时关闭
+app.config['ENRICH_URL'] = os.getenv('ENRICH_URL', '')    # 元数据服务地址，例如 http://localhost:8000/lookup
+app.config['ENRICH_API_KEY'] = os.getenv('ENRICH_API_KEY', '')    # 以 Authorization: Bearer 发送
+app.config['ENRICH_CONCURRENCY'] = int(os.getenv('ENRICH_CONCURRENCY', 4))    # 同时进行的请求数（也是连接池大小）
+app.config['ENRICH_TIMEOUT'] = float(os.getenv('ENRICH_TIMEOUT', 10))    # 单个请求的超时（秒）
+app.config['ENRICH_RETRIES'] = int(os.getenv('ENRICH_RETRIES', 3))    # 429、5xx 和网络错误时立即重试的次数
+app.config['ENRICH_BACKOFF'] = float(os.getenv('ENRICH_BACKOFF', 0.5))    # 第一次重试前等待的秒数，之后每次翻倍
+app.config['ENRICH_MAX_ATTEMPTS'] = int(os.getenv('ENRICH_MAX_ATTEMPTS', 5))    # 任务失败这么多次后不再重试
+app.config['ENRICH_CACHE_TTL'] = int(os.getenv('ENRICH_CACHE_TTL', 30 * 24 * 3600))    # 响应缓存有效期（秒）
+
+# 合并提交（见 watchlist/groupcommit.py）：表单的写操作交给每个进程的写线程，合并成一个事务提交
+app.config['GROUP_COMMIT'] = os.getenv('GROUP_COMMIT', '0') != '0'
+app.config['GROUP_COMMIT_WINDOW'] = float(os.getenv('GROUP_COMMIT_WINDOW', 0.002))    # 收到第一个写操作后再等多少秒，收集同时到达的写操作
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 100))    # 一个事务最多包含的写操作数
+
+# 在线备份（见 watchlist/backup.py）
+app.config['BACKUP_DIR'] = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(app.root_path), 'backups'))
+app.config['BACKUP_KEEP'] = int(os.getenv('BACKUP_KEEP', 7))    # 保留的快照个数
+app.config['BACKUP_PAGES'] = int(os.getenv('BACKUP_PAGES', 256))    # 每一步复制的页数（默认每页 4 KB）
+app.config['BACKUP_SLEEP'] = float(os.getenv('BACKUP_SLEEP', 0.02))    # 两步之间休息的秒数，让写事务提交
+app.config['BACKUP_INTERVAL'] = int(os.getenv('BACKUP_INTERVAL', 0))    # 在 web 进程里每隔多少秒自动备份，0 表示关闭
+
 # 在扩展类实例化前加载配置
-db = SQLAlchemy(app)    #初始化扩展，传入程序实例app
+db = WatchlistSQLAlchemy(app)    #初始化扩展，传入程序实例app（在 Flask-SQLAlchemy 的基础上加入了生产模式）
 login_manager = LoginManager(app)    # 实例化扩展类
 
 # 通过主键查询用户
 @login_manager.user_loader
 def load_user(user_id):    # 创建用户加载回调函数，接受用户 ID 作为参数
+    if app.config['USER_CACHE_ENABLED']:
+        from watchlist.cache import load_cached_user
+        return load_cached_user(int(user_id))    # 优先读取进程内缓存，版本号变化或过期后才查询数据库
     from watchlist.models import User    #使用的模型类也在函数内进行导入,就是为了避免循环导入
     user = User.query.get(int(user_id))     # 用 ID 作为 User 模型的主键查询对应的用户
     return user
@@ -43,10 +137,61 @@ login_manager.login_view = 'login'
 # 模板上下文函数，可将返回的变量在html中直接使用
 @app.context_processor    #使用 app.context_processor 装饰器注册一个模板上下文处理函数
 def inject_user():    #这个函数返回的变量（以字典键值对的形式）将会统一注入到每一个模板的上下文环境中，因此可以直接在模板(html)中使用。
-    from watchlist.models import User
-    user = User.query.first()
+    from watchlist.cache import get_owner
+    #user = User.query.first()    # 每次渲染模板都查一次数据库【弃用】
+    user = get_owner()    # 改为读取进程内缓存，只有版本号变化时才重新查询
     return dict(user=user)    # 需要返回字典，等同于return {'user': user}
 
 #在构造文件中，为了让视图函数、错误处理函数和命令函数注册到程序实例上，我们需要在这里导入这几个模块。
 #但是因为这几个模块同时也要导入构造文件中的程序实例，为了避免循环依赖（A 导入 B，B 导入 A），我们把这一行导入语句放到构造文件的结尾。
-from watchlist import views, errors, commands    
\ No newline at end of file
+#命令函数（commands）只在运行 flask 命令时才导入，见上面的 LazyAppGroup
+from watchlist import warmup, views, errors, api, assets, images, compression, enrichment, backup, stats
+
+if app.config['TEMPLATE_WARMUP']:
+    warmup.warmup()
+
+startup_times = {'import': time.perf_counter() - _import_started}    # 秒，在 /metrics 中输出
+
+
+# 给 gunicorn 等预先 fork 的服务器使用的入口（见 wsgi.py、gunicorn.conf.py）
+# 开启 preload_app 时主进程先导入、预热一次，worker 通过 fork 共享这些内存（写时复制），启动也更快。
+# fork 之后每个 worker 都要调用 post_fork()，丢掉从主进程继承来的数据库连接和进程池。
+def create_app():
+    """Return the application, warmed up and ready to be forked."""
+    if not app.config['TEMPLATE_WARMUP']:
+        start = time.perf_counter()
+        warmup.warmup()
+        startup_times['warmup'] = time.perf_counter() - start
+    release_resources()    # 主进程不持有任何连接，fork 出来的 worker 是干净的
+    app.logger.info('Application loaded in %.0f ms (import %.0f ms).',
+                    sum(startup_times.values()) * 1000, startup_times['import'] * 1000)
+    return app
+
+
+def release_resources(after_fork=False):
+    """Drop the database pools and the background threads and executors.
+
+    After a fork the inherited connections and worker processes belong to
+    the parent, so they are only forgotten, not closed.
+    """
+    from watchlist.database import dispose_read_engines
+    from watchlist.security import password_verifier
+    from watchlist.groupcommit import group_writer
+    from watchlist.backup import backup_scheduler
+    if not after_fork:
+        group_writer.shutdown()    # 先停写线程，它持有一个数据库连接
+        backup_scheduler.stop()
+    with app.app_context():
+        db.get_engine().dispose(close=not after_fork)
+    dispose_read_engines(close=not after_fork)
+    if after_fork:
+        password_verifier.reset()
+        group_writer.reset()
+        backup_scheduler.reset()
+    else:
+        password_verifier.shutdown()
+
+
+def post_fork():
+    """Call in every worker right after it is forked."""
+    release_resources(after_fork=True)    # 用到时在 worker 里重新连接
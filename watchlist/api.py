@@ -0,0 +1,174 @@
+import hashlib
+import hmac
+from functools import wraps
+
+from flask import request, jsonify
+from flask_login import current_user
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from watchlist import app, db
+from watchlist.models import User, Movie
+from watchlist.cache import invalidate_movie_cache
+from watchlist.database import read_only
+from watchlist.pagination import keyset_paginate, get_per_page, get_cursor
+from watchlist.stats import get_stats
+from watchlist.transfer import clean_row
+
+# JSON API
+# GET  /api/movies        分页列出电影（与主页相同的主键游标）
+# GET  /api/stats         电影总数、每个年代和每一年的数量
+# POST /api/movies/batch  一次提交多条创建 / 修改 / 删除操作，在一个事务里执行，逐条返回结果
+# 写操作需要登录，或者在请求头里带上 Authorization: Bearer <token>（用 flask token 命令生成）。
+
+
+def _serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='api-token')
+
+
+def _password_fingerprint(user):
+    # 令牌里带上由密码散列算出的指纹，修改密码后旧令牌自动失效。
+    # 令牌的内容只签名、不加密，所以用 SECRET_KEY 做 HMAC，不能直接放密码散列的片段
+    key = app.config['SECRET_KEY']
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    message = (user.password_hash or '').encode('utf-8')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:16]
+
+
+def generate_token(user):
+    """Return an API token for ``user``."""
+    return _serializer().dumps({'id': user.id, 'pw': _password_fingerprint(user)})
+
+
+def load_token(token):
+    """Return the user the token was issued to, or None if it is invalid or expired."""
+    try:
+        data = _serializer().loads(token, max_age=app.config['API_TOKEN_MAX_AGE'])
+    except BadSignature:    # 过期（SignatureExpired）也是 BadSignature 的子类
+        return None
+    user = User.query.get(data.get('id'))
+    if user is None or data.get('pw') != _password_fingerprint(user):
+        return None
+    return user
+
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+
+def token_required(f):
+    """Allow the request if it carries a valid bearer token or a login session."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            if load_token(auth[len('Bearer '):].strip()) is None:
+                return api_error('Invalid token.', 401)
+        elif not current_user.is_authenticated:
+            return api_error('Authentication required.', 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def movie_to_dict(movie):
+    return {
+        'id': movie.id,
+        'title': movie.title,
+        'year': movie.year,
+        'imdb_id': movie.imdb_id,
+        'poster': movie.poster,
+        'runtime': movie.runtime,
+        'updated_at': movie.updated_at.isoformat() if movie.updated_at else None,
+    }
+
+
+@app.route('/api/movies')
+@read_only
+def api_movies():
+    columns = (Movie.id,)
+    page = keyset_paginate(Movie.query, columns,
+                           after=get_cursor('after', columns),
+                           before=get_cursor('before', columns),
+                           per_page=get_per_page())
+    return jsonify(movies=[movie_to_dict(movie) for movie in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor)
+
+
+@app.route('/api/stats')
+@read_only
+def api_stats():
+    return jsonify(get_stats())
+
+
+def _apply(operation, movies):
+    """Apply one batch operation to the session; return ``(movie, error)``."""
+    if not isinstance(operation, dict):
+        return None, 'Invalid operation.'
+    op = operation.get('op')
+
+    if op == 'create':
+        values = clean_row(operation)
+        if values is None:
+            return None, 'Invalid input.'
+        movie = Movie(**values)
+        db.session.add(movie)
+        return movie, None
+
+    if op not in ('update', 'delete'):
+        return None, 'Unknown op.'
+    movie = movies.get(operation.get('id'))
+    if movie is None:
+        return None, 'Not found.'
+
+    if op == 'delete':
+        db.session.delete(movie)
+        del movies[movie.id]
+        return movie, None
+
+    values = clean_row({'title': operation.get('title', movie.title),
+                        'year': operation.get('year', movie.year)})
+    if values is None:
+        return None, 'Invalid input.'
+    movie.title = values['title']
+    movie.year = values['year']
+    return movie, None
+
+
+@app.route('/api/movies/batch', methods=['POST'])
+@token_required
+def api_movies_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('operations'), list):
+        return api_error('Expected {"operations": [...]}.', 400)
+    operations = data['operations']
+    if len(operations) > app.config['API_MAX_BATCH']:
+        return api_error('Too many operations (max %d).' % app.config['API_MAX_BATCH'], 413)
+    atomic = bool(data.get('atomic'))
+
+    # 一次查询取出所有要修改、删除的条目
+    ids = [op.get('id') for op in operations if isinstance(op, dict) and isinstance(op.get('id'), int)]
+    movies = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(ids))} if ids else {}
+
+    applied = []    # (index, op, movie)
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        movie, error = _apply(operation, movies)
+        if error is not None:
+            results[index] = {'status': 'error', 'error': error}
+        else:
+            applied.append((index, operation['op'], movie))
+    errors = len(applied) != len(operations)
+
+    if atomic and errors:
+        db.session.rollback()    # 有一条失败就全部放弃
+        for index, op, movie in applied:
+            results[index] = {'status': 'skipped'}
+        return jsonify(results=results, committed=False), 422
+
+    if applied:
+        db.session.flush()    # 生成新条目的 id
+        for index, op, movie in applied:
+            results[index] = {'status': op + 'd', 'id': movie.id}    # created / updated / deleted
+        invalidate_movie_cache()
+        db.session.commit()    # 整批只提交一次
+    return jsonify(results=results, committed=True)
@@ -0,0 +1,150 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+from flask import abort, request, send_from_directory, url_for as flask_url_for
+from werkzeug.security import safe_join
+
+from watchlist import app
+
+try:
+    import brotli
+except ImportError:    # brotli 是可选依赖，没有安装时只生成 gzip 版本
+    brotli = None
+
+# 静态资源指纹
+# flask build-assets 把 watchlist/static/ 下的文件复制到 ASSETS_BUILD_DIR，文件名里加上内容散列
+# （style.css -> style.3f2a9c1b04de.css），并为文本类文件预先生成 .gz / .br 压缩版本，
+# 最后写出 manifest.json 记录原文件名到带散列文件名的映射。
+# 模板里的 url_for('static', filename=...) 会被替换成 /assets/<带散列的文件名>：
+# 内容变了文件名就变，所以可以让浏览器永久缓存（Cache-Control: immutable），再次访问时只需要下载 HTML。
+# 没有构建过（没有 manifest.json）时保持原来的 /static/ 地址，开发时不需要先构建。
+
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.txt', '.json', '.xml', '.html', '.ico', '.map'}
+MIN_COMPRESS_SIZE = 256    # 太小的文件压缩后省不了多少，反而多一次磁盘查找
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))    # 按优先顺序
+
+
+def hashed_name(filename, content):
+    """Return ``filename`` with a content hash inserted before the extension."""
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)    # mtime=0 让相同内容的输出完全一致
+    return brotli.compress(data, quality=11)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build_assets(static_folder, build_dir):
+    """Copy every static file to ``build_dir`` under a hashed name; return the manifest."""
+    encodings = [(name, suffix) for name, suffix in ENCODINGS if name != 'br' or brotli is not None]
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                content = f.read()
+            target = hashed_name(filename, content)
+            _write(os.path.join(build_dir, target), content)
+
+            available = []
+            ext = os.path.splitext(name)[1].lower()
+            if ext in COMPRESSIBLE_EXTENSIONS and len(content) >= MIN_COMPRESS_SIZE:
+                for encoding, suffix in encodings:
+                    compressed = _compress(content, encoding)
+                    if len(compressed) < len(content) * 0.9:    # 压缩效果不明显就不保存
+                        _write(os.path.join(build_dir, target + suffix), compressed)
+                        available.append(encoding)
+            manifest[filename] = {'path': target, 'encodings': available}
+
+    # 旧版本的文件保留在目录里，已经缓存了旧页面的浏览器仍然能取到
+    _write(os.path.join(build_dir, MANIFEST_NAME),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    reload_manifest()
+    return manifest
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_manifest():
+    """Return the manifest of the build directory, or an empty dict before the first build."""
+    global _manifest
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                path = os.path.join(app.config['ASSETS_BUILD_DIR'], MANIFEST_NAME)
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        _manifest = json.load(f)
+                except FileNotFoundError:
+                    _manifest = {}
+    return _manifest
+
+
+def reload_manifest():
+    global _manifest
+    with _manifest_lock:
+        _manifest = None
+
+
+def asset_url_for(endpoint, **values):
+    """``url_for`` for templates: static files are linked by their hashed name."""
+    if endpoint == 'static' and app.config['ASSETS_ENABLED']:
+        entry = get_manifest().get(values.get('filename'))
+        if entry is not None:
+            values['filename'] = entry['path']
+            return flask_url_for('assets', **values)
+    return flask_url_for(endpoint, **values)
+
+
+app.jinja_env.globals['url_for'] = asset_url_for
+
+
+def _negotiate(available):
+    # 按服务器的优先顺序选择客户端接受（q > 0）的编码
+    for encoding, suffix in ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding, suffix
+    return None, ''
+
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    build_dir = app.config['ASSETS_BUILD_DIR']
+    path = safe_join(build_dir, filename)
+    if path is None:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    available = {encoding for encoding, suffix in ENCODINGS
+                 if os.path.isfile(path + suffix)}
+    encoding, suffix = _negotiate(available)
+
+    response = send_from_directory(build_dir, filename + suffix, mimetype=mimetype,
+                                   max_age=app.config['ASSETS_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True    # 文件名包含内容散列，内容永远不会变
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,300 @@
+import glob
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from watchlist import app, db
+from watchlist.cache import invalidate_movie_cache, invalidate_user_cache
+
+try:
+    import fcntl
+except ImportError:    # Windows 没有 fcntl，只能靠部署时只运行一个进程
+    fcntl = None
+
+# 在线备份和恢复
+# 直接复制 data.db 不安全：复制到一半时有事务提交，得到的文件可能是损坏的；
+# 加锁复制又会让整个网站在复制期间无法写入。
+# 这里使用 SQLite 的在线备份 API：每次只复制 BACKUP_PAGES 页，两步之间休息 BACKUP_SLEEP 秒。
+# 回滚日志模式下每一步只在复制时持有读锁，写事务最多等一步；备份期间如果有其他连接修改了数据库，
+# SQLite 会从头重新复制，保证得到的是某一时刻的完整快照。写入太频繁、从头复制超过 MAX_RESTARTS 次时
+# 放弃这次备份（BackupError），定时备份下一轮再试；绝不改为一步复制完，那样复制期间所有写入都要等待。
+# WAL 模式（生产模式）下整个复制过程读同一个快照，既不会从头重新复制，也完全不阻塞写。
+#
+# 快照用 gzip 压缩（mtime=0，内容相同的数据库得到完全相同的文件，方便增量同步、去重），
+# 旁边写一个 sha256sum 格式的 .sha256 文件；和最新的快照完全相同时不保存，只保留最新的 BACKUP_KEEP 个。
+# 恢复时先校验 sha256，解压后运行 PRAGMA integrity_check，都通过才写入数据库。
+
+SNAPSHOT_PREFIX = 'watchlist-'
+SNAPSHOT_SUFFIX = '.db.gz'
+MAX_RESTARTS = 3    # 写入太频繁、一直被迫从头复制时，超过这个次数就放弃
+
+
+class BackupError(Exception):
+    pass
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def database_path():
+    """Return the path of the SQLite database file, or raise BackupError."""
+    url = db.get_engine().url
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise BackupError('Only a SQLite database file can be backed up.')
+    return url.database
+
+
+def _connect(path):
+    return sqlite3.connect(path, timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000.0)
+
+
+def copy_database(source_path, target_path, pages=None, sleep=None):
+    """Copy a live database with the online backup API, a few pages at a time."""
+    pages = pages or app.config['BACKUP_PAGES']
+    sleep = app.config['BACKUP_SLEEP'] if sleep is None else sleep
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1    # 源数据库被修改，SQLite 从头开始复制，剩余页数没有减少
+            if state['restarts'] > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)    # 两步之间写事务可以提交
+
+    source = _connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # WAL 模式下先开一个读事务固定快照：之后的每一步都读这个快照，别人的写入不会让复制从头开始，
+            # 读事务也不阻塞写（只是在复制完之前检查点不能越过这个快照）
+            source.execute('BEGIN')
+            source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            # 只在回滚日志模式下发生：写入太频繁，分步复制总被打断
+            raise BackupError('The database changed more than %d times during the backup, try again later '
+                              '(DATABASE_MODE=production backs up without restarting).' % MAX_RESTARTS)
+        target.execute('PRAGMA journal_mode=DELETE')    # 快照是单个文件，不带 -wal
+    finally:
+        target.close()
+        source.close()
+    return state['restarts']
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checksum_path(snapshot):
+    return snapshot + '.sha256'
+
+
+def read_checksum(snapshot):
+    with open(checksum_path(snapshot)) as f:
+        return f.read().split()[0]
+
+
+def list_snapshots(backup_dir):
+    """Return the snapshot paths in ``backup_dir``, oldest first."""
+    return sorted(glob.glob(os.path.join(backup_dir, SNAPSHOT_PREFIX + '*' + SNAPSHOT_SUFFIX)))
+
+
+def _snapshot_name(backup_dir):
+    # 文件名里的时间精确到微秒，按文件名排序就是按时间排序
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S.%fZ')
+    return os.path.join(backup_dir, SNAPSHOT_PREFIX + stamp + SNAPSHOT_SUFFIX)
+
+
+class BackupResult(object):
+
+    def __init__(self, path, checksum, size, seconds, restarts, skipped=False):
+        self.path = path
+        self.checksum = checksum
+        self.size = size    # 压缩后的字节数
+        self.seconds = seconds
+        self.restarts = restarts
+        self.skipped = skipped    # 和最新的快照相同，没有保存新文件
+
+
+def backup_database(backup_dir=None, keep=None):
+    """Write a compressed, checksummed snapshot of the database; return a :class:`BackupResult`."""
+    backup_dir = backup_dir or app.config['BACKUP_DIR']
+    keep = keep or app.config['BACKUP_KEEP']
+    source_path = database_path()
+    os.makedirs(backup_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    fd, raw_path = tempfile.mkstemp(suffix='.db', dir=backup_dir)
+    os.close(fd)
+    tmp_path = raw_path + '.gz'
+    try:
+        restarts = copy_database(source_path, raw_path)
+        with open(raw_path, 'rb') as src, open(tmp_path, 'wb') as f:
+            # filename='' 和 mtime=0：gzip 头里不带文件名和时间
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+            f.flush()
+            os.fsync(f.fileno())
+        checksum = file_sha256(tmp_path)
+
+        snapshots = list_snapshots(backup_dir)
+        if snapshots and os.path.exists(checksum_path(snapshots[-1])) and read_checksum(snapshots[-1]) == checksum:
+            os.remove(tmp_path)
+            return BackupResult(snapshots[-1], checksum, os.path.getsize(snapshots[-1]),
+                                time.perf_counter() - start, restarts, skipped=True)
+
+        path = _snapshot_name(backup_dir)
+        with open(checksum_path(path), 'w') as f:
+            f.write('%s  %s\n' % (checksum, os.path.basename(path)))    # sha256sum -c 可以直接校验
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+    finally:
+        for leftover in (raw_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    for old in list_snapshots(backup_dir)[:-keep]:    # 轮换：只保留最新的 keep 个
+        os.remove(old)
+        if os.path.exists(checksum_path(old)):
+            os.remove(checksum_path(old))
+    return BackupResult(path, checksum, size, time.perf_counter() - start, restarts)
+
+
+def verify_snapshot(snapshot, raw_path):
+    """Check the checksum of ``snapshot`` and decompress it into ``raw_path``; raise BackupError if invalid."""
+    if not os.path.exists(checksum_path(snapshot)):
+        raise BackupError('Missing checksum file %s.' % checksum_path(snapshot))
+    if file_sha256(snapshot) != read_checksum(snapshot):
+        raise BackupError('Checksum mismatch, the snapshot is damaged.')
+    try:
+        with gzip.open(snapshot, 'rb') as src, open(raw_path, 'wb') as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+    except (OSError, EOFError) as e:
+        raise BackupError('Cannot decompress the snapshot: %s' % e)
+    connection = sqlite3.connect(raw_path)
+    try:
+        result = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        raise BackupError('Integrity check failed: %s' % e)
+    finally:
+        connection.close()
+    if result != ['ok']:
+        raise BackupError('Integrity check failed: %s' % '; '.join(result[:5]))
+
+
+def restore_database(snapshot):
+    """Replace the contents of the database with a verified snapshot."""
+    target_path = database_path()
+    fd, raw_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(target_path)))
+    os.close(fd)
+    try:
+        verify_snapshot(snapshot, raw_path)
+        # 用备份 API 把快照写进现有的数据库，而不是替换文件：
+        # 正在运行的 worker 持有旧文件的句柄和 -wal / -shm，替换文件后它们会继续读写旧文件，甚至损坏数据库。
+        # 备份 API 在一个写事务里完成，其他连接要么看到旧数据，要么看到完整的新数据。
+        db.session.remove()
+        db.get_engine().dispose()
+        source = sqlite3.connect(raw_path)
+        target = _connect(target_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(raw_path)
+    # 快照里的缓存版本号可能是 worker 已经见过的旧值，加一让所有进程的缓存失效
+    db.create_all()
+    invalidate_user_cache()
+    invalidate_movie_cache()
+    db.session.commit()
+
+
+class BackupScheduler(object):
+    """A daemon thread that takes a snapshot every BACKUP_INTERVAL seconds.
+
+    Every gunicorn worker runs one, a lock file in the backup directory lets
+    only one of them back up at a time, and a snapshot is only taken when the
+    newest one is older than the interval.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    def start(self):
+        # 第一个请求时才启动（见下面的 before_request），gunicorn 主进程不会运行备份
+        with self._lock:
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name='backup', daemon=True)
+                self._thread.start()
+
+    def _run(self, stop):
+        interval = app.config['BACKUP_INTERVAL']
+        while not stop.wait(min(interval, 60)):
+            try:
+                with app.app_context():
+                    self.run_pending(interval)
+            except BackupError as e:
+                app.logger.warning('Scheduled backup failed, retrying later: %s', e)    # 还没有新快照，下一轮会再试
+            except Exception:
+                app.logger.exception('Scheduled backup failed.')
+
+    def run_pending(self, interval):
+        """Take a snapshot if the newest one is older than ``interval``; return the result or None."""
+        backup_dir = app.config['BACKUP_DIR']
+        os.makedirs(backup_dir, exist_ok=True)
+        with open(os.path.join(backup_dir, '.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None    # 另一个 worker 正在备份
+            snapshots = list_snapshots(backup_dir)
+            if snapshots and time.time() - os.path.getmtime(snapshots[-1]) < interval:
+                return None
+            result = backup_database(backup_dir)
+            if result.skipped:
+                os.utime(result.path)    # 数据没有变化，也算作这一次已经备份过
+            else:
+                app.logger.info('Backed up the database to %s in %.1fs.', result.path, result.seconds)
+            return result
+
+    def reset(self):
+        """Forget the thread (it does not exist in a forked child)."""
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None:
+                self._stop.set()
+                self._thread.join()
+            self._thread = None
+            self._stop = None
+
+
+backup_scheduler = BackupScheduler()
+
+
+@app.before_request
+def start_backup_scheduler():
+    if app.config['BACKUP_INTERVAL'] and backup_scheduler._thread is None:
+        backup_scheduler.start()
@@ -0,0 +1,243 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from functools import wraps
+
+from flask import g, has_app_context, request, session, make_response
+from flask_login import UserMixin, current_user
+from sqlalchemy import insert
+
+from watchlist import app, db
+from watchlist.models import CacheVersion, User
+
+# 进程内缓存 + 数据库版本号
+# 缓存的数据保存在每个 worker 进程的内存里，失效依靠 cache_version 表：
+# 修改数据的一方在同一个事务里把版本号加一，其他 worker 每个请求只读一次版本号
+# （一条按主键的小查询，结果保存在 g 上），发现版本号变了就重新加载。
+
+
+def current_versions():
+    """Return ``{name: version}`` for every cache, read once per request."""
+    if has_app_context() and 'cache_versions' in g:
+        return g.cache_versions
+    versions = dict(db.session.query(CacheVersion.name, CacheVersion.version).all())
+    if has_app_context():
+        g.cache_versions = versions
+    return versions
+
+
+def current_version(name):
+    return current_versions().get(name, 0)
+
+
+def bump_version(name):
+    """Increment the version of ``name`` inside the current transaction.
+
+    The caller commits; other workers notice the change on their next request.
+    """
+    # 第一次使用时插入一行。初始值取当前毫秒时间戳，这样 initdb --drop 重建表后
+    # 版本号也不会退回到某个 worker 已经缓存过的旧值
+    db.session.execute(insert(CacheVersion).prefix_with('OR IGNORE').values(
+        name=name, version=int(time.time() * 1000)))
+    db.session.query(CacheVersion).filter_by(name=name).update(
+        {CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False)
+    if has_app_context():
+        g.pop('cache_versions', None)
+
+
+class VersionedValue(object):
+    """A single process-level value reloaded whenever its version changes."""
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._entry = None    # (version, value)
+
+    def get(self):
+        version = current_version(self.name)    # 先读版本号再加载数据，加载到的数据只会比版本号新
+        entry = self._entry
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = self.loader()
+        with self._lock:
+            self._entry = (version, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entry = None
+
+
+# 站点主人（第一个用户）的轻量快照，模板里只用到 name
+Owner = namedtuple('Owner', ['id', 'name', 'username'])
+
+
+def _load_owner():
+    user = User.query.first()
+    if user is None:
+        return None
+    return Owner(user.id, user.name, user.username)
+
+
+owner_cache = VersionedValue('user', _load_owner)
+
+
+def get_owner():
+    """Return the site owner shown in every page header."""
+    return owner_cache.get()
+
+
+class VersionedLRU(object):
+    """A bounded LRU of values that expire after a TTL or a version change."""
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()    # key -> (version, expires_at, value)
+
+    def get(self, key, loader):
+        version = current_version(self.name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self._data.move_to_end(key)    # 最近使用的放到末尾
+                return entry[2]
+        value = loader(key)
+        with self._lock:
+            self._data[key] = (version, now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)    # 淘汰最久未使用的
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# flask_login 使用的轻量用户对象，与数据库会话分离，可以安全地跨请求缓存。
+# 需要修改用户时请按 id 重新查询 User。
+class CachedUser(UserMixin):
+
+    def __init__(self, id, name, username):
+        self.id = id
+        self.name = name
+        self.username = username
+
+
+def _load_user(user_id):
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    return CachedUser(user.id, user.name, user.username)
+
+
+user_cache = VersionedLRU('user', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
+def load_cached_user(user_id):
+    """User loader for flask_login backed by :data:`user_cache`."""
+    return user_cache.get(user_id, _load_user)
+
+
+def invalidate_user_cache():
+    """Mark cached user data stale; call before committing a change to ``user``."""
+    bump_version('user')
+    owner_cache.clear()
+    user_cache.clear()
+
+
+def invalidate_movie_cache():
+    """Mark pages listing movies stale; call before committing a change to ``movie``."""
+    bump_version('movie')
+
+
+# 整页缓存
+# 匿名访客在数据变化之前看到的主页完全相同，所以把渲染好的响应体按
+# （URL, 数据版本号）缓存起来，命中时既不查询电影也不渲染模板。
+# ETag 取响应体的散列值，浏览器带 If-None-Match 再次请求时直接返回 304。
+
+class PageCache(object):
+    """An LRU of rendered responses with hit/miss counters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()    # key -> (body, etag, mimetype)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'])
+
+
+def page_cacheable():
+    # 只缓存匿名访客的 GET 请求；有待显示的 flash 消息时页面内容不同，也不缓存
+    return (app.config['PAGE_CACHE_ENABLED']
+            and request.method in ('GET', 'HEAD')
+            and not current_user.is_authenticated
+            and not session.get('_flashes'))
+
+
+def cached_page(*version_names):
+    """Cache the view's response for anonymous GETs until a version changes."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not page_cacheable():
+                return f(*args, **kwargs)
+
+            versions = current_versions()
+            key = (request.endpoint, request.full_path) + tuple(versions.get(name, 0) for name in version_names)
+            entry = page_cache.get(key)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = (body, hashlib.sha1(body).hexdigest(), response.mimetype)
+                page_cache.set(key, entry)
+
+            body, etag, mimetype = entry
+            response = app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'    # 浏览器每次都用 ETag 重新验证
+            response.vary.add('Cookie')    # 登录用户看到的页面不同
+            return response.make_conditional(request)    # If-None-Match 匹配时返回 304
+        return decorated_function
+    return decorator
+
+
+def clear_caches():
+    """Drop every process-level cache (used by the tests)."""
+    owner_cache.clear()
+    user_cache.clear()
+    page_cache.clear()
@@ -0,0 +1,32 @@
+import importlib
+
+from flask.cli import AppGroup
+
+# 命令行命令按需导入
+# 自定义命令（initdb、forge、import 等）定义在 watchlist/commands.py，只有运行 flask 命令时才需要。
+# app.cli 换成 LazyAppGroup 后，第一次列出或查找命令时才导入 commands，
+# gunicorn 的 web worker 不会导入它（以及只有命令才用到的模块）。
+# 这个模块不导入 watchlist 包，这样 watchlist/__init__.py 可以在创建 app 之后直接使用它。
+
+
+class LazyAppGroup(AppGroup):
+    """An AppGroup that imports the modules defining its commands on first use."""
+
+    def __init__(self, import_names, **kwargs):
+        AppGroup.__init__(self, **kwargs)
+        self.import_names = import_names
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            for name in self.import_names:
+                importlib.import_module(name)    # 模块里的 @app.cli.command 会把命令注册到这个组上
+
+    def get_command(self, ctx, name):
+        self._load()
+        return AppGroup.get_command(self, ctx, name)
+
+    def list_commands(self, ctx):
+        self._load()
+        return AppGroup.list_commands(self, ctx)
@@ -1,7 +1,12 @@
+import time
+
 import click
+from sqlalchemy import func
 
-from watchlist import app, db
+from watchlist import app, db, api, assets, backup, enrichment, fakedata, images, migrations, search, stats, transfer, warmup
 from watchlist.models import User, Movie
+from watchlist.cache import invalidate_user_cache, invalidate_movie_cache
+from watchlist.transfer import READERS, WRITERS
 
 # 自定义命令 —— 生成新的数据库
 @app.cli.command()    #创建自定义命令 initdb
@@ -25,9 +30,15 @@ def initdb(drop):
 
 # 自定义命令 —— 数据库初始化数据
 @app.cli.command()    #创建自定义命令 froge. 执行该命令即可将虚拟数据添加到数据库里。
-def forge():
+@click.option('--count', type=click.IntRange(min=0), help='Generate this many random movies instead of the default list.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Random seed, the same seed forges the same movies.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=50000, show_default=True, help='Rows per transaction.')
+def forge(count, seed, batch_size):
     """Generate fake data"""
     db.create_all()
+    if count is not None:
+        forge_movies(count, seed, batch_size)
+        return
 
     #全局的两个变量移动到这个函数内
     name = 'Alex Goke'
@@ -47,12 +58,32 @@ def forge():
     user = User(name=name)
     db.session.add(user)
     for m in movies:
-        movie = Movie(title=m['title'], year=m['year'])
+        movie = Movie(title=m['title'], year=int(m['year']))
         db.session.add(movie)
     
+    invalidate_user_cache()
+    invalidate_movie_cache()    # 正在运行的 worker 缓存的主页、统计页失效
     db.session.commit()
     click.echo('Done.')
 
+
+# 用于压测、预发布环境的大量数据
+def forge_movies(count, seed, batch_size):
+    if User.query.first() is None:
+        db.session.add(User(name='Alex Goke'))
+        invalidate_user_cache()
+        db.session.commit()
+
+    # 插入的行数不少于已有的行数时，先删掉索引、最后统一重建，比逐行维护索引快得多
+    defer_indexes = count >= db.session.query(func.count(Movie.id)).scalar()
+    start = time.perf_counter()
+    with click.progressbar(length=count, label='Forging movies') as bar:
+        total = fakedata.insert_movies(fakedata.generate_movies(count, seed, batch_size), on_batch=bar.update,
+                                       defer_indexes=defer_indexes)
+    elapsed = time.perf_counter() - start
+    click.echo('Forged %d movies in %.1fs (%d rows/s).' % (total, elapsed, total / elapsed if elapsed else 0))
+    click.echo('Done.')
+
 # 生成管理员账户
 @app.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')
@@ -72,5 +103,226 @@ def admin(username, password):
         user.set_password(password)  # 设置密码
         db.session.add(user)
 
+    invalidate_user_cache()    # 通知正在运行的 worker 重新加载用户
     db.session.commit()  # 提交数据库会话
-    click.echo('Done.')
\ No newline at end of file
+    click.echo('Done.')
+
+# 批量导入电影条目
+@app.cli.command('import')    # import 是 Python 关键字，函数换个名字，命令名通过参数指定
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(sorted(READERS)), help='Input format, guessed from the file extension by default.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=5000, show_default=True, help='Rows inserted per transaction.')
+@click.option('--dedupe', is_flag=True, help='Skip rows whose (title, year) already exists.')
+@click.option('--max-errors', default=20, show_default=True, help='Invalid rows to report individually.')
+def import_movies(path, fmt, batch_size, dedupe, max_errors):
+    """Import movies from a CSV or JSON-lines file."""
+    db.create_all()
+
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    reported = []
+
+    def on_invalid(line_number, row):
+        if len(reported) < max_errors:
+            click.echo('Line %d: invalid row %r' % (line_number, row), err=True)
+        reported.append(line_number)
+
+    start = time.perf_counter()
+    if path == '-':
+        stream = click.get_text_stream('stdin', encoding='utf-8')
+    else:
+        stream = open(path, encoding='utf-8', newline='')    # newline='' 让 csv 模块自己处理字段里的换行
+    with stream:    # 逐行读取，不把整个文件读进内存
+        result = transfer.import_movies(READERS[fmt](stream), batch_size=batch_size,
+                                        dedupe=dedupe, on_invalid=on_invalid)
+    elapsed = time.perf_counter() - start
+
+    click.echo('Imported %d movies in %.2fs (%d invalid, %d duplicates skipped).'
+               % (result.inserted, elapsed, result.invalid, result.duplicates))
+    click.echo('Done.')
+
+
+# 导出电影条目
+@app.cli.command('export')
+@click.argument('path', default='-', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(sorted(WRITERS)), help='Output format, guessed from the file extension by default.')
+@click.option('--gzip', is_flag=True, help='Compress the output with gzip.')
+@click.option('--since', type=click.DateTime(), help='Only export movies changed at or after this UTC time.')
+def export_movies(path, fmt, gzip, since):
+    """Export movies as CSV or JSON-lines."""
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.jsonl.gz', '.ndjson')) else 'csv'
+    if path.endswith('.gz'):
+        gzip = True
+
+    chunks = transfer.export_movies(fmt, since=since, gzip=gzip)
+    if gzip:
+        with click.open_file(path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    else:
+        with click.open_file(path, 'w', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+
+# 重建全文搜索索引
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """Rebuild the full-text search index."""
+    db.create_all()
+    search.rebuild_index()    # 旧数据库上会顺带创建索引表
+    click.echo('Done.')
+
+
+# 重新统计电影数量
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recount the movies by year and decade."""
+    db.create_all()
+    stats.rebuild_stats()
+    invalidate_movie_cache()    # 统计页是缓存的
+    db.session.commit()
+    click.echo('Done.')
+
+
+# 检查统计是否和 movie 表一致
+@app.cli.command('check-stats')
+def check_stats():
+    """Compare the movie counts with the movie table."""
+    mismatches = stats.check_stats()
+    for scope, key, expected, actual in mismatches:
+        click.echo('%s %s: expected %s, found %s' % (scope, key, expected, actual), err=True)
+    if mismatches:
+        raise click.ClickException('%d counts are wrong, run "flask rebuild-stats".' % len(mismatches))
+    click.echo('Stats are consistent.')
+
+
+# 生成 API 令牌
+@app.cli.command('token')
+def token():
+    """Print an API token for the admin user."""
+    user = User.query.first()
+    if user is None:
+        click.echo('Create the admin user first with "flask admin".')
+        return
+    click.echo(api.generate_token(user))
+
+
+# 升级旧版本的数据库
+@app.cli.command('migrate')
+def migrate():
+    """Upgrade an existing database to the current schema."""
+    try:
+        rebuilt = migrations.upgrade_movie_table()
+    except migrations.MigrationError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    click.echo('Rebuilt the movie table.' if rebuilt else 'Schema is up to date.')
+    click.echo('Done.')
+
+
+# 生成带散列文件名和预压缩版本的静态文件
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress the static files."""
+    manifest = assets.build_assets(app.static_folder, app.config['ASSETS_BUILD_DIR'])
+    for filename, entry in sorted(manifest.items()):
+        click.echo('%s -> %s %s' % (filename, entry['path'], ' '.join(entry['encodings'])))
+    if assets.brotli is None:
+        click.echo('brotli is not installed, only gzip copies were written.')
+    click.echo('Done.')
+
+
+# 提前生成模板里用到的所有缩略图
+@app.cli.command('build-images')
+def build_images():
+    """Generate the resized image variants."""
+    if images.Image is None:
+        raise click.ClickException('Pillow is not installed.')
+    for name in images.build_images():
+        click.echo(name)
+    click.echo('Done.')
+
+
+# 提前编译所有模板，写入字节码缓存（构建镜像时运行）
+@app.cli.command('warmup')
+def warmup_command():
+    """Precompile the templates into the bytecode cache."""
+    count, elapsed = warmup.warmup()
+    click.echo('Compiled %d templates in %.3fs.' % (count, elapsed))
+    if app.jinja_env.bytecode_cache is None:
+        click.echo('JINJA_BYTECODE_CACHE_DIR is empty, nothing was written to disk.')
+    click.echo('Done.')
+
+
+# 后台获取电影元数据
+@app.cli.command('enrich-worker')
+@click.option('--once', is_flag=True, help='Process the jobs that are due and exit.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=50, show_default=True, help='Jobs claimed at a time.')
+@click.option('--poll-interval', type=click.FloatRange(min=0), default=5.0, show_default=True,
+              help='Seconds to wait when the queue is empty.')
+def enrich_worker(once, batch_size, poll_interval):
+    """Fetch posters, runtimes and IMDb ids for queued movies."""
+    if not enrichment.enrichment_enabled():
+        raise click.ClickException('Set ENRICH_URL to the metadata service first.')
+    db.create_all()
+    client = enrichment.create_client()
+    try:
+        while True:
+            result = enrichment.process_batch(client, batch_size)
+            if result.total:
+                click.echo('Enriched %d movies (%d not found, %d failed, %d from cache).'
+                           % (result.enriched, result.not_found, result.failed, result.cached))
+            if result.claimed:
+                continue
+            if once:
+                break
+            else:
+                time.sleep(poll_interval)
+    finally:
+        client.close()
+    click.echo('Done.')
+
+
+# 为还没有元数据的电影（例如批量导入的）创建任务
+@app.cli.command('enrich-missing')
+def enrich_missing():
+    """Queue every movie that has no metadata yet."""
+    db.create_all()
+    click.echo('Queued %d movies.' % enrichment.enqueue_missing())
+    click.echo('Done.')
+
+
+# 在线备份数据库
+@app.cli.command('backup')
+@click.option('--dir', 'backup_dir', type=click.Path(file_okay=False), help='Where snapshots are kept (BACKUP_DIR).')
+@click.option('--keep', type=click.IntRange(min=1), help='Number of snapshots to keep (BACKUP_KEEP).')
+def backup_command(backup_dir, keep):
+    """Take a compressed snapshot of the live database."""
+    try:
+        result = backup.backup_database(backup_dir, keep)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    if result.skipped:
+        click.echo('Database unchanged since %s, no new snapshot.' % result.path)
+    else:
+        click.echo('Wrote %s (%d KB) in %.1fs.' % (result.path, result.size // 1024, result.seconds))
+        click.echo('sha256 %s' % result.checksum)
+    click.echo('Done.')
+
+
+# 从快照恢复数据库
+@app.cli.command('restore')
+@click.argument('snapshot', type=click.Path(exists=True, dir_okay=False))
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def restore_command(snapshot, yes):
+    """Verify a snapshot and restore the database from it."""
+    if not yes:
+        click.confirm('Replace the current database with %s?' % snapshot, abort=True)
+    try:
+        backup.restore_database(snapshot)
+    except backup.BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo('Restored %s.' % snapshot)
+    click.echo('Done.')
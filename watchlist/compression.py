@@ -0,0 +1,130 @@
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+from watchlist import app
+
+try:
+    import brotli
+except ImportError:    # brotli 是可选依赖，没有安装时只使用 gzip
+    brotli = None
+
+# 响应压缩
+# 对 HTML、JSON、CSV 等文本响应按 Accept-Encoding 做 br / gzip 压缩。
+# 普通响应整体压缩，小于 COMPRESS_MIN_SIZE 的不压缩；流式响应逐块压缩，
+# 每块都 flush 一次，浏览器收到一块就能解压显示一块，不会因为压缩而失去流式的效果。
+# 已经带 Content-Encoding 的响应（/assets 的预压缩文件、?gzip=1 的导出）原样返回。
+
+
+def _choose_encoding():
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def _should_compress(response):
+    if not app.config['COMPRESS_ENABLED'] or request.method == 'HEAD':
+        return False
+    if response.status_code < 200 or response.status_code in (204, 206):    # 304 见 compress_response()
+        return False
+    if 'Content-Encoding' in response.headers or response.direct_passthrough:    # 文件响应交给 send_file 处理
+        return False
+    if 'no-transform' in response.headers.get('Cache-Control', ''):
+        return False
+    return response.mimetype in app.config['COMPRESS_MIMETYPES']
+
+
+# 整页缓存里的页面每次命中都是同样的内容，按 (ETag, 编码) 缓存压缩结果，不必每次重新压缩
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
+COMPRESSED_CACHE_SIZE = 256
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        return compressor.process, compressor.flush, compressor.finish
+    # wbits=31：带 gzip 头和校验和
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of str or byte chunks, flushing after each one."""
+    process, flush, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = process(chunk)
+            if chunk:
+                data += flush()    # 不等缓冲区写满，马上把这一块发出去
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):    # 让 stream_with_context 照常结束请求上下文
+            chunks.close()
+
+
+def _compress_cached(data, encoding, etag):
+    if etag is None:
+        return compress(data, encoding)
+    key = (etag, encoding)
+    with _compressed_lock:
+        compressed = _compressed.get(key)
+        if compressed is not None:
+            _compressed.move_to_end(key)
+            return compressed
+    compressed = compress(data, encoding)
+    with _compressed_lock:
+        _compressed[key] = compressed
+        while len(_compressed) > COMPRESSED_CACHE_SIZE:
+            _compressed.popitem(last=False)
+    return compressed
+
+
+@app.after_request
+def compress_response(response):
+    if not _should_compress(response):
+        return response
+    encoding = _choose_encoding()
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if response.status_code == 304:
+            # 304 不发送响应体，但 ETag 要和同一内容压缩后的 200 响应相同，否则缓存会把两者当成不同的版本
+            _weaken_etag(response)
+            return response
+        etag, weak = response.get_etag()
+        response.set_data(_compress_cached(data, encoding, etag if not weak else None))
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+    return response
+
+
+def _weaken_etag(response):
+    # 压缩后的内容和原内容字节不同，强 ETag 改成弱 ETag；If-None-Match 用弱比较，仍然可以返回 304
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
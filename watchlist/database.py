@@ -0,0 +1,133 @@
+import threading
+from functools import wraps
+
+import sqlalchemy
+from flask import g, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+# SQLite 生产模式（DATABASE_MODE=production）
+# 默认的 SQLite 设置适合开发：回滚日志模式下写事务会阻塞所有读，
+# 多个 gunicorn worker 同时写时还会直接报 database is locked。
+# 生产模式下：
+#   * 每个连接都设置 WAL、synchronous、mmap_size、cache_size、busy_timeout；
+#   * 使用固定大小的连接池，避免每个请求都重新打开数据库文件；
+#   * 只读视图（用 @read_only 装饰）的查询走单独的只读连接池，不和写事务抢连接。
+# 这个模块不导入 watchlist 包，这样 watchlist/__init__.py 可以在创建 db 之前导入它。
+
+
+def is_production(config):
+    return config['DATABASE_MODE'] == 'production'
+
+
+def _is_memory(sa_url):
+    return sa_url.database in (None, '', ':memory:')
+
+
+def sqlite_pragmas(config, read_only=False):
+    """Return the PRAGMA statements run on every new connection."""
+    pragmas = [
+        'PRAGMA journal_mode=WAL',    # 读写互不阻塞
+        'PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'],
+        'PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'],    # 等待写锁的毫秒数，而不是立即报错
+        'PRAGMA cache_size=%d' % config['SQLITE_CACHE_SIZE'],
+        'PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'],
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only=ON')
+    return pragmas
+
+
+def configure_engine(engine, config, read_only=False):
+    """Run the production pragmas on every connection ``engine`` opens."""
+    pragmas = sqlite_pragmas(config, read_only)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def pool_options(config, pool_size):
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_pre_ping': False,    # 本地文件数据库不会断线
+        'connect_args': {'check_same_thread': False},    # 连接会被池在不同线程间复用
+    }
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends queries from read-only views to the read pool."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and has_app_context() and g.get('db_read_only'):
+            engine = get_read_engine(self.app)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class WatchlistSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with the production SQLite mode."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if sa_url.drivername == 'sqlite' and not _is_memory(sa_url) and is_production(app.config):
+            options.update(pool_options(app.config, app.config['DATABASE_POOL_SIZE']))
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        app = self.get_app()
+        if sa_url.drivername == 'sqlite' and not _is_memory(sa_url) and is_production(app.config):
+            configure_engine(engine, app.config)
+        return engine
+
+
+_read_engines = {}    # 写连接池的 URL -> 只读连接池
+_read_engines_lock = threading.Lock()
+
+
+def get_read_engine(app):
+    """Return the read-only engine for ``app``, or None outside production mode."""
+    if not is_production(app.config):
+        return None
+    write_engine = app.extensions['sqlalchemy'].db.get_engine(app)
+    url = write_engine.url
+    if url.drivername != 'sqlite' or _is_memory(url):
+        return None
+    with _read_engines_lock:
+        engine = _read_engines.get(str(url))
+        if engine is None:
+            engine = sqlalchemy.create_engine(url, **pool_options(app.config, app.config['DATABASE_READ_POOL_SIZE']))
+            configure_engine(engine, app.config, read_only=True)
+            _read_engines[str(url)] = engine
+    return engine
+
+
+def dispose_read_engines(close=True):
+    """Close every pooled read connection; with ``close=False`` only forget them (after a fork)."""
+    with _read_engines_lock:
+        for engine in _read_engines.values():
+            engine.dispose(close=close)
+        _read_engines.clear()
+
+
+def read_only(f):
+    """Route the database reads of GET requests to the read-only pool."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            g.db_read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
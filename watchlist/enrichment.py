@@ -0,0 +1,342 @@
+import asyncio
+import http.client
+import json
+import queue
+import random
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from sqlalchemy import delete, event, inspect, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from watchlist import app, db
+from watchlist.models import Movie, EnrichmentJob, MetadataResponse
+from watchlist.cache import invalidate_movie_cache
+
+# 电影元数据（海报、片长、IMDb 编号）
+# 视图里不访问外部服务：新建、修改电影时只在同一个事务里插入一条任务（enrichment_job 表），
+# 由单独运行的 flask enrich-worker 取出任务，批量请求 ENRICH_URL 指定的元数据服务，再写回 movie 表。
+#
+# 元数据服务的约定：GET <ENRICH_URL>?title=<标题>&year=<年份>，
+#   * 200 返回 JSON：{"imdb_id": "tt0096283", "poster": "https://...", "runtime": 86}，字段都可以省略；
+#   * 404 表示找不到这部电影；
+#   * 429、5xx 和网络错误会按指数退避重试。
+# ENRICH_URL 为空时不创建任务，也不能运行 worker。
+#
+# worker 的每一批：领取到期的任务 -> 查响应缓存 -> 并发请求没有缓存的 URL -> 在一个事务里写回结果。
+# 请求用 asyncio 调度，在线程池里用 http.client 发送（保持连接，复用 TCP），
+# 同时进行的请求数不超过 ENRICH_CONCURRENCY。
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+LEASE = timedelta(minutes=5)    # 领取任务后多久还没完成（worker 崩溃）就让别的 worker 重新领取
+JOB_RETRY_DELAY = 60    # 秒，任务失败后第 n 次重试前等待 60 * 2 ** (n - 1) 秒
+
+
+class EnrichmentError(Exception):
+    pass
+
+
+Metadata = namedtuple('Metadata', ['imdb_id', 'poster', 'runtime'])
+
+
+def enrichment_enabled():
+    return bool(app.config['ENRICH_URL'])
+
+
+# 任务队列
+
+
+def _enqueue_statement(movie_ids):
+    now = datetime.utcnow()
+    statement = insert(EnrichmentJob).values([{'movie_id': movie_id, 'status': 'pending', 'attempts': 0,
+                                               'run_after': now} for movie_id in movie_ids])
+    # 已经有任务时重置它：正在执行的 worker 发现 token 变了，就不会用旧标题的结果覆盖
+    return statement.on_conflict_do_update(index_elements=['movie_id'], set_={
+        'status': 'pending', 'attempts': 0, 'run_after': now, 'token': None, 'last_error': None})
+
+
+@event.listens_for(Movie, 'after_insert')
+def enqueue_new_movie(mapper, connection, target):
+    if enrichment_enabled():
+        connection.execute(_enqueue_statement([target.id]))
+
+
+@event.listens_for(Movie, 'after_update')
+def enqueue_changed_movie(mapper, connection, target):
+    state = inspect(target).attrs
+    if enrichment_enabled() and (state.title.history.has_changes() or state.year.history.has_changes()):
+        connection.execute(_enqueue_statement([target.id]))
+
+
+def enqueue_missing(batch_size=1000):
+    """Queue every movie without an IMDb id (after an import); return how many were queued."""
+    total = 0
+    last_id = 0
+    while True:
+        ids = db.session.execute(select(Movie.id).where(Movie.imdb_id.is_(None), Movie.id > last_id)
+                                 .order_by(Movie.id).limit(batch_size)).scalars().all()
+        if not ids:
+            return total
+        db.session.execute(_enqueue_statement(ids))
+        db.session.commit()
+        total += len(ids)
+        last_id = ids[-1]
+
+
+Job = namedtuple('Job', ['id', 'token', 'attempts', 'movie_id', 'title', 'year'])
+
+
+def claim_jobs(limit):
+    """Take up to ``limit`` due jobs for this worker and return them as :class:`Job` tuples."""
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+    due = (select(EnrichmentJob.id).where(EnrichmentJob.status == 'pending', EnrichmentJob.run_after <= now)
+           .order_by(EnrichmentJob.run_after).limit(limit))
+    # 领取和查询分两步：UPDATE 在写锁内完成，多个 worker 同时领取也不会拿到同一个任务
+    db.session.execute(update(EnrichmentJob).where(EnrichmentJob.id.in_(due)).values(
+        token=token, run_after=now + LEASE, attempts=EnrichmentJob.attempts + 1),
+        execution_options={'synchronize_session': False})
+    db.session.commit()
+    rows = db.session.execute(
+        select(EnrichmentJob.id, EnrichmentJob.token, EnrichmentJob.attempts, EnrichmentJob.movie_id,
+               Movie.title, Movie.year)
+        .outerjoin(Movie, Movie.id == EnrichmentJob.movie_id).where(EnrichmentJob.token == token)).all()
+    return [Job(*row) for row in rows]
+
+
+def _finish_job(job):
+    """Delete ``job`` if nobody reset it meanwhile; return True if it was still ours."""
+    result = db.session.execute(delete(EnrichmentJob).where(EnrichmentJob.id == job.id,
+                                                            EnrichmentJob.token == job.token))
+    return result.rowcount == 1
+
+
+def _retry_job(job, error):
+    if job.attempts >= app.config['ENRICH_MAX_ATTEMPTS']:
+        values = {'status': 'failed'}
+    else:
+        values = {'run_after': datetime.utcnow() + timedelta(seconds=JOB_RETRY_DELAY * 2 ** (job.attempts - 1))}
+    db.session.execute(update(EnrichmentJob).where(EnrichmentJob.id == job.id, EnrichmentJob.token == job.token)
+                       .values(token=None, last_error=str(error)[:255], **values))
+
+
+# 元数据服务客户端
+
+
+class MetadataClient(object):
+    """A concurrency-limited HTTP client for the metadata service.
+
+    Requests are scheduled with asyncio and sent from a thread pool over
+    pooled keep-alive connections.
+    """
+
+    def __init__(self, url, concurrency=4, timeout=10, retries=3, backoff=0.5, api_key=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            raise ValueError('Invalid metadata service URL: %r' % url)
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = {'Accept': 'application/json', 'User-Agent': 'watchlist'}
+        if api_key:
+            self.headers['Authorization'] = 'Bearer ' + api_key
+        self._parts = parts
+        self._connections = queue.LifoQueue()    # 空闲的连接，后放回的先取出，少用的连接自然被服务端关闭
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix='enrich')
+
+    def lookup_url(self, title, year):
+        """Return the request URL for one movie; it is also the response cache key."""
+        query = parse_qsl(self._parts.query) + [('title', title), ('year', str(year))]
+        return urlunsplit(self._parts._replace(query=urlencode(query)))
+
+    def _connect(self):
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if self._parts.scheme == 'https' else http.client.HTTPConnection
+            return cls(self._parts.netloc, timeout=self.timeout)
+
+    def _send(self, url):
+        """Send one GET in the calling thread; return ``(status, retry_after, body)``."""
+        parts = urlsplit(url)
+        connection = self._connect()
+        try:
+            connection.request('GET', parts.path + '?' + parts.query, headers=self.headers)
+            response = connection.getresponse()
+            body = response.read()
+        except BaseException:
+            connection.close()    # 连接状态未知，不放回池里
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._connections.put(connection)
+        return response.status, response.getheader('Retry-After'), body
+
+    async def fetch(self, url, semaphore):
+        """Return ``(status, body)`` for a 200 or 404 response, retrying temporary failures."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with semaphore:
+                try:
+                    status, retry_after, body = await loop.run_in_executor(self._executor, self._send, url)
+                except (OSError, http.client.HTTPException) as e:
+                    error = EnrichmentError('%s: %s' % (type(e).__name__, e))
+                else:
+                    if status in (200, 404):
+                        return status, body.decode('utf-8', 'replace')
+                    error = EnrichmentError('HTTP %d' % status)
+                    if status not in RETRY_STATUSES:
+                        raise error
+            if attempt == self.retries:
+                raise error
+            # 指数退避加随机抖动，服务端给了 Retry-After 时以它为准（等待之前已经释放了并发名额）
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    async def _fetch_all(self, urls):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self.fetch(url, semaphore) for url in urls), return_exceptions=True)
+        return dict(zip(urls, results))
+
+    def fetch_all(self, urls):
+        """Fetch every URL concurrently; return ``{url: (status, body) or exception}``."""
+        if not urls:
+            return {}
+        return asyncio.run(self._fetch_all(list(urls)))
+
+    def close(self):
+        self._executor.shutdown()
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def create_client():
+    """Return a :class:`MetadataClient` configured from the app config."""
+    return MetadataClient(app.config['ENRICH_URL'], concurrency=app.config['ENRICH_CONCURRENCY'],
+                          timeout=app.config['ENRICH_TIMEOUT'], retries=app.config['ENRICH_RETRIES'],
+                          backoff=app.config['ENRICH_BACKOFF'], api_key=app.config['ENRICH_API_KEY'])
+
+
+def parse_metadata(body):
+    """Turn a 200 response body into :class:`Metadata`, raising EnrichmentError if it is malformed."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise EnrichmentError('Response is not JSON.')
+    if not isinstance(data, dict):
+        raise EnrichmentError('Response is not a JSON object.')
+    imdb_id, poster, runtime = data.get('imdb_id'), data.get('poster'), data.get('runtime')
+    if imdb_id is not None and not (isinstance(imdb_id, str) and 0 < len(imdb_id) <= 16):
+        raise EnrichmentError('Invalid imdb_id.')
+    if poster is not None and not (isinstance(poster, str) and len(poster) <= 255
+                                   and poster.startswith(('https://', 'http://'))):
+        raise EnrichmentError('Invalid poster.')
+    if runtime is not None and not (isinstance(runtime, int) and not isinstance(runtime, bool) and runtime > 0):
+        raise EnrichmentError('Invalid runtime.')
+    return Metadata(imdb_id, poster, runtime)
+
+
+# 响应缓存
+
+
+def load_cached(urls):
+    """Return ``{url: (status, body)}`` for the cached responses that have not expired."""
+    if not urls:
+        return {}
+    oldest = datetime.utcnow() - timedelta(seconds=app.config['ENRICH_CACHE_TTL'])
+    rows = db.session.execute(select(MetadataResponse.url, MetadataResponse.status, MetadataResponse.body)
+                              .where(MetadataResponse.url.in_(list(urls)), MetadataResponse.fetched_at >= oldest))
+    return {url: (status, body) for url, status, body in rows}
+
+
+def store_cached(responses):
+    if not responses:
+        return
+    now = datetime.utcnow()
+    statement = insert(MetadataResponse).values([{'url': url, 'status': status, 'body': body, 'fetched_at': now}
+                                                 for url, (status, body) in responses.items()])
+    db.session.execute(statement.on_conflict_do_update(index_elements=['url'], set_={
+        'status': statement.excluded.status, 'body': statement.excluded.body,
+        'fetched_at': statement.excluded.fetched_at}))
+
+
+# worker
+
+
+class BatchResult(object):
+
+    def __init__(self):
+        self.claimed = 0
+        self.enriched = 0
+        self.not_found = 0
+        self.failed = 0
+        self.cached = 0    # 直接用缓存，没有访问元数据服务的任务数
+
+    @property
+    def total(self):
+        return self.enriched + self.not_found + self.failed
+
+
+def process_batch(client, batch_size=50):
+    """Claim up to ``batch_size`` jobs, fetch their metadata and save it; return a :class:`BatchResult`."""
+    result = BatchResult()
+    jobs = claim_jobs(batch_size)
+    result.claimed = len(jobs)
+    if not jobs:
+        return result
+
+    urls = {job.id: client.lookup_url(job.title, job.year) for job in jobs if job.title is not None}
+    responses = load_cached(set(urls.values()))
+    result.cached = sum(1 for url in urls.values() if url in responses)
+    fetched = client.fetch_all(sorted(set(urls.values()) - set(responses)))    # 网络请求期间不占用数据库连接
+
+    to_cache = {}
+    for url, response in fetched.items():
+        if isinstance(response, Exception):
+            continue
+        status, body = response
+        try:
+            if status == 200:
+                parse_metadata(body)    # 格式不对的响应不缓存，下次重试
+        except EnrichmentError as e:
+            fetched[url] = e
+            continue
+        to_cache[url] = response
+    responses.update(fetched)
+    store_cached(to_cache)
+
+    for job in jobs:
+        if job.title is None:    # 电影已经删除
+            _finish_job(job)
+            continue
+        response = responses[urls[job.id]]
+        if isinstance(response, Exception):
+            _retry_job(job, response)
+            result.failed += 1
+            continue
+        status, body = response
+        if not _finish_job(job):    # 执行期间电影又被修改了，新任务会用新标题重新获取
+            continue
+        if status == 404:
+            result.not_found += 1
+            continue
+        metadata = parse_metadata(body)
+        db.session.execute(update(Movie).where(Movie.id == job.movie_id).values(**metadata._asdict()),
+                           execution_options={'synchronize_session': False})
+        result.enriched += 1
+    if result.enriched:
+        invalidate_movie_cache()    # 主页显示海报和片长
+    db.session.commit()
+    return result
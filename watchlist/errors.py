@@ -13,6 +13,10 @@ def page_not_found(e):
 def bad_request(e):
     return render_template('errors/400.html'), 400
 
+@app.errorhandler(429)
+def too_many_requests(e):
+    return render_template('errors/429.html'), 429
+
 @app.errorhandler(500)
 def internal_server_error(e):
     return render_template('errors/500.html'), 500
@@ -0,0 +1,119 @@
+import itertools
+import random
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from watchlist import db
+from watchlist.models import Movie
+from watchlist.cache import invalidate_movie_cache
+from watchlist.search import begin_bulk_insert, index_movies_after
+from watchlist.stats import count_movies_after
+
+# 生成大量虚拟电影数据（flask forge --count）
+# 按批生成：每批先用 Random.choices(k=批大小) 一次抽出所有年份、模板和单词，再拼成标题，
+# 然后用一条 executemany 插入、一次提交。同一个 --seed 总是生成完全相同的数据。
+
+ADJECTIVES = [
+    'Last', 'Silent', 'Dark', 'Lost', 'Broken', 'Golden', 'Hidden', 'Wild', 'Secret', 'Final', 'Red', 'Blue',
+    'Little', 'Long', 'Cold', 'Crimson', 'Eternal', 'Forgotten', 'Midnight', 'Perfect', 'Sweet', 'Strange',
+    'Burning', 'Empty', 'Endless', 'Fallen', 'Glass', 'Iron', 'Lonely', 'Quiet',
+]
+NOUNS = [
+    'City', 'Night', 'River', 'Summer', 'Winter', 'Road', 'House', 'Garden', 'Dream', 'Storm', 'Star', 'Moon',
+    'Heart', 'Kingdom', 'Island', 'Mountain', 'Station', 'Shadow', 'Letter', 'Song', 'Voyage', 'Empire',
+    'Harbor', 'Forest', 'Sky', 'Ocean', 'Mirror', 'Train', 'Bridge', 'Detective',
+]
+NAMES = [
+    'Alice', 'Leon', 'Mary', 'Tom', 'Amelie', 'Chihiro', 'Totoro', 'Marco', 'Anna', 'Hugo', 'Jules', 'Yuki',
+    'Frank', 'Lola', 'Max', 'Rosa', 'Sam', 'Wang', 'Mei', 'Oscar',
+]
+TEMPLATES = [
+    ('The {adj} {noun}', 30),
+    ('{adj} {noun}', 20),
+    ('{noun} of the {noun2}', 15),
+    ('The {noun}', 10),
+    ("{name}'s {noun}", 10),
+    ('{name}', 5),
+    ('A {adj} {noun} in {noun2}', 5),
+    ('The {adj} {noun} {sequel}', 5),    # 续集
+]
+SEQUELS = ['II', 'III', 'Returns', 'Part 2', 'Reloaded']
+
+FIRST_YEAR = 1900
+LAST_YEAR = 2024
+# 每年上映的电影数量大致逐年增长，越近的年份权重越大（权重每年增长约 3%）
+YEARS = list(range(FIRST_YEAR, LAST_YEAR + 1))
+YEAR_WEIGHTS = list(itertools.accumulate(1.03 ** (year - FIRST_YEAR) for year in YEARS))
+
+
+GENERATE_CHUNK = 10000    # 每次抽样的行数固定，生成的数据不受 batch_size 影响
+
+
+def _generate(count, seed):
+    rng = random.Random(seed)
+    templates = [template for template, weight in TEMPLATES]
+    template_weights = list(itertools.accumulate(weight for template, weight in TEMPLATES))
+    remaining = count
+    while remaining > 0:
+        n = min(GENERATE_CHUNK, remaining)
+        remaining -= n
+        years = rng.choices(YEARS, cum_weights=YEAR_WEIGHTS, k=n)
+        rows = zip(rng.choices(templates, cum_weights=template_weights, k=n), rng.choices(ADJECTIVES, k=n),
+                   rng.choices(NOUNS, k=n), rng.choices(NOUNS, k=n), rng.choices(NAMES, k=n),
+                   rng.choices(SEQUELS, k=n))
+        yield from ((template.format(adj=adj, noun=noun, noun2=noun2, name=name, sequel=sequel)[:60], year)
+                    for (template, adj, noun, noun2, name, sequel), year in zip(rows, years))
+
+
+def generate_movies(count, seed=None, batch_size=10000):
+    """Yield lists of ``(title, year)`` tuples, ``count`` movies in total.
+
+    The same ``seed`` always produces the same movies, whatever the ``batch_size``.
+    """
+    movies = _generate(count, seed)
+    while True:
+        batch = list(itertools.islice(movies, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert_movies(batches, on_batch=None, defer_indexes=False):
+    """Insert each batch from :func:`generate_movies` in its own transaction; return the row count.
+
+    With ``defer_indexes`` the secondary indexes of the movie table are
+    dropped during the load and rebuilt once at the end, which is several
+    times faster when the table is empty or small compared to the load.
+    """
+    table = Movie.__table__
+    connection = db.session.connection()
+    # 直接用 DB-API 的 executemany 插入元组，跳过 SQLAlchemy 逐行处理参数字典的开销
+    statement = str(insert(table).compile(dialect=connection.dialect, column_keys=['title', 'year', 'updated_at']))
+    to_db = table.c.updated_at.type.bind_processor(connection.dialect)
+    if defer_indexes:
+        for index in table.indexes:
+            index.drop(connection, checkfirst=True)    # 中途失败时用 flask migrate 补回索引
+        db.session.commit()
+
+    total = 0
+    try:
+        for batch in batches:
+            updated_at = to_db(datetime.utcnow()) if to_db else datetime.utcnow()
+            last_id = begin_bulk_insert()
+            db.session.connection().exec_driver_sql(statement, [(title, year, updated_at) for title, year in batch])
+            index_movies_after(last_id)
+            count_movies_after(last_id)
+            invalidate_movie_cache()
+            db.session.commit()
+            total += len(batch)
+            if on_batch is not None:
+                on_batch(len(batch))
+    finally:
+        if defer_indexes:
+            db.session.rollback()
+            connection = db.session.connection()
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+            db.session.commit()
+    return total
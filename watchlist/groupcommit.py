@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from watchlist import app, db
+
+# 合并提交（GROUP_COMMIT=1）
+# SQLite 同一时间只允许一个写事务，每次提交还要等一次 fsync。多个 worker 同时处理表单提交时，
+# 请求排队等写锁，尾延迟随并发数迅速上升。
+# 合并提交模式下，表单的写操作（新建、编辑、删除电影，修改设置）不在请求线程里提交，
+# 而是交给每个进程里唯一的写线程：写线程收集 GROUP_COMMIT_WINDOW 秒内到达的写操作，
+# 在一个事务里依次执行，只提交（fsync）一次。
+#   * 每个写操作在自己的 SAVEPOINT 里执行，出错（包括 abort(404)）只回滚它自己，异常原样交给对应的请求；
+#   * 整批提交失败时逐个重新执行、单独提交，每个请求仍然得到自己的结果；
+#   * 写线程使用专用连接，开启 synchronous=FULL：请求只在事务提交、写入磁盘之后才返回，
+#     返回成功的写操作不会因为进程崩溃或断电丢失；
+#   * 事务用 BEGIN IMMEDIATE 开始，一开始就拿到写锁，不会在执行到一半时因为锁冲突失败。
+# 写操作是一个函数，在写线程里使用 db.session 读写数据，可能被执行不止一次（逐个重试时），
+# 所以要在函数里创建对象、查询数据，不能引用请求线程的会话里的对象。
+
+
+class GroupCommitWriter(object):
+    """A per-process writer thread that commits queued writes in batches."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+
+    def _start(self):
+        # 第一次使用时才启动写线程，这样 gunicorn fork 出来的每个 worker 都有自己的写线程
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                                name='group-commit', daemon=True)
+                self._thread.start()
+            return self._queue
+
+    def submit(self, func):
+        """Run ``func`` on the writer thread and return its result once it is committed."""
+        future = Future()
+        self._start().put((func, future))
+        return future.result()    # 不设超时：超时返回时写操作可能稍后仍会提交，请求会得到错误的结果
+
+    def _run(self, pending):
+        with app.app_context():
+            connection = db.get_engine().connect()
+            connection.exec_driver_sql('PRAGMA synchronous=FULL')    # 提交返回时事务已经写入磁盘
+            db.session(bind=connection)    # 写线程的会话固定使用这个连接
+            try:
+                while True:
+                    batch = self._collect(pending)
+                    if batch is None:
+                        return
+                    self._commit_batch(batch)
+            finally:
+                db.session.remove()
+                connection.close()
+
+    def _collect(self, pending):
+        """Wait for the first write, then gather more for GROUP_COMMIT_WINDOW seconds."""
+        item = pending.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + app.config['GROUP_COMMIT_WINDOW']
+        while len(batch) < app.config['GROUP_COMMIT_MAX_BATCH']:
+            try:
+                item = pending.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                pending.put(None)    # 先把这一批提交完，下一轮再退出
+                break
+            batch.append(item)
+        return batch
+
+    def _begin(self):
+        db.session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+
+    def _commit_batch(self, batch):
+        done = []    # (future, result, exception)
+        try:
+            self._begin()
+            for func, future in batch:
+                try:
+                    with db.session.begin_nested():
+                        result = func()
+                except Exception as e:
+                    done.append((future, None, e))
+                else:
+                    done.append((future, result, None))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # 整批没能提交（例如等写锁超时），逐个单独提交
+            for func, future in batch:
+                self._commit_one(func, future)
+            return
+        for future, result, exception in done:
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+    def _commit_one(self, func, future):
+        try:
+            self._begin()
+            result = func()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def reset(self):
+        """Forget the writer thread (it does not exist in a forked child)."""
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+            self._queue = None
+            self._thread = None
+
+
+group_writer = GroupCommitWriter()
+
+
+def commit_write(func):
+    """Run ``func`` and commit the changes it made to ``db.session``; return its result.
+
+    With GROUP_COMMIT the write is handed to the writer thread and batched
+    with concurrent writes, otherwise it runs and commits in the request.
+    """
+    if app.config['GROUP_COMMIT']:
+        return group_writer.submit(func)
+    result = func()
+    db.session.commit()
+    return result
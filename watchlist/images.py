@@ -0,0 +1,226 @@
+import hashlib
+import io
+import os
+import threading
+
+from flask import abort, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+from watchlist import app
+
+try:
+    from PIL import Image, ImageSequence, features
+except ImportError:    # 没有安装 Pillow 时模板退回原图
+    Image = None
+
+# 图片缩略图
+# 页面上的头像只显示 80px 宽，原图却是 300px 的 43 KB 图片；龙猫动图也比显示尺寸大。
+# 这里按显示尺寸生成 1x / 2x 两种宽度的缩略图，每种宽度再生成 AVIF、WebP 和原格式三个版本，
+# 模板里用 picture() 输出 <picture> + srcset，浏览器自己挑最合适的那一个。
+# 缩略图第一次被请求时生成并写入 IMAGES_CACHE_DIR，之后直接读文件；
+# 也可以用 flask build-images 提前全部生成。URL 里带原图的内容散列，所以可以永久缓存。
+
+# 页面上用到的图片和它们的显示宽度（CSS 像素）
+IMAGE_SIZES = {
+    'images/avatar.png': 80,
+    'images/totoro.gif': 137,    # 高 100px
+}
+DENSITIES = (1, 2)
+FALLBACK_FORMATS = {'JPEG': 'jpeg', 'GIF': 'gif'}    # 其他格式一律退回 PNG
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg', 'gif': 'gif', 'png': 'png'}
+QUALITY = {'avif': 50, 'webp': 75}    # AVIF 的质量刻度和 WebP 不同，50 大致相当于 WebP 的 75
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'gif': 'image/gif', 'png': 'image/png'}
+
+
+class SourceImage(object):
+    """Size, format and content hash of an image under the static folder."""
+
+    def __init__(self, filename, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        with Image.open(io.BytesIO(content)) as image:
+            self.size = image.size
+            self.format = image.format
+            self.animated = getattr(image, 'n_frames', 1) > 1
+        self.filename = filename
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.digest = hashlib.sha256(content).hexdigest()[:12]
+
+    @property
+    def fallback_format(self):
+        return FALLBACK_FORMATS.get(self.format, 'png')
+
+    def formats(self):
+        """Output formats, best first."""
+        formats = []
+        if not self.animated and features.check('avif'):    # 动图只生成 WebP
+            formats.append('avif')
+        if features.check('webp'):
+            formats.append('webp')
+        formats.append(self.fallback_format)
+        return formats
+
+    def widths(self, display_width):
+        # 不放大：原图不够宽时 2x 就用原图宽度
+        return sorted({min(display_width * density, self.size[0]) for density in DENSITIES})
+
+    def height_for(self, width):
+        return max(1, round(self.size[1] * width / self.size[0]))
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def get_source(filename):
+    """Return the :class:`SourceImage` for a file listed in ``IMAGE_SIZES``, or None."""
+    if Image is None or filename not in IMAGE_SIZES:
+        return None
+    path = os.path.join(app.static_folder, filename)
+    with _sources_lock:
+        source = _sources.get(filename)
+        if source is None or source.mtime != os.path.getmtime(path):    # 原图被替换后重新计算散列
+            source = _sources[filename] = SourceImage(filename, path)
+    return source
+
+
+def derivative_name(source, width, fmt):
+    # <宽度>/<原图散列>/<原图路径>.<格式>，和缓存目录里的文件路径一致，也可以交给 nginx 直接伺服
+    return '%d/%s/%s.%s' % (width, source.digest, source.filename, EXTENSIONS[fmt])
+
+
+def derivative_url(source, width, fmt):
+    return url_for('image', width=width, digest=source.digest,
+                   filename='%s.%s' % (source.filename, EXTENSIONS[fmt]))
+
+
+def _resize(image, width, height):
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def render_derivative(source, width, fmt):
+    """Return the bytes of ``source`` resized to ``width`` and encoded as ``fmt``."""
+    height = source.height_for(width)
+    output = io.BytesIO()
+    with Image.open(source.path) as image:
+        if source.animated:
+            frames, durations = [], []
+            for frame in ImageSequence.Iterator(image):
+                # 动图的帧统一转成 RGBA 再缩放，保存 GIF 时重新量化，比直接按 RGB 保存小得多
+                frames.append(frame.convert('RGBA').resize((width, height), Image.LANCZOS))
+                durations.append(frame.info.get('duration', 100))    # 每一帧的时长可能不同
+            options = {'save_all': True, 'append_images': frames[1:], 'loop': image.info.get('loop', 0),
+                       'duration': durations}
+            if fmt == 'gif':
+                options['optimize'] = True
+            frames[0].save(output, format=fmt.upper(), **options)
+        else:
+            image = _resize(image, width, height)
+            if fmt == 'jpeg':
+                image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True, progressive=True)
+            elif fmt == 'png':
+                image.save(output, format='PNG', optimize=True)
+            else:
+                image.save(output, format=fmt.upper(), quality=QUALITY[fmt])
+    return output.getvalue()
+
+
+def ensure_derivative(source, width, fmt):
+    """Generate the derivative on disk if it is missing; return its path below the cache dir."""
+    name = derivative_name(source, width, fmt)
+    path = os.path.join(app.config['IMAGES_CACHE_DIR'], name)
+    if not os.path.exists(path):
+        data = render_derivative(source, width, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，多个 worker 同时生成也不会读到写了一半的文件
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return name
+
+
+def build_images():
+    """Generate every derivative used by the templates; return their names."""
+    names = []
+    for filename, display_width in sorted(IMAGE_SIZES.items()):
+        source = get_source(filename)
+        if source is None:
+            continue
+        for width in source.widths(display_width):
+            for fmt in source.formats():
+                names.append(ensure_derivative(source, width, fmt))
+    return names
+
+
+def picture(filename, alt, lazy=False, **attrs):
+    """Render a ``<picture>`` element with 1x/2x sources for a static image.
+
+    ``class_`` sets the class attribute of the ``<img>``; ``lazy`` defers
+    loading for images below the fold.
+    """
+    img_attrs = {'alt': alt}
+    if 'class_' in attrs:
+        attrs['class'] = attrs.pop('class_')
+    img_attrs.update(attrs)
+    if lazy:
+        img_attrs['loading'] = 'lazy'
+        img_attrs['decoding'] = 'async'
+
+    source = get_source(filename)
+    if source is None:
+        img_attrs['src'] = url_for('static', filename=filename)
+        return Markup('<img %s>' % _attributes(img_attrs))
+
+    display_width = IMAGE_SIZES[filename]
+    widths = source.widths(display_width)
+    img_attrs.setdefault('width', display_width)    # 写明尺寸，图片加载前页面不会跳动
+    img_attrs.setdefault('height', source.height_for(display_width))
+
+    def srcset(fmt):
+        return ', '.join('%s %sx' % (derivative_url(source, width, fmt),
+                                     _density(width, display_width)) for width in widths)
+
+    formats = source.formats()
+    parts = ['<picture>']
+    for fmt in formats[:-1]:
+        parts.append('<source type="%s" srcset="%s">' % (MIME_TYPES[fmt], escape(srcset(fmt))))
+    fallback = formats[-1]
+    img_attrs['src'] = derivative_url(source, widths[0], fallback)
+    if len(widths) > 1:
+        img_attrs['srcset'] = srcset(fallback)
+    parts.append('<img %s>' % _attributes(img_attrs))
+    parts.append('</picture>')
+    return Markup(''.join(parts))
+
+
+def _density(width, display_width):
+    return ('%.2f' % (width / display_width)).rstrip('0').rstrip('.')
+
+
+def _attributes(attrs):
+    return ' '.join('%s="%s"' % (key, escape(value)) for key, value in attrs.items())
+
+
+app.jinja_env.globals['picture'] = picture
+
+
+@app.route('/images/<int:width>/<digest>/<path:filename>')
+def image(width, digest, filename):
+    source_name, _, ext = filename.rpartition('.')
+    source = get_source(source_name)
+    # 只生成模板里会用到的尺寸和格式，不能通过构造 URL 让服务器生成任意尺寸的图片
+    if source is None or digest != source.digest or width not in source.widths(IMAGE_SIZES[source_name]):
+        abort(404)
+    fmt = next((fmt for fmt in source.formats() if EXTENSIONS[fmt] == ext), None)
+    if fmt is None:
+        abort(404)
+    name = ensure_derivative(source, width, fmt)
+    response = send_from_directory(app.config['IMAGES_CACHE_DIR'], name, mimetype=MIME_TYPES[fmt],
+                                   max_age=app.config['ASSETS_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True    # URL 里带原图散列
+    return response
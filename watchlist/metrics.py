@@ -0,0 +1,194 @@
+import threading
+import time
+
+from flask import g, has_app_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from watchlist import app
+from watchlist.cache import page_cache
+
+# 请求指标
+# 每个请求记录：总耗时、SQL 条数、SQL 耗时、模板渲染耗时，按端点（endpoint）汇总成直方图，
+# 在 /metrics 以 Prometheus 文本格式输出。每条 SQL 只多两次计时和几次加法，可以在生产环境常开。
+# SLOW_REQUEST_THRESHOLD 大于 0 时，超过阈值的请求会连同执行过的 SQL 一起写入日志。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram(object):
+    """A Prometheus-style cumulative histogram keyed by a label value."""
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}    # label value -> [bucket counts..., count, sum]
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, label_value):
+        series = self._series.get(label_value)
+        return series[-2] if series else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_value, series in items:
+            label = '%s="%s"' % (self.label, _escape(label_value))
+            for bound, count in zip(self.buckets, series):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, _format(bound), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, series[-2]))
+            lines.append('%s_count{%s} %d' % (self.name, label, series[-2]))
+            lines.append('%s_sum{%s} %s' % (self.name, label, _format(series[-1])))
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    return repr(float(value))
+
+
+request_latency = Histogram('watchlist_request_duration_seconds', 'Request latency by endpoint.',
+                            'endpoint', LATENCY_BUCKETS)
+request_queries = Histogram('watchlist_request_sql_queries', 'SQL statements executed per request by endpoint.',
+                            'endpoint', QUERY_COUNT_BUCKETS)
+request_sql_time = Histogram('watchlist_request_sql_duration_seconds', 'Time spent in SQL per request by endpoint.',
+                             'endpoint', LATENCY_BUCKETS)
+template_render_time = Histogram('watchlist_template_render_duration_seconds', 'Template render time by template.',
+                                 'template', LATENCY_BUCKETS)
+
+HISTOGRAMS = (request_latency, request_queries, request_sql_time, template_render_time)
+
+
+class RequestMetrics(object):
+    """Counters for the current request, stored on ``g``."""
+
+    __slots__ = ('start', 'queries', 'sql_time', 'statements', 'render_starts')
+
+    def __init__(self, keep_statements):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.statements = [] if keep_statements else None
+        self.render_starts = []
+
+
+def _current():
+    if has_app_context():
+        return g.get('_metrics')
+    return None
+
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        g._metrics = RequestMetrics(app.config['SLOW_REQUEST_THRESHOLD'] > 0)
+
+
+@app.teardown_request
+def record_request_metrics(exc):
+    metrics = g.pop('_metrics', None)
+    if metrics is None:
+        return
+    elapsed = time.perf_counter() - metrics.start
+    endpoint = request.endpoint or 'none'    # 404 等没有匹配到端点的请求
+    request_latency.observe(endpoint, elapsed)
+    request_queries.observe(endpoint, metrics.queries)
+    request_sql_time.observe(endpoint, metrics.sql_time)
+
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold > 0 and elapsed >= threshold:
+        app.logger.warning('Slow request: %s %s took %.3fs (%d queries, %.3fs in SQL)\n%s',
+                           request.method, request.full_path, elapsed, metrics.queries, metrics.sql_time,
+                           '\n'.join('  %.3fs  %s' % item for item in metrics.statements or ()))
+
+
+# 监听所有引擎（包括生产模式下的只读连接池）
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        conn.info.setdefault('_metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    metrics = _current()
+    starts = conn.info.get('_metrics_query_start')
+    if metrics is None or not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    metrics.queries += 1
+    metrics.sql_time += elapsed
+    if metrics.statements is not None:
+        metrics.statements.append((elapsed, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    # 出错的语句不会触发 after_cursor_execute，丢掉它的开始时间
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('_metrics_query_start'):
+        connection.info['_metrics_query_start'].pop()
+
+
+def start_render_timer(sender, template, context, **extra):
+    metrics = _current()
+    if metrics is not None:
+        metrics.render_starts.append(time.perf_counter())
+
+
+def record_render_time(sender, template, context, **extra):
+    metrics = _current()
+    if metrics is not None and metrics.render_starts:
+        template_render_time.observe(template.name, time.perf_counter() - metrics.render_starts.pop())
+
+
+before_render_template.connect(start_render_timer, app)
+template_rendered.connect(record_render_time, app)
+
+
+def render_metrics():
+    """Return every metric in the Prometheus text exposition format."""
+    from watchlist import startup_times    # 包导入完成后才有这个变量，所以在这里导入
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.extend(['# HELP watchlist_startup_seconds Time spent importing and warming up the application.',
+                  '# TYPE watchlist_startup_seconds gauge'])
+    for phase, seconds in sorted(startup_times.items()):
+        lines.append('watchlist_startup_seconds{phase="%s"} %s' % (phase, _format(seconds)))
+    lines.extend([
+        '# HELP watchlist_page_cache_hits_total Anonymous page cache hits.',
+        '# TYPE watchlist_page_cache_hits_total counter',
+        'watchlist_page_cache_hits_total %d' % page_cache.hits,
+        '# HELP watchlist_page_cache_misses_total Anonymous page cache misses.',
+        '# TYPE watchlist_page_cache_misses_total counter',
+        'watchlist_page_cache_misses_total %d' % page_cache.misses,
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.reset()
@@ -0,0 +1,90 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from watchlist import db
+from watchlist.models import Movie
+from watchlist import search, stats
+
+# 数据库升级
+# 项目没有使用迁移框架，db.create_all() 只会创建缺少的表，不会修改已有的表。
+# upgrade_movie_table() 把旧版本的 movie 表（year 为字符串、缺少 updated_at 或索引）
+# 重建为当前模型的结构：SQLite 不支持修改列类型，只能新建表后复制数据。
+# 如果只是缺少可以为空、没有默认值的列（例如 imdb_id、poster、runtime），
+# 直接 ALTER TABLE ADD COLUMN，只改表结构，不用复制整张表。
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _columns(connection):
+    return {row[1]: row[2].upper() for row in connection.execute(text('PRAGMA table_info(movie)'))}
+
+
+def needs_rebuild(connection):
+    columns = _columns(connection)
+    expected = {column.name for column in Movie.__table__.columns}
+    return set(columns) != expected or columns.get('year') != 'INTEGER'
+
+
+def addable_columns(connection):
+    """Return the missing columns if they can all be added in place, else None."""
+    columns = _columns(connection)
+    if columns.get('year') != 'INTEGER' or not set(columns) <= set(Movie.__table__.columns.keys()):
+        return None
+    missing = [column for column in Movie.__table__.columns if column.name not in columns]
+    if any(not column.nullable or column.default is not None or column.index for column in missing):
+        return None
+    return missing
+
+
+def invalid_years(connection, limit=20):
+    """Return ids of movies whose year is not a 1-4 digit number."""
+    rows = connection.execute(text(
+        "SELECT id FROM movie WHERE year IS NULL OR trim(year) = '' OR trim(year) GLOB '*[^0-9]*' "
+        "OR length(trim(year)) > 4 LIMIT :limit"), {'limit': limit})
+    return [row[0] for row in rows]
+
+
+def upgrade_movie_table():
+    """Bring the movie table up to the current schema; return True if it was rebuilt.
+
+    Missing nullable columns are added in place and do not count as a rebuild.
+    """
+    db.create_all()    # 创建缺少的表（cache_version 等）
+    connection = db.session.connection()
+    missing = addable_columns(connection)
+    if missing:
+        for column in missing:
+            connection.execute(text('ALTER TABLE movie ADD COLUMN %s' % CreateColumn(column).compile(connection)))
+    if not needs_rebuild(connection):
+        # 结构一致，只补上缺少的索引
+        for index in Movie.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        db.session.commit()
+        return False
+
+    bad = invalid_years(connection)
+    if bad:
+        raise MigrationError('Movies with an invalid year, fix them first: %s' % ', '.join(map(str, bad)))
+
+    old_columns = _columns(connection)
+    names = [name for name in old_columns if name in Movie.__table__.columns]
+    select_list = ['CAST(trim(year) AS INTEGER)' if name == 'year' else name for name in names]
+    if 'updated_at' not in old_columns:
+        names.append('updated_at')
+        select_list.append("strftime('%Y-%m-%d %H:%M:%f', 'now')")
+
+    # 旧表上的索引会跟着改名，先删掉，否则新表建同名索引会冲突
+    for index in inspect(connection).get_indexes('movie'):
+        connection.execute(text('DROP INDEX IF EXISTS "%s"' % index['name']))
+    connection.execute(text('DROP TABLE IF EXISTS movie_fts'))
+    connection.execute(text('ALTER TABLE movie RENAME TO movie_old'))
+    Movie.__table__.create(connection)    # 按当前模型建表和索引
+    connection.execute(text('INSERT INTO movie (%s) SELECT %s FROM movie_old'
+                            % (', '.join(names), ', '.join(select_list))))
+    connection.execute(text('DROP TABLE movie_old'))
+    db.session.commit()
+    search.rebuild_index()
+    stats.rebuild_stats()    # 旧表的年份可能是字符串，按转换后的整数重新计数
+    return True
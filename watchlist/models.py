@@ -1,7 +1,10 @@
+import re
+from datetime import datetime
+
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from watchlist import db
+from watchlist import app, db
 
 # 用户模型 数据库表
 class User(db.Model, UserMixin):  # 表名将会是 user（自动生成，小写处理）    # 继承 UserMixin类会让 User 类拥有几个用于判断认证状态的属性和方法
@@ -11,7 +14,9 @@ class User(db.Model, UserMixin):  # 表名将会是 user（自动生成，小写
     password_hash = db.Column(db.String(128))    # 密码散列值
     
     def set_password(self, password):    # 用来设置密码的方法，接受密码作为参数
-        self.password_hash = generate_password_hash(password)  # 将生成的密码保持到对应字段
+        self.password_hash = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])  # 将生成的密码保持到对应字段
+        from watchlist.cache import invalidate_user_cache    # 在函数内导入，避免循环导入
+        invalidate_user_cache()    # 修改密码后让缓存的登录用户失效
 
     def validate_password(self, password):    # 用于验证密码的方法，接受密码作为参数
         return check_password_hash(self.password_hash, password)  # 返回布尔值
@@ -20,4 +25,62 @@ class User(db.Model, UserMixin):  # 表名将会是 user（自动生成，小写
 class Movie(db.Model):   # 表名将会是movie
     id = db.Column(db.Integer, primary_key=True)  # 主键
     title = db.Column(db.String(60))  # 电影标题
-    year = db.Column(db.String(4))  # 电影年份
\ No newline at end of file
+    #year = db.Column(db.String(4))  # 电影年份【弃用】字符串比较排序不对，也不能按范围走索引
+    year = db.Column(db.Integer)  # 电影年份（整数）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # 最后修改时间（UTC），导出时按它增量同步
+    # 以下三项由后台任务从元数据服务获取（见 watchlist/enrichment.py），获取之前为空
+    imdb_id = db.Column(db.String(16))  # IMDb 编号，例如 tt0096283
+    poster = db.Column(db.String(255))  # 海报图片的 URL
+    runtime = db.Column(db.Integer)  # 片长（分钟）
+
+    __table_args__ = (
+        db.Index('ix_movie_title_year', 'title', 'year'),    # 导入时按（标题, 年份）去重；按标题排序
+        db.Index('ix_movie_year_title', 'year', 'title'),    # 按年份排序、按年份范围筛选
+        db.Index('ix_movie_year', 'year'),    # 按年份筛选时的默认排序（年份, id）
+    )
+
+YEAR_RE = re.compile(r'[0-9]{1,4}')    # 用 fullmatch()：$ 会匹配末尾的换行，'2019\n' 也能通过
+
+# 校验电影条目，表单、批量导入等所有写入路径共用同一套规则
+# year 是表单里提交的字符串，必须是不超过 4 位的数字，保存前用 int() 转换
+def validate_movie(title, year):
+    return bool(title) and bool(year) and len(title) <= 60 and YEAR_RE.fullmatch(year) is not None
+
+# 电影数量统计 数据库表
+# 每次增删电影、修改年份时在同一个事务里更新（见 watchlist/stats.py），统计页和主页的总数只读这张小表，
+# 不再对 movie 表计数。scope 为 total（key 为 0）、decade（key 为 1990 这样的年代）或 year（key 为年份）。
+class MovieStat(db.Model):    # 表名将会是 movie_stat
+    scope = db.Column(db.String(8), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# 缓存版本号 数据库表
+# 每个进程在内存里缓存一些很少变化的数据（例如站点主人），修改这些数据时把对应的版本号加一，
+# 各个 gunicorn worker 只需读一下版本号就知道自己的缓存是否过期。
+class CacheVersion(db.Model):    # 表名将会是 cache_version
+    name = db.Column(db.String(32), primary_key=True)  # 缓存名称，例如 user
+    version = db.Column(db.Integer, nullable=False, default=0)  # 版本号
+
+# 元数据获取任务 数据库表
+# 新建或修改电影后插入一行，由 flask enrich-worker 取出执行，成功后删除。
+# 每部电影最多一个任务：任务还没执行时电影又被修改，只是把这一行重置。
+class EnrichmentJob(db.Model):    # 表名将会是 enrichment_job
+    id = db.Column(db.Integer, primary_key=True)
+    movie_id = db.Column(db.Integer, nullable=False, unique=True)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending 或 failed（重试次数用完）
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # 已经尝试的次数
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 在这个时间之后才执行（UTC）
+    token = db.Column(db.String(32))  # 领取任务的 worker 写入的随机值，用来判断任务是否被别人重置
+    last_error = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_enrichment_job_status_run_after', 'status', 'run_after'),    # 按时间取出到期的任务
+    )
+
+# 元数据服务的响应缓存 数据库表
+# 同样的请求（同样的标题和年份）在有效期内不再访问元数据服务，404 也会缓存
+class MetadataResponse(db.Model):    # 表名将会是 metadata_response
+    url = db.Column(db.String(512), primary_key=True)  # 请求的完整 URL（不含 API 密钥）
+    status = db.Column(db.Integer, nullable=False)  # 200 或 404
+    body = db.Column(db.Text)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
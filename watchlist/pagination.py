@@ -0,0 +1,134 @@
+import base64
+import json
+
+from flask import request
+from sqlalchemy import literal, tuple_
+
+from watchlist import app
+
+# 游标（keyset）分页
+# 不使用 OFFSET：OFFSET 需要数据库先扫描并丢弃前面所有的行，页码越大越慢。
+# 这里记住上一页最后一行（或第一行）的键值，下一页直接用 WHERE key > ? 在索引上定位，
+# 所以无论表里有 10 行还是 1000 万行，取任意一页的代价都是一样的。
+
+
+class Page(object):
+    """One page of keyset-paginated results."""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor    # 传给 ?after= 的值，没有下一页时为 None
+        self.prev_cursor = prev_cursor    # 传给 ?before= 的值，没有上一页时为 None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def get_per_page():
+    """Read ?per_page= from the request, clamped to the configured bounds."""
+    per_page = request.args.get('per_page', app.config['WATCHLIST_PER_PAGE'], type=int)
+    return max(1, min(per_page, app.config['WATCHLIST_MAX_PER_PAGE']))
+
+
+def encode_cursor(values):
+    """Turn the key of a row into a URL-safe cursor.
+
+    Single integer keys stay plain integers (``?after=42``); composite keys
+    become an opaque base64 token.
+    """
+    if len(values) == 1:
+        return values[0]
+    data = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+# SQLite 的整数是 64 位有符号数，超出范围的游标绑定参数时会 OverflowError
+MIN_INT, MAX_INT = -2 ** 63, 2 ** 63 - 1
+
+
+def _valid_value(value, column):
+    # 每个值的类型要和对应的列一致（年份、id 是整数，标题是字符串，年份可以为空），
+    # 否则伪造的游标（例如 ["a", {"x": 1}, 3]）会在绑定参数时出错
+    if value is None:
+        return True
+    if type(value) is not column.type.python_type:
+        return False
+    return not isinstance(value, int) or MIN_INT <= value <= MAX_INT
+
+
+def get_cursor(name, columns):
+    """Read the ``name`` cursor (after / before) for ``columns`` from the request."""
+    if len(columns) == 1:
+        value = request.args.get(name, type=int)
+        return None if value is None or not _valid_value(value, columns[0]) else (value,)
+    token = request.args.get(name)
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:    # 无效的游标当作没有游标，返回第一页
+        return None
+    if not isinstance(values, list) or len(values) != len(columns):
+        return None
+    if not all(_valid_value(value, column) for value, column in zip(values, columns)):
+        return None
+    return tuple(values)
+
+
+def _key(columns):
+    # 单列直接比较，多列用 SQLite 的行值比较 (a, b, c) > (?, ?, ?)，同样可以用索引定位
+    return columns[0] if len(columns) == 1 else tuple_(*columns)
+
+
+def _value(values):
+    return values[0] if len(values) == 1 else tuple_(*[literal(value) for value in values])
+
+
+def keyset_paginate(query, columns, after=None, before=None, per_page=20):
+    """Return a :class:`Page` of ``query`` ordered by the indexed ``columns``.
+
+    ``columns`` is a column or a sequence of columns whose combined values
+    are unique (end with the primary key). ``after`` returns the rows
+    following that key tuple, ``before`` the rows preceding it; with
+    neither the first page is returned.
+    """
+    if not isinstance(columns, (list, tuple)):
+        columns = (columns,)
+    key = _key(columns)
+
+    if before is not None:
+        # 向前翻页：倒序取 per_page + 1 行，多出来的一行说明前面还有数据
+        rows = query.filter(key < _value(before)).order_by(*[column.desc() for column in columns]) \
+            .limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = True    # before 指向的那一行就在后面
+    else:
+        if after is not None:
+            query_after = query.filter(key > _value(after))
+        else:
+            query_after = query
+        rows = query_after.order_by(*[column.asc() for column in columns]).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        # 只用索引确认 after 之前是否还有行（LIMIT 1，代价固定）
+        has_prev = after is not None and query.filter(key <= _value(after)).limit(1).first() is not None
+
+    def cursor(item):
+        return encode_cursor(tuple(getattr(item, column.key) for column in columns))
+
+    next_cursor = cursor(items[-1]) if items and has_next else None
+    prev_cursor = cursor(items[0]) if items and has_prev else None
+    return Page(items, per_page, next_cursor, prev_cursor)
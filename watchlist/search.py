@@ -0,0 +1,96 @@
+import re
+
+from sqlalchemy import DDL, event, inspect, text
+
+from watchlist import db
+from watchlist.models import Movie
+
+# 标题全文搜索
+# 使用 SQLite FTS5 虚拟表 movie_fts 索引 movie.title。它是“外部内容”表（content='movie'），
+# 只保存倒排索引，不重复保存标题。
+# 索引的同步没有用数据库触发器：逐行触发写 FTS5 索引比批量 INSERT ... SELECT 慢近十倍，
+# 会拖慢批量导入。所以通过 ORM 的事件在同一个事务里逐条同步（表单、API 等），
+# 批量插入的路径用 begin_bulk_insert() 开始每一批的事务，插入后调用 index_movies_after() 一次性补上索引。
+
+# prefix='2 3' 额外建立前缀索引，加快 "ab*" 这类前缀查询
+FTS_DDL = ("CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+           "title, content='movie', content_rowid='id', "
+           "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+
+INDEX_ROW = text('INSERT INTO movie_fts (rowid, title) VALUES (:id, :title)')
+UNINDEX_ROW = text("INSERT INTO movie_fts (movie_fts, rowid, title) VALUES ('delete', :id, :title)")
+
+# db.create_all() / db.drop_all() 时同时创建、删除索引表
+event.listen(Movie.__table__, 'after_create', DDL(FTS_DDL).execute_if(dialect='sqlite'))
+event.listen(Movie.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS movie_fts').execute_if(dialect='sqlite'))
+
+
+@event.listens_for(Movie, 'after_insert')
+def index_movie(mapper, connection, target):
+    connection.execute(INDEX_ROW, {'id': target.id, 'title': target.title})
+
+
+@event.listens_for(Movie, 'after_update')
+def reindex_movie(mapper, connection, target):
+    history = inspect(target).attrs.title.history
+    if not history.has_changes():
+        return
+    # 外部内容表删除索引时必须提供旧的标题
+    for old_title in history.deleted:
+        connection.execute(UNINDEX_ROW, {'id': target.id, 'title': old_title})
+    connection.execute(INDEX_ROW, {'id': target.id, 'title': target.title})
+
+
+@event.listens_for(Movie, 'after_delete')
+def unindex_movie(mapper, connection, target):
+    connection.execute(UNINDEX_ROW, {'id': target.id, 'title': target.title})
+
+
+def index_movies_after(last_id):
+    """Index every movie with an id greater than ``last_id`` (after a bulk insert)."""
+    db.session.execute(text('INSERT INTO movie_fts (rowid, title) SELECT id, title FROM movie WHERE id > :id'),
+                       {'id': last_id})
+
+
+def max_movie_id():
+    return db.session.execute(text('SELECT coalesce(max(id), 0) FROM movie')).scalar()
+
+
+def begin_bulk_insert():
+    """Start a write transaction for one bulk insert batch; return the largest movie id before it.
+
+    Until the commit, the movies with a greater id are exactly the ones this batch inserts.
+    """
+    # 先拿到写锁再读最大 id：否则读 id 和插入之间别的请求提交的电影（已经由 ORM 事件加入索引）
+    # 也会被 index_movies_after() 再加入一次，FTS5 不检查重复的 rowid
+    db.session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+    return max_movie_id()
+
+
+def rebuild_index():
+    """Create the FTS table if missing and reindex every title."""
+    db.session.execute(text(FTS_DDL))
+    db.session.execute(text("INSERT INTO movie_fts (movie_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+
+def build_match_query(q):
+    """Turn user input into an FTS5 query: every word must match as a prefix."""
+    # 只保留单词字符，避免用户输入的引号、括号、AND/OR 等被当作 FTS5 语法
+    words = re.findall(r'\w+', q or '')
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def search_movies(q, page=1, per_page=20):
+    """Return ``(movies, has_next)`` for the best-ranked titles matching ``q``."""
+    match = build_match_query(q)
+    if not match:
+        return [], False
+    # rank 即 bm25 相关度，越小越相关；多取一行用来判断是否还有下一页
+    statement = text(
+        'SELECT movie.* FROM movie_fts JOIN movie ON movie.id = movie_fts.rowid '
+        'WHERE movie_fts MATCH :match ORDER BY movie_fts.rank LIMIT :limit OFFSET :offset'
+    )
+    movies = Movie.query.from_statement(statement).params(
+        match=match, limit=per_page + 1, offset=(page - 1) * per_page).all()
+    return movies[:per_page], len(movies) > per_page
@@ -0,0 +1,124 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+from flask import abort
+from werkzeug.security import check_password_hash
+
+from watchlist import app
+
+# 登录保护
+# 校验密码（PBKDF2）是故意设计得很慢的 CPU 计算。如果直接在请求线程里做，
+# 有人不停地提交 /login 时所有 worker 都会忙于算散列，正常页面也跟着变慢。
+# 这里做了两层保护：
+#   1. 令牌桶限流：每个客户端 IP、每个用户名各有一个桶，桶空了直接返回 429；
+#   2. 密码校验交给一个固定大小的进程池，同时排队的校验数有上限，超过上限立即返回 429，
+#      而不是让请求线程排队等待。等待超过 LOGIN_TIMEOUT 秒也返回 429。
+
+
+class TokenBucketLimiter(object):
+    """In-memory token buckets: ``burst`` tokens, refilled at ``rate`` per second."""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}    # key -> (tokens, updated_at)
+
+    def allow(self, key, rate, burst):
+        """Take one token from ``key``'s bucket; return False if it is empty."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now, rate, burst)
+            return allowed
+
+    def _prune(self, now, rate, burst):
+        # 删除已经重新装满的桶，它们和不存在的桶等价
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * rate >= burst:
+                del self._buckets[key]
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+login_limiter = TokenBucketLimiter()
+
+
+def check_login_rate(client, username):
+    """Abort with 429 when the client or the username is over its login rate."""
+    rate = app.config['LOGIN_RATE']
+    burst = app.config['LOGIN_BURST']
+    # 两个桶都要扣，避免换 IP 猜同一个用户名，或用同一个 IP 猜不同用户名
+    client_allowed = login_limiter.allow('client:%s' % client, rate, burst)
+    username_allowed = login_limiter.allow('username:%s' % username, rate, burst)
+    if not (client_allowed and username_allowed):
+        abort(429)
+
+
+class PasswordVerifier(object):
+    """Runs password checks on a bounded executor, failing fast when it is full."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _get_executor(self):
+        # 第一次使用时才创建进程池，这样 gunicorn fork 出来的每个 worker 都有自己的进程池
+        with self._lock:
+            if self._executor is None:
+                kind = app.config['LOGIN_EXECUTOR']
+                workers = app.config['LOGIN_WORKERS']
+                if kind == 'process':
+                    # spawn 出的子进程只导入 werkzeug，不复制整个应用
+                    self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                elif kind == 'thread':
+                    self._executor = ThreadPoolExecutor(workers)
+                self._slots = threading.BoundedSemaphore(app.config['LOGIN_QUEUE_LIMIT'])
+            return self._executor, self._slots
+
+    def verify(self, password_hash, password):
+        """Return True if ``password`` matches ``password_hash``; abort with 429 when saturated."""
+        executor, slots = self._get_executor()
+        if executor is None:    # LOGIN_EXECUTOR=inline
+            return check_password_hash(password_hash, password)
+        if not slots.acquire(blocking=False):
+            abort(429)    # 排队的校验已经太多，立即拒绝
+        try:
+            future = executor.submit(check_password_hash, password_hash, password)
+        except Exception:
+            slots.release()
+            raise
+        # 校验结束（或被取消）时才归还名额：请求超时返回后，还在排队、正在计算的校验仍然占着名额，
+        # 进程池的队列长度始终不超过 LOGIN_QUEUE_LIMIT
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(timeout=app.config['LOGIN_TIMEOUT'])
+        except TimeoutError:
+            future.cancel()    # 还在排队的校验直接取消，已经开始的算完后归还名额
+            abort(429)
+
+    def reset(self):
+        """Forget the executor without shutting it down (its workers belong to the parent process after a fork)."""
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._slots = None
+
+
+password_verifier = PasswordVerifier()
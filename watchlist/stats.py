@@ -0,0 +1,139 @@
+from collections import Counter
+
+from sqlalchemy import event, inspect, text
+
+from watchlist import db
+from watchlist.models import Movie, MovieStat
+
+# 电影数量统计
+# 主页的总数、统计页的按年份、按年代计数都只读 movie_stat 这张小表，不扫描 movie 表。
+# 和搜索索引一样（见 watchlist/search.py），统计通过 ORM 事件在同一个事务里更新（表单、API、forge），
+# 批量插入的路径在每批插入后调用 count_movies_after() 用一条 GROUP BY 补上这一批的计数。
+# 这一批的事务必须用 search.begin_bulk_insert() 开始：它先拿写锁再读最大 id，
+# 否则中间别的请求提交的电影（已经由 ORM 事件计数）会被再计数一次。
+# 只有 flask rebuild-stats 和 flask check-stats 会扫描整张 movie 表。
+
+# 计数只做增减：count = count + excluded.count，并发的写事务不会互相覆盖
+ON_CONFLICT = ' ON CONFLICT (scope, "key") DO UPDATE SET count = count + excluded.count'
+UPSERT = text('INSERT INTO movie_stat (scope, "key", count) VALUES (:scope, :key, :count)' + ON_CONFLICT)
+
+# 年代用整数除法计算，1994 -> 1990；没有年份的电影只计入总数
+COUNT_QUERIES = (
+    "SELECT 'total', 0, count(*) FROM movie WHERE id > :id",
+    "SELECT 'decade', year / 10 * 10, count(*) FROM movie WHERE id > :id AND year IS NOT NULL GROUP BY year / 10",
+    "SELECT 'year', year, count(*) FROM movie WHERE id > :id AND year IS NOT NULL GROUP BY year",
+)
+
+
+def _deltas(year, sign):
+    deltas = [('total', 0, sign)]
+    if year is not None:
+        year = int(year)
+        deltas += [('decade', year // 10 * 10, sign), ('year', year, sign)]
+    return deltas
+
+
+def _apply(connection, deltas):
+    changes = Counter()
+    for scope, key, count in deltas:
+        changes[scope, key] += count
+    params = [{'scope': scope, 'key': key, 'count': count} for (scope, key), count in changes.items() if count]
+    if params:    # 例如同一年代里修改年份时，年代的增减正好抵消
+        connection.execute(UPSERT, params)
+
+
+@event.listens_for(Movie, 'after_insert')
+def count_movie(mapper, connection, target):
+    _apply(connection, _deltas(target.year, 1))
+
+
+@event.listens_for(Movie, 'after_update')
+def recount_movie(mapper, connection, target):
+    history = inspect(target).attrs.year.history
+    if not history.has_changes():
+        return
+    deltas = _deltas(target.year, 1)
+    for old_year in history.deleted:
+        deltas += _deltas(old_year, -1)
+    _apply(connection, deltas)
+
+
+@event.listens_for(Movie, 'after_delete')
+def uncount_movie(mapper, connection, target):
+    _apply(connection, _deltas(target.year, -1))
+
+
+def _insert_counts(connection, last_id):
+    for query in COUNT_QUERIES:
+        connection.execute(text('INSERT INTO movie_stat (scope, "key", count) ' + query + ON_CONFLICT),
+                           {'id': last_id})
+
+
+# 新建 movie_stat 表时（db.create_all()，包括给旧数据库补建）按已有的电影填好计数，
+# 表里一开始就有 total 这一行
+@event.listens_for(MovieStat.__table__, 'after_create')
+def fill_stats(target, connection, **kw):
+    if inspect(connection).has_table('movie'):
+        _insert_counts(connection, 0)
+
+
+def count_movies_after(last_id):
+    """Add the movies with an id greater than ``last_id`` to the counts.
+
+    Call it after a bulk insert, in the transaction started by
+    :func:`watchlist.search.begin_bulk_insert` that returned ``last_id``.
+    """
+    _insert_counts(db.session.connection(), last_id)
+
+
+def rebuild_stats():
+    """Recount every movie from scratch."""
+    db.session.execute(text('DELETE FROM movie_stat'))
+    count_movies_after(0)
+    db.session.commit()
+
+
+def _expected_counts():
+    counts = {}
+    for query in COUNT_QUERIES:
+        for scope, key, count in db.session.execute(text(query), {'id': 0}):
+            counts[scope, key] = count
+    return counts
+
+
+def check_stats():
+    """Compare the counts with the movie table; return ``(scope, key, expected, actual)`` for each mismatch."""
+    expected = _expected_counts()
+    actual = {(stat.scope, stat.key): stat.count for stat in MovieStat.query}
+    actual.setdefault(('total', 0), None)    # 没有电影时 total 这一行也应该存在（计数为 0）
+    mismatches = []
+    for scope, key in sorted(set(expected) | set(actual)):
+        if expected.get((scope, key), 0) != actual.get((scope, key), 0):
+            mismatches.append((scope, key, expected.get((scope, key), 0), actual.get((scope, key), 0)))
+    return mismatches
+
+
+def count_movies(year_from=None, year_to=None):
+    """Return the number of movies, optionally only those released in ``year_from``-``year_to``."""
+    if year_from is None and year_to is None:
+        return db.session.query(MovieStat.count).filter_by(scope='total', key=0).scalar() or 0
+    query = db.session.query(db.func.coalesce(db.func.sum(MovieStat.count), 0)).filter(MovieStat.scope == 'year')
+    if year_from is not None:
+        query = query.filter(MovieStat.key >= year_from)
+    if year_to is not None:
+        query = query.filter(MovieStat.key <= year_to)
+    return query.scalar()
+
+
+def get_stats():
+    """Return the total and the per-decade and per-year counts, read with one query."""
+    stats = {'total': 0, 'decades': [], 'years': []}
+    rows = MovieStat.query.filter(MovieStat.count > 0).order_by(MovieStat.scope, MovieStat.key)
+    for stat in rows:
+        if stat.scope == 'total':
+            stats['total'] = stat.count
+        elif stat.scope == 'decade':
+            stats['decades'].append({'decade': stat.key, 'count': stat.count})
+        else:
+            stats['years'].append({'year': stat.key, 'count': stat.count})
+    return stats
@@ -0,0 +1,63 @@
+from flask import before_render_template, get_flashed_messages, stream_with_context, template_rendered
+
+from watchlist import app
+from watchlist.cache import page_cacheable
+
+# 流式渲染
+# render_template() 要等整页都渲染完才开始发送。stream_template() 边渲染边发送：
+# <head>、头像和导航栏先发出去，浏览器可以马上开始加载样式表，
+# 列表查询、计数等用 Deferred 包装的值在模板用到时才执行。
+# 匿名访客的页面会进入整页缓存（见 watchlist/cache.py），缓存需要完整的响应体，所以这时仍然整页渲染。
+
+
+class Deferred(object):
+    """A value computed the first time the template touches it."""
+
+    def __init__(self, func):
+        self._func = func
+        self._resolved = False
+        self._value = None
+
+    def resolve(self):
+        if not self._resolved:
+            self._value = self._func()
+            self._resolved = True
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __bool__(self):
+        return bool(self.resolve())
+
+    def __str__(self):
+        return str(self.resolve())
+
+
+def should_stream():
+    """Stream list pages unless the page cache wants the whole body."""
+    return app.config['STREAM_TEMPLATES'] and not page_cacheable()
+
+
+def stream_template(template_name, **context):
+    """Render ``template_name`` as a streamed response."""
+    # 提示消息存放在 session 里，流式响应开始发送后 session 就不能再修改了，
+    # 所以先取出来（会缓存在请求上下文里，模板再次调用时直接返回）
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)    # 让渲染时间照常计入指标
+        stream = template.stream(context)
+        stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])    # 攒够几段再发送，避免一个标签一个数据块
+        yield from stream
+        template_rendered.send(app, template=template, context=context)
+
+    return app.response_class(stream_with_context(generate()), mimetype='text/html')
@@ -0,0 +1,179 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import insert, select, text
+
+from watchlist import db
+from watchlist.models import Movie, validate_movie
+from watchlist.cache import invalidate_movie_cache
+from watchlist.search import begin_bulk_insert, index_movies_after
+from watchlist.stats import count_movies_after
+
+# 批量导入
+# 逐行读取文件（内存占用与文件大小无关），每 batch_size 行用一条 executemany
+# 插入并提交一次事务，既避免逐行提交的开销，又不会让单个事务过大。
+
+# 去重插入：同一事务里 executemany 逐行执行，后面的行能看到前面刚插入的行，
+# 所以文件内部的重复行也会被跳过。依赖 ix_movie_title_year 索引。
+DEDUPE_INSERT = text(
+    'INSERT INTO movie (title, year, updated_at) SELECT :title, :year, :updated_at '
+    'WHERE NOT EXISTS (SELECT 1 FROM movie WHERE title = :title AND year = :year)'
+)
+
+
+def read_csv(stream):
+    """Yield ``(line_number, row)`` pairs from a CSV file with a header row."""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(stream):
+    """Yield ``(line_number, row)`` pairs from a JSON-lines file."""
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def clean_row(row):
+    """Return ``{'title': str, 'year': int}`` or None if the row is invalid."""
+    if not isinstance(row, dict):
+        return None
+    title = row.get('title')
+    year = row.get('year')
+    if isinstance(year, int) and not isinstance(year, bool):
+        year = str(year)    # JSON 里的年份可能是数字
+    if not isinstance(title, str) or not isinstance(year, str):
+        return None
+    if not validate_movie(title, year):
+        return None
+    return {'title': title, 'year': int(year)}
+
+
+class ImportResult(object):
+
+    def __init__(self):
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+
+def import_movies(rows, batch_size=5000, dedupe=False, on_invalid=None):
+    """Insert ``(line_number, row)`` pairs in batches and return an :class:`ImportResult`.
+
+    ``on_invalid(line_number, row)`` is called for every row that fails validation.
+    """
+    result = ImportResult()
+    statement = DEDUPE_INSERT if dedupe else insert(Movie)
+    batch = []
+
+    def flush():
+        if dedupe:
+            now = datetime.utcnow()    # 文本 SQL 不会套用模型里的默认值，手动填上修改时间
+            for values in batch:
+                values['updated_at'] = now
+        last_id = begin_bulk_insert()
+        cursor = db.session.execute(statement, batch)
+        inserted = cursor.rowcount if dedupe else len(batch)
+        index_movies_after(last_id)    # 新插入的行 id 都大于 last_id，一次性加入搜索索引
+        count_movies_after(last_id)    # 同样一次性加入统计
+        result.inserted += inserted
+        result.duplicates += len(batch) - inserted
+        invalidate_movie_cache()
+        db.session.commit()    # 每批提交一次
+        del batch[:]
+
+    for line_number, row in rows:
+        values = clean_row(row)
+        if values is None:
+            result.invalid += 1
+            if on_invalid is not None:
+                on_invalid(line_number, row)
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return result
+
+
+# 流式导出
+# 用 yield_per 分块读取查询结果，再分块生成输出，任何时候内存里都只有一个块，
+# 第一块数据生成后就可以立即发送给客户端。
+
+EXPORT_COLUMNS = ('id', 'title', 'year', 'updated_at')
+
+
+def iter_movies(since=None, chunk_size=1000):
+    """Yield lists of up to ``chunk_size`` movie rows ordered by id."""
+    query = select(Movie.id, Movie.title, Movie.year, Movie.updated_at).order_by(Movie.id)
+    if since is not None:
+        query = query.where(Movie.updated_at >= since)
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+    for partition in result.partitions(chunk_size):
+        yield partition
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def write_csv(chunks):
+    """Yield CSV text, one string per chunk of rows, starting with the header."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows((id, title, year, _isoformat(updated_at)) for id, title, year, updated_at in rows)
+        yield buffer.getvalue()
+
+
+def write_jsonl(chunks):
+    """Yield JSON-lines text, one string per chunk of rows."""
+    for rows in chunks:
+        yield ''.join(json.dumps({'id': id, 'title': title, 'year': year,
+                                  'updated_at': _isoformat(updated_at)}) + '\n'
+                      for id, title, year, updated_at in rows)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip an iterable of text chunks on the fly, yielding bytes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)    # wbits=31 生成 gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_movies(fmt, since=None, gzip=False, chunk_size=1000):
+    """Return an iterator of output chunks (str, or bytes when ``gzip``)."""
+    chunks = WRITERS[fmt](iter_movies(since, chunk_size))
+    if gzip:
+        chunks = gzip_stream(chunks)
+    return chunks
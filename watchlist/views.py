@@ -1,12 +1,26 @@
-from flask import render_template, request, url_for, redirect, flash
+from datetime import datetime
+
+from flask import render_template, request, url_for, redirect, flash, abort, stream_with_context
 from flask_login import login_user, login_required, logout_user, current_user
 
 from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist.models import User, Movie, validate_movie
+from watchlist.cache import invalidate_user_cache, invalidate_movie_cache, cached_page
+from watchlist.database import read_only
+from watchlist.pagination import keyset_paginate, get_per_page, get_cursor, MAX_INT
+from watchlist.transfer import export_movies
+from watchlist.search import search_movies
+from watchlist.stats import count_movies, get_stats
+from watchlist.security import check_login_rate, password_verifier
+from watchlist.metrics import render_metrics
+from watchlist.streaming import Deferred, should_stream, stream_template
+from watchlist.groupcommit import commit_write
 
 # 主页视图
 # 这个视图函数处理哪种方法类型的请求。默认只接受 GET 请求，上面的写法表示同时接受 GET 和 POST 请求。
 @app.route('/', methods=['GET', 'POST'])    # index-索引，即主页
+@read_only    # GET 请求的查询走只读连接池
+@cached_page('movie', 'user')    # 匿名访客的 GET 请求直接返回缓存的页面，电影或用户数据变化后失效
 def index():
 
     if request.method == 'POST':    #判断是否是post请求
@@ -16,26 +30,115 @@ def index():
         title = request.form.get('title')    # 传入表单对应输入字段的 name 值
         year = request.form.get('year')
         #验证数据是否有效
-        if not title or not year or len(title) > 60 or len(year) > 4:
+        if not validate_movie(title, year):    # 标题不超过 60 个字符，年份是不超过 4 位的数字
             flash("Invalid input.")    # 显示错误提示
             return redirect(url_for('index'))    # 重定向回主页
         #保存表单数据到数据库
-        movid = Movie(title=title, year=year)    # 创建记录
-        db.session.add(movid)    # 添加到数据库会话
-        db.session.commit()    # 提交数据库会话
+        def create_movie():    # 写操作放在函数里，合并提交模式下交给写线程执行（见 watchlist/groupcommit.py）
+            movid = Movie(title=title, year=int(year))    # 创建记录
+            db.session.add(movid)    # 添加到数据库会话
+            invalidate_movie_cache()    # 让缓存的主页失效
+
+        commit_write(create_movie)    # 提交数据库会话
         flash("Item Created.")    #显示成功创建的提示
         return redirect(url_for('index'))  # 重定向回主页
 
     #user = User(name = 'Alex Goke')     #直接给user赋值，后面采用数据库的方式【弃用】
-    user = User.query.first()
-    movies = Movie.query.all()
+    #movies = Movie.query.all()    # 一次取出整张表，表越大主页越慢【弃用】，改为按主键游标分页
+    query, columns, filters = movie_list_query()
+    after, before, per_page = get_cursor('after', columns), get_cursor('before', columns), get_per_page()
+
+    def get_page():
+        return keyset_paginate(query, columns, after=after, before=before, per_page=per_page)
+
+    def get_total():
+        #return query.with_entities(func.count(Movie.id)).scalar()    # 计数要扫描整个索引，表越大越慢【弃用】
+        return count_movies(filters['year_from'], filters['year_to'])    # 改为读取统计表（见 watchlist/stats.py）
+
+    if should_stream():
+        # 流式渲染：页面头部先发出去，计数和列表查询在模板渲染到那里时才执行
+        page = Deferred(get_page)
+        return stream_template('index.html', movies=page, page=page, total=Deferred(get_total), filters=filters)
+    page = get_page()
     #return render_template('index.html', user=user, movies=movies)    #render_template() 函数在调用时会识别并执行 index.html 里所有的 Jinja2 语句，返回渲染好的模板内容。
-    return render_template('index.html', movies=movies)    #有了模板上下文函数，user可省略
+    return render_template('index.html', movies=page.items, page=page, total=get_total(), filters=filters)    #有了模板上下文函数，user可省略
+
+
+# 主页的排序方式：每种排序的列组合都正好对应一个索引（SQLite 的索引末尾隐含 id），
+# 翻页和排序都在索引上完成，不需要扫描整张表或额外排序
+MOVIE_SORTS = {
+    'id': (Movie.id,),
+    'year': (Movie.year, Movie.title, Movie.id),    # ix_movie_year_title
+    'title': (Movie.title, Movie.year, Movie.id),    # ix_movie_title_year
+}
+# 按年份筛选时默认排序改为先按年份、同一年里按添加顺序（ix_movie_year），
+# 否则按 id 排序要把整个年份范围取出来再排序
+FILTERED_ID_SORT = (Movie.year, Movie.id)
+# 按年份范围查找再排序时每行要回表读整行，代价约是沿标题索引读一项的 30 倍（100 万行的数据实测）
+SORT_ROW_COST = 30
+
+
+def movie_list_query():
+    """Build the index page query from ?year_from=, ?year_to= and ?sort=."""
+    year_from = request.args.get('year_from', type=int)
+    year_to = request.args.get('year_to', type=int)
+    sort = request.args.get('sort')
+    if sort not in MOVIE_SORTS:
+        sort = None
+
+    columns = MOVIE_SORTS[sort or 'id']
+    query = Movie.query
+    if year_from is not None and year_from == year_to:
+        # 只筛选一年：等值查找，三种排序在 ix_movie_year / ix_movie_year_title 里都已经有序
+        query = query.filter(Movie.year == year_from)
+    elif year_from is not None or year_to is not None:
+        year = Movie.year
+        if sort == 'title' and not narrow_year_range(year_from, year_to):
+            # 范围很宽时写成 year + 0，让 SQLite 不用年份索引做范围查找，
+            # 而是沿着 ix_movie_title_year 按顺序读取、边读边过滤，很快就能取满一页
+            year = Movie.year + 0
+        if year_from is not None:
+            query = query.filter(year >= year_from)
+        if year_to is not None:
+            query = query.filter(year <= year_to)
+    if sort in (None, 'id') and (year_from is not None or year_to is not None):
+        columns = FILTERED_ID_SORT
+    filters = {'year_from': year_from, 'year_to': year_to, 'sort': sort}    # 翻页链接需要带上这些参数
+    return query, columns, filters
+
+
+def narrow_year_range(year_from, year_to):
+    """Return True if sorting the movies in the year range by title is cheaper than walking the title index."""
+    # 按年份范围查找再排序要读 matching 行；沿标题索引边读边过滤，取满一页平均要读 per_page * total / matching 项。
+    # 两个数都从统计表读出（见 watchlist/stats.py），不扫描 movie 表
+    matching = count_movies(year_from, year_to)
+    return matching * matching * SORT_ROW_COST <= get_per_page() * count_movies()
+
+
+# 标题搜索
+@app.route('/search')
+@read_only
+def search():
+    q = request.args.get('q', '').strip()
+    page, per_page = max(request.args.get('page', 1, type=int), 1), get_per_page()
+    if (page - 1) * per_page > MAX_INT:    # OFFSET 超出 SQLite 的 64 位整数范围
+        abort(400)
+    movies, has_next = search_movies(q, page=page, per_page=per_page)
+    return render_template('search.html', q=q, movies=movies, page=page, has_next=has_next)
+
+
+# 统计页：总数、每个年代和每一年的电影数量，只读统计表，一次查询
+@app.route('/stats')
+@read_only
+@cached_page('movie', 'user')
+def stats():
+    return render_template('stats.html', stats=get_stats())
 
 
 # 编辑电影条目
 @app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])    #<int:movie_id> 部分表示 URL 变量，而 int 则是将变量转换成整型的 URL 变量转换器。
 @login_required
+@read_only
 def edit(movie_id):
     movie = Movie.query.get_or_404(movie_id)    #get_or_404() 方法，它会返回对应主键的记录，如果没有找到，则返回 404 错误响应。
 
@@ -43,13 +146,17 @@ def edit(movie_id):
         title = request.form['title']
         year = request.form['year']
 
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not validate_movie(title, year):
             flash('Invalid input.')
             return redirect(url_for('edit', movie_id=movie_id))  # 重定向回对应的编辑页面
 
-        movie.title = title  # 更新标题
-        movie.year = year  # 更新年份
-        db.session.commit()  # 提交数据库会话
+        def update_movie():
+            movie = Movie.query.get_or_404(movie_id)    # 重新查询：合并提交模式下这个函数在写线程里执行
+            movie.title = title  # 更新标题
+            movie.year = int(year)  # 更新年份
+            invalidate_movie_cache()
+
+        commit_write(update_movie)  # 提交数据库会话
         flash('Item updated.')
         return redirect(url_for('index'))  # 重定向回主页
 
@@ -59,9 +166,12 @@ def edit(movie_id):
 @app.route('/movie/delete/<int:movie_id>', methods=['POST'])  # 限定只接受 POST 请求
 @login_required  # 登录保护 添加了这个装饰器后，如果未登录的用户访问对应的 URL，Flask-Login 会把用户重定向到登录页面，并显示一个错误提示。
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)  # 获取电影记录
-    db.session.delete(movie)  # 删除对应的记录
-    db.session.commit()  # 提交数据库会话
+    def delete_movie():
+        movie = Movie.query.get_or_404(movie_id)  # 获取电影记录
+        db.session.delete(movie)  # 删除对应的记录
+        invalidate_movie_cache()
+
+    commit_write(delete_movie)  # 提交数据库会话
     flash('Item deleted.')
     return redirect(url_for('index'))  # 重定向回主页   
 
@@ -76,12 +186,16 @@ def settings():
             flash('Invalid input.')
             return redirect(url_for('settings'))
 
-        current_user.name = name
-        # current_user 会返回当前登录用户的数据库记录对象
-        # 等同于下面的用法
-        # user = User.query.first()
-        # user.name = name
-        db.session.commit()
+        #current_user.name = name
+        # current_user 可能是缓存的轻量用户对象（不在数据库会话中），所以按 id 重新查询再修改
+        user_id = current_user.id
+
+        def update_user():
+            user = User.query.get(user_id)
+            user.name = name
+            invalidate_user_cache()    # 名字显示在每个页面上，让所有 worker 的缓存失效
+
+        commit_write(update_user)
         flash('Settings updated.')
         return redirect(url_for('index'))
 
@@ -98,9 +212,12 @@ def login():
             flash('Invalid input.')
             return redirect(url_for('login'))
 
+        check_login_rate(request.remote_addr, username)    # 尝试太频繁时返回 429
+
         user = User.query.first()
         # 验证用户名和密码是否一致
-        if username == user.username and user.validate_password(password):
+        # 密码校验交给进程池，不占用请求线程的 CPU
+        if user is not None and username == user.username and password_verifier.verify(user.password_hash, password):
             login_user(user)    # 登入用户
             flash('Login success.')
             return redirect(url_for('index'))    # 重定向到主页
@@ -115,4 +232,33 @@ def login():
 def logout():
     logout_user()  # 登出用户
     flash('Goodbye.')
-    return redirect(url_for('index'))  # 重定向回首页
\ No newline at end of file
+    return redirect(url_for('index'))  # 重定向回首页
+
+# 导出整个片单
+# /export.csv 或 /export.jsonl，?gzip=1 压缩输出，?since=2019-01-01T00:00:00 只导出此后修改过的条目
+@app.route('/export.<any(csv, jsonl):fmt>')
+def export(fmt):
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+    else:
+        since = None
+    gzip = request.args.get('gzip', type=int) == 1
+
+    filename = 'watchlist.' + fmt
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if gzip:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    # 生成器响应：边查询边发送，stream_with_context 让生成器在请求结束前都能使用数据库会话
+    response = app.response_class(stream_with_context(export_movies(fmt, since=since, gzip=gzip)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+# Prometheus 指标
+@app.route('/metrics')
+def metrics():
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
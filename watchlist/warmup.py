@@ -0,0 +1,38 @@
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+from watchlist import app
+
+# 冷启动预热
+# 每个 gunicorn worker 第一次用到某个模板时都要把它编译成 Python 代码，部署或 worker 重启后的头几个请求明显变慢。
+#   * 字节码缓存：编译结果写入 JINJA_BYTECODE_CACHE_DIR，按模板源码的校验和区分，
+#     其他 worker 和下次启动直接读取，不再编译。写入时先写临时文件再改名，多个进程同时写也是安全的；
+#   * 预热：warmup() 提前加载所有模板、整理 URL 规则，TEMPLATE_WARMUP=1 时在启动时执行，
+#     也可以在构建镜像时运行 flask warmup，把字节码缓存一起打包进去。
+
+
+def configure_bytecode_cache():
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:    # 目录不可写（例如只读的镜像）时不使用字节码缓存，应用照常启动
+            app.logger.warning('Jinja bytecode cache disabled, cannot create %s: %s', cache_dir, e)
+            app.jinja_env.bytecode_cache = None
+            return
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def warmup():
+    """Compile every template and build the URL map; return ``(template_count, seconds)``."""
+    start = time.perf_counter()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)    # 编译后留在环境的模板缓存里，同时写入字节码缓存
+    app.url_map.update()    # 排序规则、生成匹配器，否则第一个请求来做
+    return len(names), time.perf_counter() - start
+
+
+configure_bytecode_cache()